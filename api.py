@@ -1,20 +1,75 @@
 from fastapi import FastAPI
 from typing import List, Optional
 from pydantic import BaseModel
-import mysql.connector
 from datetime import datetime
 import os
 from dotenv import load_dotenv
 import logging
-from fastapi import HTTPException
+import json
+import base64
+import socket
+import time
+from contextlib import asynccontextmanager
+from fastapi import HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from log_tail import read_log_tail, follow_log
+import metrics
 
 # Load environment variables
 load_dotenv()
 
-# Import DB_CONFIG after loading environment variables
-from database import DB_CONFIG
+# Import the database layer after loading environment variables
+from database import (get_connection, build_emails_query, EMAIL_COLUMNS,
+                      build_sessions_query, get_session, SESSION_COLUMNS, build_search_query, SEARCH_MODES,
+                      get_metrics_snapshots, ensure_schema, build_changes_query, get_changes_version)
+from change_feed import ResponseCache, make_etag, etag_matches, next_cursor, CHANGES_SETTLE_SECONDS
 
-app = FastAPI()
+# Rows fetched from MySQL per round-trip by the streaming endpoint
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', '500'))
+
+# Database driver for /emails/ and /logs/: 'mysql-connector' (blocking, run in
+# the threadpool) or 'aiomysql' (async, pool managed by the app lifespan)
+API_DB_DRIVER = os.getenv('API_DB_DRIVER', 'mysql-connector')
+
+# Create/migrate the schema when the API starts. Off by default: the worker
+# does it, and API processes should start without waiting for the database
+API_SCHEMA_CHECK = os.getenv('API_SCHEMA_CHECK', 'false').lower() in ('1', 'true', 'yes')
+
+LOG_FILE = "email_service.log"
+
+API_WORKER_ID = f"api:{socket.gethostname()}:{os.getpid()}"
+API_REQUEST_SECONDS = metrics.histogram('email_api_request_seconds', "API request duration by route")
+CHANGES_RESPONSES = metrics.counter('email_api_changes_total', "Change feed responses by how they were served")
+
+# Serialized /emails/changes pages by ETag
+changes_cache = ResponseCache()
+
+@asynccontextmanager
+async def lifespan(app):
+    if API_SCHEMA_CHECK:
+        await run_in_threadpool(ensure_schema)
+    if API_DB_DRIVER == 'aiomysql':
+        from api_async import open_pool, close_pool
+        await open_pool(app)
+        try:
+            yield
+        finally:
+            await close_pool(app)
+    else:
+        yield
+
+app = FastAPI(lifespan=lifespan)
+
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    # The route template, not the raw path, keeps the label set bounded
+    route = request.scope.get('route')
+    API_REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                path=getattr(route, 'path', 'unmatched'), status=response.status_code)
+    return response
 
 class Email(BaseModel):
     sender_email: str
@@ -27,71 +82,424 @@ class Email(BaseModel):
     role: str
     received_at: str
 
+class SearchResult(Email):
+    score: float
+
+class Session(BaseModel):
+    session_id: str
+    subject: Optional[str] = None
+    sender_email: Optional[str] = None
+    message_count: int
+    first_at: str
+    last_at: str
+    last_role: Optional[str] = None
+
+class SessionDetail(BaseModel):
+    session: Session
+    emails: List[Email]
+
+def format_received_at(received_time):
+    """Format the datetime for display"""
+    if isinstance(received_time, datetime):
+        return received_time.strftime('%Y-%m-%d %H:%M:%S')
+    return str(received_time)
+
+def parse_fields(fields):
+    """Parse a comma separated field projection, defaulting to every Email field"""
+    if not fields:
+        return list(EMAIL_COLUMNS)
+    selected = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = [field for field in selected if field not in EMAIL_COLUMNS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return selected
+
+def row_to_dict(row, fields):
+    """Map a row from build_emails_query to a dict of the projected fields"""
+    email = dict(zip(fields, row))
+    if 'received_at' in email:
+        email['received_at'] = format_received_at(email['received_at'])
+    return email
+
+def encode_cursor(received_at, key):
+    """Opaque keyset cursor for the row a page ended on (timestamp plus tie-breaker)"""
+    raw = json.dumps([format_received_at(received_at), key])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        received_at, key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.strptime(received_at, '%Y-%m-%d %H:%M:%S'), key
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def emails_page(db_emails, selected, limit, fields, response):
+    """Turn the rows of a limit + 1 page query into the /emails/ response"""
+    headers = {}
+    if len(db_emails) > limit:
+        db_emails = db_emails[:limit]
+        headers['X-Next-Cursor'] = encode_cursor(*db_emails[-1][-2:])
+    
+    emails = [row_to_dict(email[:-2], selected) for email in db_emails]
+    logging.getLogger(__name__).info(f"Successfully processed {len(emails)} emails")
+    
+    if fields:
+        # Partial rows do not fit the Email model, so skip response validation
+        return JSONResponse(content=emails, headers=headers)
+    response.headers.update(headers)
+    return [Email(**email) for email in emails]
+
 @app.get("/emails/", response_model=List[Email])
-def get_emails():
+def get_emails(
+    response: Response,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    session_id: Optional[str] = None,
+    sender: Optional[str] = None,
+    role: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    fields: Optional[str] = None,
+):
+    """
+    Return one page of emails, newest first. Pass the X-Next-Cursor response
+    header back as cursor to get the next page; the header is absent on the
+    last page. fields is an optional comma separated projection.
+    """
+    logger = logging.getLogger(__name__)
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
-        c = conn.cursor()
+        selected = parse_fields(fields)
+        after = decode_cursor(cursor) if cursor else None
         
         # Add logging to help debug
-        logger = logging.getLogger(__name__)
         logger.info("Attempting to fetch emails from database")
         
-        c.execute('''SELECT sender_email, sender_id, session_id, message_id, in_reply_to, subject, message, role, received_at 
-                     FROM emails
-                     ORDER BY received_at DESC''')
-        db_emails = c.fetchall()
+        # Fetch one extra row to know whether another page follows
+        sql, params = build_emails_query(selected, session_id=session_id, sender=sender, role=role,
+                                         since=since, until=until, after=after, limit=limit + 1)
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute(sql, params)
+            db_emails = c.fetchall()
         
         logger.info(f"Retrieved {len(db_emails)} emails from database")
+        return emails_page(db_emails, selected, limit, fields, response)
         
-        emails = []
-        for email in db_emails:
-            # Format the datetime for display
-            received_time = email[8]
-            if isinstance(received_time, datetime):
-                formatted_time = received_time.strftime('%Y-%m-%d %H:%M:%S')
-            else:
-                formatted_time = str(received_time)
-                
-            emails.append(Email(
-                sender_email=email[0],
-                sender_id=email[1],
-                session_id=email[2],
-                message_id=email[3],
-                in_reply_to=email[4],
-                subject=email[5],
-                message=email[6],
-                role=email[7],
-                received_at=formatted_time
-            ))
-        
-        conn.close()
-        logger.info(f"Successfully processed {len(emails)} emails")
-        return emails
-        
+    except HTTPException:
+        raise
     except Exception as e:
-        logger = logging.getLogger(__name__)
         logger.error(f"Error fetching emails: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error fetching emails: {str(e)}")
 
+@app.get("/emails/stream")
+def stream_emails(
+    session_id: Optional[str] = None,
+    sender: Optional[str] = None,
+    role: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    fields: Optional[str] = None,
+):
+    """Stream every matching email as NDJSON, newest first, without buffering the result"""
+    logger = logging.getLogger(__name__)
+    selected = parse_fields(fields)
+    sql, params = build_emails_query(selected, session_id=session_id, sender=sender, role=role,
+                                     since=since, until=until)
+
+    def generate():
+        with get_connection() as conn:
+            # Unbuffered cursor: rows are read from the server as we go
+            c = conn.cursor(buffered=False)
+            try:
+                c.execute(sql, params)
+                while True:
+                    rows = c.fetchmany(STREAM_BATCH_SIZE)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield json.dumps(row_to_dict(row[:-2], selected)) + "\n"
+            except Exception as e:
+                logger.error(f"Error streaming emails: {str(e)}", exc_info=True)
+                raise
+            finally:
+                # The client may disconnect mid-stream; the connection must be
+                # drained before it can go back to the pool
+                if conn.unread_result:
+                    conn.consume_results()
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+@app.get("/emails/changes")
+def get_email_changes(
+    request: Request,
+    since: int = Query(0, ge=0),
+    limit: int = Query(500, ge=1, le=5000),
+    fields: Optional[str] = None,
+):
+    """
+    Incremental change feed: the emails stored after cursor since, oldest
+    first, each with its id. Poll again with the returned cursor; more is
+    true while another page is ready. Send the ETag back as If-None-Match
+    to get 304 Not Modified when nothing changed.
+    """
+    logger = logging.getLogger(__name__)
+    try:
+        selected = parse_fields(fields)
+        with get_connection() as conn:
+            c = conn.cursor()
+            # Both queries run in the same transaction, so the page matches its version
+            version = get_changes_version(c, since, limit + 1, settle=CHANGES_SETTLE_SECONDS)
+            etag = make_etag(since, limit, selected, version)
+            headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+            if etag_matches(request.headers.get('if-none-match'), etag):
+                CHANGES_RESPONSES.inc(result='not_modified')
+                return Response(status_code=304, headers=headers)
+            body = changes_cache.get(etag)
+            if body is not None:
+                CHANGES_RESPONSES.inc(result='cached')
+                return Response(content=body, media_type="application/json", headers=headers)
+
+            sql, params = build_changes_query(selected, since=since, settle=CHANGES_SETTLE_SECONDS, limit=limit + 1)
+            c.execute(sql, params)
+            rows = c.fetchall()
+
+        more = len(rows) > limit
+        rows = rows[:limit]
+        emails = [{**row_to_dict(row[:-2], selected), 'id': row[-2]} for row in rows]
+        cursor = next_cursor(since, [(row[-2], bool(row[-1])) for row in rows])
+        body = json.dumps({'cursor': cursor, 'more': more, 'emails': emails}).encode()
+        changes_cache.put(etag, body)
+        CHANGES_RESPONSES.inc(result='queried')
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error fetching email changes: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error fetching email changes: {str(e)}")
+
+def encode_search_cursor(score, key):
+    """Opaque keyset cursor for /search: relevance score plus tie-breaker"""
+    return base64.urlsafe_b64encode(json.dumps([score, key]).encode()).decode()
+
+def decode_search_cursor(cursor):
+    try:
+        score, key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(score), int(key)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@app.get("/search", response_model=List[SearchResult])
+def search_emails(
+    response: Response,
+    q: str = Query(..., min_length=1, max_length=500),
+    mode: str = Query('all'),
+    limit: int = Query(20, ge=1, le=200),
+    cursor: Optional[str] = None,
+    session_id: Optional[str] = None,
+    sender: Optional[str] = None,
+    role: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    fields: Optional[str] = None,
+):
+    """
+    Full-text search over subject and message, best match first, with a
+    relevance score per email. mode is 'all' (every word, prefix match),
+    'any' (natural language) or 'boolean' (MySQL boolean syntax). Paginated
+    like /emails/ through the X-Next-Cursor header.
+    """
+    logger = logging.getLogger(__name__)
+    try:
+        if mode not in SEARCH_MODES:
+            raise HTTPException(status_code=400, detail=f"mode must be one of: {', '.join(SEARCH_MODES)}")
+        selected = parse_fields(fields)
+        after = decode_search_cursor(cursor) if cursor else None
+        query = build_search_query(q, mode, selected, session_id=session_id, sender=sender, role=role,
+                                   since=since, until=until, after=after, limit=limit + 1)
+        if query is None:
+            raise HTTPException(status_code=400, detail="Search query has no words")
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute(*query)
+            rows = c.fetchall()
+        
+        headers = {}
+        if len(rows) > limit:
+            rows = rows[:limit]
+            headers['X-Next-Cursor'] = encode_search_cursor(*rows[-1][-2:])
+        results = []
+        for row in rows:
+            result = row_to_dict(row[:-2], selected)
+            result['score'] = row[-2]
+            results.append(result)
+        logger.info(f"Search for {q!r} returned {len(results)} emails")
+        
+        if fields:
+            return JSONResponse(content=results, headers=headers)
+        response.headers.update(headers)
+        return [SearchResult(**result) for result in results]
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error searching emails: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error searching emails: {str(e)}")
+
+def order_by_reply_chain(emails):
+    """
+    Order a conversation by its In-Reply-To chain: each email is followed by
+    its replies, and siblings (and unlinked emails) keep chronological order.
+    """
+    known = {email['message_id'] for email in emails}
+    replies = {}
+    roots = []
+    for email in emails:
+        parent = email['in_reply_to']
+        if parent in known and parent != email['message_id']:
+            replies.setdefault(parent, []).append(email)
+        else:
+            roots.append(email)
+
+    ordered = []
+    visited = set()
+    stack = list(reversed(roots))
+    while stack:
+        email = stack.pop()
+        if email['message_id'] in visited:
+            continue
+        visited.add(email['message_id'])
+        ordered.append(email)
+        stack.extend(reversed(replies.get(email['message_id'], [])))
+    # Anything only reachable through a reply cycle is appended as-is
+    ordered.extend(email for email in emails if email['message_id'] not in visited)
+    return ordered
+
+def row_to_session(row):
+    session = dict(zip(SESSION_COLUMNS, row))
+    session['first_at'] = format_received_at(session['first_at'])
+    session['last_at'] = format_received_at(session['last_at'])
+    return session
+
+@app.get("/sessions/", response_model=List[Session])
+def get_sessions(
+    response: Response,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    sender: Optional[str] = None,
+    last_role: Optional[str] = None,
+):
+    """
+    Return conversations, most recently active first, with message counts.
+    Paginated like /emails/ through the X-Next-Cursor header.
+    """
+    logger = logging.getLogger(__name__)
+    try:
+        after = decode_cursor(cursor) if cursor else None
+        sql, params = build_sessions_query(sender=sender, last_role=last_role, after=after, limit=limit + 1)
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute(sql, params)
+            rows = c.fetchall()
+        
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = dict(zip(SESSION_COLUMNS, rows[-1]))
+            response.headers['X-Next-Cursor'] = encode_cursor(last['last_at'], last['session_id'])
+        
+        return [Session(**row_to_session(row)) for row in rows]
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error fetching sessions: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error fetching sessions: {str(e)}")
+
+@app.get("/sessions/{session_id}", response_model=SessionDetail)
+def get_session_detail(session_id: str):
+    """Return one conversation with its emails in reply-chain order"""
+    logger = logging.getLogger(__name__)
+    try:
+        result = get_session(session_id)
+        if result is None:
+            raise HTTPException(status_code=404, detail=f"Session {session_id} not found")
+        summary, rows = result
+        
+        emails = order_by_reply_chain([row_to_dict(row, list(EMAIL_COLUMNS)) for row in rows])
+        return SessionDetail(session=Session(**row_to_session(summary)),
+                             emails=[Email(**email) for email in emails])
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error fetching session {session_id}: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error fetching session: {str(e)}")
+
 @app.get("/logs/")
-def get_logs():
+def get_logs(lines: int = Query(100, ge=1, le=10000)):
     """Endpoint to retrieve the most recent log entries"""
     try:
-        log_file = "email_service.log"
-        if not os.path.exists(log_file):
+        if not os.path.exists(LOG_FILE):
             return {"error": "Log file not found"}
             
-        # Read the last 100 lines of the log file
-        with open(log_file, 'r') as f:
-            # Read all lines and get the last 100
-            lines = f.readlines()
-            last_lines = lines[-100:] if len(lines) > 100 else lines
-            
-        return {"logs": last_lines}
+        # Reads the file backwards, so cost depends on lines, not file size
+        return {"logs": read_log_tail(LOG_FILE, lines)}
     except Exception as e:
         return {"error": f"Error retrieving logs: {str(e)}"}
 
+@app.get("/logs/follow")
+async def follow_logs(request: Request, lines: int = Query(0, ge=0, le=10000)):
+    """
+    Server-Sent Events stream of log lines as they are written. Optionally
+    starts with the last `lines` lines; survives log rotation.
+    """
+    async def events():
+        if lines and os.path.exists(LOG_FILE):
+            for line in await run_in_threadpool(read_log_tail, LOG_FILE, lines):
+                yield f"data: {line.rstrip()}\n\n"
+        async for line in follow_log(LOG_FILE, is_disconnected=request.is_disconnected):
+            yield f"data: {line.rstrip()}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+def collect_snapshots():
+    """This process's metrics plus the latest snapshot of every live worker"""
+    logger = logging.getLogger(__name__)
+    snapshots = [({'worker': API_WORKER_ID}, metrics.snapshot())]
+    try:
+        for worker_id, snapshot in get_metrics_snapshots(metrics.METRICS_STALE_SECONDS):
+            snapshots.append(({'worker': worker_id}, json.loads(snapshot)))
+    except Exception as e:
+        # Still serve the API's own metrics when the database is unavailable
+        logger.error(f"Error reading worker metrics: {str(e)}", exc_info=True)
+    return snapshots
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Prometheus text exposition of the API and all workers, labelled by worker"""
+    return PlainTextResponse(metrics.render_prometheus(collect_snapshots()),
+                             media_type="text/plain; version=0.0.4")
+
+@app.get("/metrics/traces")
+def get_traces(limit: int = Query(50, ge=1, le=1000), outcome: Optional[str] = None):
+    """Most recent per-email traces (stage timings) across workers, newest first"""
+    traces = []
+    for labels, snapshot in collect_snapshots():
+        for trace in snapshot.get('traces', []):
+            if outcome is None or trace['outcome'] == outcome:
+                traces.append({**trace, 'worker': labels['worker']})
+    traces.sort(key=lambda trace: trace['started_at'], reverse=True)
+    return {"traces": traces[:limit]}
+
+# Serve /emails/ and /logs/ from the non-blocking implementation when configured
+if API_DB_DRIVER == 'aiomysql':
+    from api_async import router as async_router
+    # Routes match in registration order, so drop the blocking versions first
+    async_paths = {route.path for route in async_router.routes}
+    app.router.routes = [route for route in app.router.routes if getattr(route, 'path', None) not in async_paths]
+    app.include_router(async_router)
+
 # Run the server with: uvicorn api:app --reload 
 
 
@@ -0,0 +1,101 @@
+"""
+Non-blocking variants of the /emails/ and /logs/ endpoints, enabled with
+API_DB_DRIVER=aiomysql. They return the same response models as the
+blocking versions in api.py but run on the event loop, so one worker
+process can serve many concurrent clients.
+"""
+
+import logging
+import os
+from datetime import datetime
+from typing import List, Optional
+
+import aiomysql
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from starlette.concurrency import run_in_threadpool
+
+from database import DB_CONFIG, build_emails_query
+# Imported by api.py once its models and helpers are defined
+from api import Email, LOG_FILE, decode_cursor, emails_page, parse_fields
+from log_tail import read_log_tail
+
+logger = logging.getLogger(__name__)
+
+# Async pool bounds; connections idle longer than DB_POOL_RECYCLE seconds are reopened
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '3600'))
+
+router = APIRouter()
+
+
+async def open_pool(app):
+    """Create the aiomysql pool on application startup"""
+    app.state.db_pool = await aiomysql.create_pool(
+        host=DB_CONFIG['host'],
+        user=DB_CONFIG['user'],
+        password=DB_CONFIG['password'],
+        db=DB_CONFIG['database'],
+        minsize=DB_POOL_MIN_SIZE,
+        maxsize=DB_POOL_SIZE,
+        pool_recycle=DB_POOL_RECYCLE,
+        autocommit=True,
+    )
+    logger.info(f"Created aiomysql connection pool with up to {DB_POOL_SIZE} connections")
+
+
+async def close_pool(app):
+    """Close the aiomysql pool on application shutdown"""
+    pool = getattr(app.state, 'db_pool', None)
+    if pool is not None:
+        pool.close()
+        await pool.wait_closed()
+
+
+@router.get("/emails/", response_model=List[Email])
+async def get_emails(
+    request: Request,
+    response: Response,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    session_id: Optional[str] = None,
+    sender: Optional[str] = None,
+    role: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    fields: Optional[str] = None,
+):
+    """Async version of api.get_emails with identical parameters and response"""
+    try:
+        selected = parse_fields(fields)
+        after = decode_cursor(cursor) if cursor else None
+
+        logger.info("Attempting to fetch emails from database")
+
+        sql, params = build_emails_query(selected, session_id=session_id, sender=sender, role=role,
+                                         since=since, until=until, after=after, limit=limit + 1)
+        async with request.app.state.db_pool.acquire() as conn:
+            async with conn.cursor() as c:
+                await c.execute(sql, params)
+                db_emails = await c.fetchall()
+
+        logger.info(f"Retrieved {len(db_emails)} emails from database")
+        return emails_page(db_emails, selected, limit, fields, response)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error fetching emails: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error fetching emails: {str(e)}")
+
+
+@router.get("/logs/")
+async def get_logs(lines: int = Query(100, ge=1, le=10000)):
+    """Async version of api.get_logs; file I/O runs off the event loop"""
+    try:
+        if not os.path.exists(LOG_FILE):
+            return {"error": "Log file not found"}
+
+        return {"logs": await run_in_threadpool(read_log_tail, LOG_FILE, lines)}
+    except Exception as e:
+        return {"error": f"Error retrieving logs: {str(e)}"}
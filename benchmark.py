@@ -0,0 +1,682 @@
+"""
+Reproducible benchmarks of the email pipeline against local stand-ins.
+
+    python benchmark.py [pipeline] [database] [api] [--messages 1000] [--seed 1]
+                        [--llm-ttft 0.05] [--llm-tokens-per-second 200] [--llm-parallel 4]
+                        [--output results.json] [--baseline results.json] [--tolerance 0.2]
+
+Everything except MySQL runs in this process:
+
+- a synthetic mailbox of --messages emails (1k to 1M), generated on demand
+  from --seed, with conversations, HTML-only emails, attachments and a few
+  very long bodies
+- a minimal IMAP server serving it over a local socket (CAPABILITY, LOGIN,
+  SELECT, NOOP, UID SEARCH, UID FETCH of BODYSTRUCTURE/HEADER/partial
+  sections, UID STORE); SEARCH honours the UID range and the
+  Processed-By-System keyword but not FROM
+- a minimal SMTP server that accepts every message
+- a stub of Ollama's streaming /api/generate with configurable time to
+  first token, token rate and parallelism
+
+MySQL is a real server (DB_HOST, DB_USER, DB_PASSWORD) with a throwaway
+database, BENCH_DB_NAME or --db-name (default email_benchmark), which is
+dropped and recreated on every run unless --keep-db is given.
+
+Scenarios:
+
+pipeline  read_emails over the whole mailbox: IMAP fetch, claim, save,
+          generate, send and flag. Per-email stages come from the traces in
+          metrics.py (exact); per-batch IMAP stages and the model server's
+          time to first token from their histograms (approximate).
+database  save_email and get_conversation_id, one email at a time
+api       bulk load with save_emails_bulk, then /emails/ (first page, deep
+          pagination, sender filter), /search and unchanged
+          /emails/changes polls (304) through the ASGI app
+
+Each scenario reports its throughput and p50/p99 latency per stage. With
+--output the results are written as JSON; with --baseline they are
+compared to an earlier run and the exit status is 1 when throughput
+dropped or a p99 latency grew by more than --tolerance.
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import re
+import socketserver
+import sys
+import threading
+import time
+from email.message import EmailMessage
+from email.parser import BytesParser
+from email.policy import SMTP, compat32
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+SCENARIOS = ('pipeline', 'database', 'api')
+UIDVALIDITY = 1
+SUPPORT_ADDRESS = 'support@bench.invalid'
+
+WORDS = ("account order refund payment card declined delivery delayed password reset login error "
+         "invoice charge subscription cancel upgrade transfer balance statement address update phone "
+         "verification code expired app crash screen blank support ticket urgent please help thanks "
+         "yesterday today week month number missing wrong twice receipt shipping tracking package").split()
+
+
+def percentile(samples, q):
+    """Nearest-rank percentile of a sorted list"""
+    if not samples:
+        return None
+    return samples[max(0, math.ceil(q * len(samples)) - 1)]
+
+
+def summarize(samples):
+    """count, mean, p50 and p99 in milliseconds of a list of durations in seconds"""
+    samples = sorted(samples)
+    if not samples:
+        return {'count': 0}
+    return {
+        'count': len(samples),
+        'mean_ms': round(sum(samples) / len(samples) * 1000, 3),
+        'p50_ms': round(percentile(samples, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 3),
+    }
+
+
+def histogram_quantile(buckets, counts, q):
+    """Estimate a quantile from per-bucket counts by interpolating within the bucket, like Prometheus"""
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    cumulative = 0
+    lower = 0.0
+    for bound, count in zip(list(buckets) + [None], counts):
+        if count and cumulative + count >= rank:
+            if bound is None:
+                return buckets[-1]
+            return lower + (bound - lower) * (rank - cumulative) / count
+        cumulative += count
+        if bound is not None:
+            lower = bound
+    return buckets[-1]
+
+
+def summarize_histogram(metric, **labels):
+    """summarize() for one series of a metrics.snapshot() histogram (quantiles are estimates)"""
+    for series_labels, value in metric['series']:
+        if all(series_labels.get(name) == str(expected) for name, expected in labels.items()):
+            count = sum(value['counts'])
+            if not count:
+                break
+            return {
+                'count': count,
+                'mean_ms': round(value['sum'] / count * 1000, 3),
+                'p50_ms': round(histogram_quantile(metric['buckets'], value['counts'], 0.5) * 1000, 3),
+                'p99_ms': round(histogram_quantile(metric['buckets'], value['counts'], 0.99) * 1000, 3),
+                'approximate': True,
+            }
+    return {'count': 0}
+
+
+class SyntheticMailbox:
+    """
+    A deterministic mailbox of count emails, UIDs 1..count. Every email is
+    derived from (seed, uid) alone, so any one can be produced on demand and
+    two runs with the same seed see the same mail.
+    """
+
+    def __init__(self, count, seed=1, domain='bench.invalid'):
+        self.count = count
+        self.seed = seed
+        self.domain = domain
+        self.senders = max(1, count // 5)
+
+    def _random(self, uid):
+        return random.Random(self.seed * 1000003 + uid)
+
+    def message_id(self, uid):
+        return f"<{self.seed}.{uid}@{self.domain}>"
+
+    def _thread_root(self, uid):
+        # About a third of the emails reply to one of the 50 before them
+        parent = None
+        rng = self._random(uid)
+        if uid > 1 and rng.random() < 0.3:
+            parent = uid - rng.randint(1, min(50, uid - 1))
+        root = uid if parent is None else parent
+        for _ in range(20):
+            rng = self._random(root)
+            if root == 1 or rng.random() >= 0.3:
+                break
+            root -= rng.randint(1, min(50, root - 1))
+        return parent, root
+
+    def fields(self, uid):
+        """The email as save_email arguments: sender_email, message_id, in_reply_to, subject, message"""
+        parent, root = self._thread_root(uid)
+        root_rng = self._random(root)
+        root_rng.random()
+        customer = root_rng.randrange(self.senders)
+        sender = f"Customer {customer} <customer{customer}@example.com>"
+        topic = ' '.join(root_rng.choice(WORDS) for _ in range(root_rng.randint(2, 6)))
+        rng = self._random(uid)
+        rng.random()
+        # Mostly short emails, a few long ones (still within the TEXT column)
+        words = rng.randint(4_000, 8_000) if rng.random() < 0.01 else int(rng.expovariate(1 / 80)) + 5
+        sentences = []
+        while words > 0:
+            length = min(words, rng.randint(5, 15))
+            sentences.append(' '.join(rng.choice(WORDS) for _ in range(length)).capitalize() + '.')
+            words -= length
+        return {
+            'sender_email': sender,
+            'message_id': self.message_id(uid),
+            'in_reply_to': self.message_id(parent) if parent else None,
+            'subject': f"Re: {topic}" if parent else topic.capitalize(),
+            'message': '\n'.join(' '.join(sentences[i:i + 5]) for i in range(0, len(sentences), 5)),
+        }
+
+    @lru_cache(maxsize=4096)
+    def message(self, uid):
+        """The email as sent over IMAP, re-parsed so payloads are in their transfer encoding"""
+        fields = self.fields(uid)
+        # Drawn independently of the threading decisions made from _random(uid)
+        kind = random.Random(f"{self.seed}:{uid}:format").random()
+        msg = EmailMessage()
+        msg['From'] = fields['sender_email']
+        msg['To'] = SUPPORT_ADDRESS
+        msg['Subject'] = fields['subject']
+        msg['Message-ID'] = fields['message_id']
+        if fields['in_reply_to']:
+            msg['In-Reply-To'] = fields['in_reply_to']
+        msg['Date'] = 'Mon, 06 Jan 2025 10:00:00 +0000'
+        if kind < 0.1:
+            # HTML-only mail
+            paragraphs = ''.join(f"<p>{line}</p>" for line in fields['message'].split('\n'))
+            msg.set_content(f"<html><body>{paragraphs}</body></html>", subtype='html')
+        else:
+            msg.set_content(fields['message'])
+            if kind < 0.25:
+                msg.add_alternative(f"<html><body><p>{fields['message']}</p></body></html>", subtype='html')
+            if 0.2 < kind < 0.3:
+                msg.add_attachment(random.Random(uid).randbytes(20_000),
+                                   maintype='application', subtype='pdf', filename='statement.pdf')
+        raw = msg.as_bytes(policy=SMTP)
+        return raw, BytesParser(policy=compat32).parsebytes(raw)
+
+
+def _quote(value):
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _bodystructure(part):
+    if part.is_multipart():
+        children = ''.join(_bodystructure(child) for child in part.get_payload())
+        return f"({children} {_quote(part.get_content_subtype().upper())})"
+    payload = part.get_payload().encode('ascii', errors='replace')
+    params = ' '.join(f"{_quote(name.upper())} {_quote(value)}" for name, value in part.get_params()[1:]) or None
+    fields = [_quote(part.get_content_maintype().upper()), _quote(part.get_content_subtype().upper()),
+              f"({params})" if params else 'NIL', 'NIL', 'NIL',
+              _quote((part['Content-Transfer-Encoding'] or '7bit').upper()), str(len(payload))]
+    if part.get_content_maintype() == 'text':
+        fields.append(str(payload.count(b'\n')))
+    # MD5, then the disposition, e.g. ("ATTACHMENT" ("FILENAME" "statement.pdf"))
+    fields.append('NIL')
+    disposition = part.get_content_disposition()
+    if disposition:
+        filename = part.get_filename()
+        parameters = f"({_quote('FILENAME')} {_quote(filename)})" if filename else 'NIL'
+        fields.append(f"({_quote(disposition.upper())} {parameters})")
+    else:
+        fields.append('NIL')
+    return f"({' '.join(fields)})"
+
+
+def _section(message, number):
+    part = message
+    for index in number.split('.'):
+        if part.is_multipart():
+            part = part.get_payload()[int(index) - 1]
+    return part.get_payload().encode('ascii', errors='replace')
+
+
+def _uids(sequence_set, count):
+    uids = []
+    for item in sequence_set.split(','):
+        start, _, end = item.partition(':')
+        start = count if start == '*' else int(start)
+        end = start if not end else count if end == '*' else int(end)
+        uids.extend(range(min(start, end), min(max(start, end), count) + 1))
+    return uids
+
+
+class ImapHandler(socketserver.StreamRequestHandler):
+    """One IMAP client connection to the server's mailbox"""
+
+    def send(self, line):
+        self.wfile.write(line if isinstance(line, bytes) else line.encode() + b'\r\n')
+
+    def handle(self):
+        mailbox = self.server.mailbox
+        self.send("* OK [CAPABILITY IMAP4rev1 IDLE] benchmark IMAP ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, _, rest = line.decode().rstrip('\r\n').partition(' ')
+            command, _, args = rest.partition(' ')
+            command = command.upper()
+            if command == 'UID':
+                command, _, args = args.partition(' ')
+                command = 'UID ' + command.upper()
+            if command == 'CAPABILITY':
+                self.send("* CAPABILITY IMAP4rev1 IDLE")
+            elif command == 'SELECT':
+                self.send(f"* {mailbox.count} EXISTS")
+                self.send(f"* OK [UIDVALIDITY {UIDVALIDITY}] UIDs valid")
+            elif command == 'LOGOUT':
+                self.send("* BYE")
+                self.send(f"{tag} OK LOGOUT completed")
+                return
+            elif command == 'UID SEARCH':
+                match = re.search(r'UID (\d+):\*', args)
+                first = int(match.group(1)) if match else 1
+                with self.server.lock:
+                    flagged = set(self.server.flagged)
+                uids = [str(uid) for uid in range(first, mailbox.count + 1) if uid not in flagged]
+                self.send("* SEARCH " + ' '.join(uids))
+            elif command == 'UID FETCH':
+                sequence_set, _, items = args.partition(' ')
+                self.fetch(_uids(sequence_set, mailbox.count), items.upper())
+            elif command == 'UID STORE':
+                sequence_set, _, flags = args.partition(' ')
+                if 'PROCESSED-BY-SYSTEM' in flags.upper():
+                    with self.server.lock:
+                        self.server.flagged.update(_uids(sequence_set, mailbox.count))
+            elif command not in ('LOGIN', 'NOOP'):
+                self.send(f"{tag} BAD unsupported command {command}")
+                continue
+            self.send(f"{tag} OK {command} completed")
+
+    def fetch(self, uids, items):
+        partial = re.search(r'BODY\.PEEK\[([\d.]*)\]<0\.(\d+)>', items)
+        for uid in uids:
+            raw, message = self.server.mailbox.message(uid)
+            response = f"* {uid} FETCH (UID {uid}"
+            if 'BODYSTRUCTURE' in items:
+                response += f" BODYSTRUCTURE {_bodystructure(message)}"
+            if 'BODY.PEEK[HEADER]' in items:
+                key, literal = 'BODY[HEADER]', raw[:raw.index(b'\r\n\r\n') + 4]
+            elif partial:
+                key, literal = f"BODY[{partial.group(1)}]<0>", _section(message, partial.group(1))[:int(partial.group(2))]
+            elif 'BODY.PEEK[]' in items:
+                key, literal = 'BODY[]', raw
+            else:
+                self.send(response + ")")
+                continue
+            self.send(f"{response} {key} {{{len(literal)}}}\r\n".encode() + literal + b")\r\n")
+
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    """Accepts any sender, recipient and message"""
+
+    def send(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.send("220 benchmark ESMTP ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].decode(errors='replace').upper()
+            if command == 'EHLO':
+                self.send("250-benchmark\r\n250-AUTH PLAIN LOGIN\r\n250-8BITMIME\r\n250 SMTPUTF8")
+            elif command == 'AUTH':
+                self.send("235 authenticated")
+            elif command == 'DATA':
+                self.send("354 end with .")
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                with self.server.lock:
+                    self.server.delivered += 1
+                self.send("250 queued")
+            elif command == 'QUIT':
+                self.send("221 bye")
+                return
+            else:
+                self.send("250 OK")
+
+
+class OllamaHandler(BaseHTTPRequestHandler):
+    """Streams /api/generate responses; at most `parallel` requests generate at once, like Ollama"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        server = self.server
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        rng = random.Random(len(request.get('prompt', '')))
+        with server.slots:
+            started = time.monotonic()
+            time.sleep(server.ttft)
+            for index in range(server.reply_words):
+                word = rng.choice(WORDS)
+                token = (word.capitalize() if index % 12 == 0 else ' ' + word) + ('.' if index % 12 == 11 else '')
+                self.chunk(json.dumps({'response': token, 'done': False}).encode() + b'\n')
+                time.sleep(1 / server.tokens_per_second)
+            self.chunk(json.dumps({'response': '.', 'done': True, 'context': [1, 2, 3],
+                                   'eval_count': server.reply_words,
+                                   'eval_duration': int((time.monotonic() - started) * 1e9)}).encode() + b'\n')
+        self.chunk(b'')
+
+
+def serve(server):
+    server.daemon_threads = True
+    server.server_port = server.server_address[1]
+    # Clients drop connections mid-response (llm.py stops reading at 'done'); not worth a traceback
+    server.handle_error = lambda request, client_address: logger.debug(
+        f"{server.RequestHandlerClass.__name__} connection from {client_address} failed", exc_info=True)
+    threading.Thread(target=server.serve_forever, name=server.RequestHandlerClass.__name__,
+                     daemon=True).start()
+    return server
+
+
+def start_imap(mailbox):
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), ImapHandler)
+    server.mailbox = mailbox
+    server.flagged = set()
+    server.lock = threading.Lock()
+    return serve(server)
+
+
+def start_smtp():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SmtpHandler)
+    server.delivered = 0
+    server.lock = threading.Lock()
+    return serve(server)
+
+
+def start_ollama(ttft, tokens_per_second, parallel, reply_words):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), OllamaHandler)
+    server.ttft = ttft
+    server.tokens_per_second = tokens_per_second
+    server.slots = threading.Semaphore(parallel)
+    server.reply_words = reply_words
+    return serve(server)
+
+
+def prepare_environment(args, ollama):
+    """Point the service's configuration at the stand-ins; must run before the service modules are imported"""
+    if not re.fullmatch(r'\w+', args.db_name):
+        sys.exit(f"Invalid benchmark database name: {args.db_name}")
+    if args.db_name == os.getenv('DB_NAME'):
+        sys.exit(f"Refusing to benchmark against DB_NAME={args.db_name}; use a separate --db-name")
+    if not args.keep_db:
+        import mysql.connector
+        conn = mysql.connector.connect(host=os.getenv('DB_HOST'), user=os.getenv('DB_USER'),
+                                       password=os.getenv('DB_PASSWORD'))
+        conn.cursor().execute(f"DROP DATABASE IF EXISTS {args.db_name}")
+        conn.close()
+    os.environ.update({
+        'DB_NAME': args.db_name,
+        'EMAIL': SUPPORT_ADDRESS,
+        'PASSWORD': 'benchmark',
+        'IMAP_SERVER': '127.0.0.1',
+        'IMAP_PORT': '0',
+        'SMTP_SERVER': '127.0.0.1',
+        'SMTP_PORT': '0',
+        'OLLAMA_URL': f"http://127.0.0.1:{ollama.server_port}/api/generate",
+        # Keep every email's trace for the per-stage percentiles
+        'METRICS_TRACE_BUFFER': str(min(args.messages, 100_000)),
+        'EMAIL_WRITE_INTERVAL': os.getenv('EMAIL_WRITE_INTERVAL', '0.2'),
+    })
+    from database import ensure_schema
+    ensure_schema(force=True)
+
+
+def run_pipeline(args):
+    import main
+    import metrics
+    from mail_client import ImapSession, SmtpSession
+    from pipeline import EmailPipeline
+
+    mailbox = SyntheticMailbox(args.messages, args.seed, domain='pipeline.bench.invalid')
+    imap = start_imap(mailbox)
+    smtp = start_smtp()
+
+    def connect_smtp():
+        smtp_session = SmtpSession('127.0.0.1', smtp.server_port, SUPPORT_ADDRESS, 'benchmark', starttls=False)
+        smtp_session.connect()
+        return smtp_session
+
+    imap_session = ImapSession('127.0.0.1', SUPPORT_ADDRESS, 'benchmark', port=imap.server_port, use_ssl=False)
+    imap_session.connect()
+    pipeline = EmailPipeline(generate=main.generate_stage, send=main.send_stage, connect_smtp=connect_smtp,
+                             generation_workers=main.GENERATION_WORKERS, smtp_workers=main.SMTP_WORKERS,
+                             max_pending=main.PIPELINE_MAX_PENDING)
+    started = time.monotonic()
+    try:
+        main.read_emails(imap_session, pipeline)
+    finally:
+        pipeline.close()
+        imap_session.close()
+    elapsed = time.monotonic() - started
+
+    snapshot = metrics.snapshot()
+    traces = snapshot['traces']
+    samples = {}
+    for trace in traces:
+        if trace['outcome'] == 'replied':
+            samples.setdefault('email_total', []).append(trace['duration_ms'] / 1000)
+        for span in trace['spans']:
+            samples.setdefault(span['name'], []).append(span['duration_ms'] / 1000)
+    stages = {name: summarize(values) for name, values in samples.items()}
+    for stage in ('imap_search', 'imap_fetch', 'imap_flag'):
+        stages[stage] = summarize_histogram(snapshot['metrics']['email_stage_seconds'], stage=stage)
+    ttft = snapshot['metrics']['email_llm_ttft_seconds']
+    ttft_series = [labels for labels, _ in ttft['series']]
+    stages['llm_ttft'] = summarize_histogram(ttft, **ttft_series[0]) if ttft_series else {'count': 0}
+
+    replied = sum(1 for trace in traces if trace['outcome'] == 'replied')
+    return {
+        'throughput': round(replied / elapsed, 2),
+        'unit': 'emails/s',
+        'processed': replied,
+        'sent': smtp.delivered,
+        'flagged': len(imap.flagged),
+        'seconds': round(elapsed, 2),
+        'stages': stages,
+    }
+
+
+def run_database(args):
+    from database import get_connection, get_conversation_id, save_email
+
+    mailbox = SyntheticMailbox(args.messages, args.seed, domain='database.bench.invalid')
+    save_samples = []
+    started = time.monotonic()
+    for uid in range(1, args.messages + 1):
+        fields = mailbox.fields(uid)
+        begun = time.perf_counter()
+        save_email(fields['sender_email'], fields['message_id'], fields['in_reply_to'],
+                   fields['subject'], fields['message'], 'user')
+        save_samples.append(time.perf_counter() - begun)
+    elapsed = time.monotonic() - started
+
+    lookup_samples = []
+    rng = random.Random(args.seed)
+    with get_connection() as conn:
+        c = conn.cursor()
+        for _ in range(min(args.messages, 10_000)):
+            fields = mailbox.fields(rng.randint(1, args.messages))
+            begun = time.perf_counter()
+            get_conversation_id(c, fields['sender_email'], fields['subject'], fields['in_reply_to'])
+            lookup_samples.append(time.perf_counter() - begun)
+
+    return {
+        'throughput': round(args.messages / elapsed, 2),
+        'unit': 'emails/s',
+        'seconds': round(elapsed, 2),
+        'stages': {'save_email': summarize(save_samples), 'get_conversation_id': summarize(lookup_samples)},
+    }
+
+
+def run_api(args):
+    from fastapi.testclient import TestClient
+
+    import api
+    from database import save_emails_bulk
+
+    mailbox = SyntheticMailbox(args.messages, args.seed, domain='api.bench.invalid')
+    load_samples = []
+    started = time.monotonic()
+    for first in range(1, args.messages + 1, 1000):
+        rows = [dict(mailbox.fields(uid), role='user') for uid in range(first, min(first + 1000, args.messages + 1))]
+        begun = time.perf_counter()
+        save_emails_bulk(rows)
+        load_samples.append(time.perf_counter() - begun)
+    load_seconds = time.monotonic() - started
+
+    client = TestClient(api.app)
+    rng = random.Random(args.seed)
+    samples = {'emails_first_page': [], 'emails_next_page': [], 'emails_by_sender': [], 'search': [],
+               'changes_unchanged': []}
+
+    def timed(stage, url, headers=None, status=200, **params):
+        begun = time.perf_counter()
+        response = client.get(url, params=params, headers=headers)
+        samples[stage].append(time.perf_counter() - begun)
+        if response.status_code != status:
+            raise RuntimeError(f"GET {url} returned {response.status_code}: {response.text[:200]}")
+        return response
+
+    # Follow the change feed to its end, then poll it unchanged like an idle dashboard
+    changes = client.get('/emails/changes', params={'limit': 5000})
+    while changes.json()['more']:
+        changes = client.get('/emails/changes', params={'since': changes.json()['cursor'], 'limit': 5000})
+    tip = changes.json()['cursor']
+    etag = client.get('/emails/changes', params={'since': tip}).headers['ETag']
+
+    started = time.monotonic()
+    cursor = None
+    for _ in range(args.api_requests):
+        timed('emails_first_page', '/emails/', limit=100)
+        params = {'limit': 100, 'cursor': cursor} if cursor else {'limit': 100}
+        cursor = timed('emails_next_page', '/emails/', **params).headers.get('X-Next-Cursor')
+        fields = mailbox.fields(rng.randint(1, args.messages))
+        timed('emails_by_sender', '/emails/', sender=fields['sender_email'], limit=100)
+        timed('search', '/search', q=' '.join(rng.sample(WORDS, 2)), limit=20)
+        timed('changes_unchanged', '/emails/changes', headers={'If-None-Match': etag}, status=304, since=tip)
+    elapsed = time.monotonic() - started
+
+    stages = {name: summarize(values) for name, values in samples.items()}
+    stages['bulk_load_1000'] = summarize(load_samples)
+    return {
+        'throughput': round(sum(len(values) for values in samples.values()) / elapsed, 2),
+        'unit': 'requests/s',
+        'load_throughput': round(args.messages / load_seconds, 2),
+        'seconds': round(elapsed, 2),
+        'stages': stages,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Regressions of results against baseline: throughput down or p99 up by more than tolerance"""
+    regressions = []
+    for scenario, result in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(scenario)
+        if not previous:
+            continue
+        if result['throughput'] < previous['throughput'] * (1 - tolerance):
+            regressions.append(f"{scenario}: throughput {previous['throughput']} -> {result['throughput']} {result['unit']}")
+        for stage, summary in result['stages'].items():
+            old = previous['stages'].get(stage, {}).get('p99_ms')
+            new = summary.get('p99_ms')
+            # Below a millisecond the p99 is mostly noise
+            if old is not None and new is not None and new > max(old * (1 + tolerance), old + 1):
+                regressions.append(f"{scenario}/{stage}: p99 {old} -> {new} ms")
+    return regressions
+
+
+def print_results(results):
+    for scenario, result in results['scenarios'].items():
+        print(f"\n{scenario}: {result['throughput']} {result['unit']} ({result['seconds']}s)")
+        print(f"  {'stage':<22}{'count':>9}{'p50 ms':>12}{'p99 ms':>12}{'mean ms':>12}")
+        for stage, summary in result['stages'].items():
+            if not summary['count']:
+                continue
+            mark = '~' if summary.get('approximate') else ' '
+            print(f"  {stage:<22}{summary['count']:>9}{summary['p50_ms']:>11.2f}{mark}"
+                  f"{summary['p99_ms']:>11.2f}{mark}{summary['mean_ms']:>12.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the email pipeline against local stand-ins")
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help=f"any of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument('--messages', type=int, default=1000, help="emails in the synthetic mailbox")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--llm-ttft', type=float, default=0.05, help="stub model server: seconds to first token")
+    parser.add_argument('--llm-tokens-per-second', type=float, default=200)
+    parser.add_argument('--llm-parallel', type=int, default=4, help="stub model server: requests generated at once")
+    parser.add_argument('--reply-words', type=int, default=60, help="stub model server: tokens per reply")
+    parser.add_argument('--api-requests', type=int, default=200, help="rounds of API requests")
+    parser.add_argument('--db-name', default=os.getenv('BENCH_DB_NAME', 'email_benchmark'))
+    parser.add_argument('--keep-db', action='store_true', help="do not drop the benchmark database first")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="compare against the results of an earlier run")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative regression")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+
+    # Configured before the service modules so their import-time logging setup is a no-op
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    ollama = start_ollama(args.llm_ttft, args.llm_tokens_per_second, args.llm_parallel, args.reply_words)
+    prepare_environment(args, ollama)
+
+    results = {'config': {name: value for name, value in vars(args).items()
+                          if name not in ('output', 'baseline', 'scenarios')},
+               'scenarios': {}}
+    runners = {'pipeline': run_pipeline, 'database': run_database, 'api': run_api}
+    for scenario in args.scenarios or SCENARIOS:
+        print(f"Running {scenario} with {args.messages} messages...", file=sys.stderr)
+        results['scenarios'][scenario] = runners[scenario](args)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        if regressions:
+            print("\nRegressions:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print("\nNo regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Helpers for the /emails/changes feed.
+
+The feed returns the emails stored after a cursor, which is the
+auto-increment id of the last email the client has seen. Each page is
+versioned by get_changes_version() (a short primary key range plus the
+session merge counter). Any email the worker saves into the page's window
+changes the version, and so do an email in it becoming settled (see
+below), since that can move the page's cursor, and a session merge, since
+that changes the session_id of the page's emails. That version is the
+page's ETag, so an unchanged poll is answered with 304 after a single index
+lookup, and it is also the key of an in-process LRU of serialized pages:
+a change moves the version on, so stale pages are never served again and
+simply age out. Emails before the cursor are not sent again after a merge.
+
+Auto-increment ids are handed out at insert but become visible at commit,
+so a lower id can appear after a higher one, and ids of rolled-back or
+duplicate inserts are never used. The cursor therefore only moves past a
+gap in the ids once the email after it was stored CHANGES_SETTLE_SECONDS
+ago. That age comes from created_at, set by the database clock at insert,
+not from received_at, which imports take from the Date header. The emails
+beyond a gap are still returned and returned again on the next poll, so
+clients should upsert them by id.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CHANGES_CACHE_SIZE = int(os.getenv('CHANGES_CACHE_SIZE', '256'))
+# How long a gap in the ids may belong to a transaction that has not committed yet;
+# keep it above the longest write, which can wait THREAD_LOCK_TIMEOUT for thread locks
+CHANGES_SETTLE_SECONDS = int(os.getenv('CHANGES_SETTLE_SECONDS', '60'))
+
+
+class ResponseCache:
+    """Thread-safe LRU of serialized responses by ETag"""
+
+    def __init__(self, max_size=CHANGES_CACHE_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = body
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+def make_etag(since, limit, fields, version):
+    """Strong ETag of a feed page: its parameters plus the window's version tuple"""
+    raw = f"{since}:{limit}:{','.join(fields)}:" + ':'.join(str(part) for part in version)
+    return '"' + hashlib.sha1(raw.encode()).hexdigest()[:20] + '"'
+
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header value covers etag"""
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+    return '*' in candidates or etag in [candidate.removeprefix('W/') for candidate in candidates]
+
+
+def next_cursor(since, rows):
+    """
+    Cursor after a page, from its (id, settled) pairs in id order: advance
+    over consecutive ids, and past a gap only if the email after it settled.
+    """
+    cursor = since
+    for email_id, settled in rows:
+        if email_id != cursor + 1 and not settled:
+            break
+        cursor = email_id
+    return cursor
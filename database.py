@@ -1,10 +1,17 @@
 import mysql.connector
+import mysql.connector.pooling
 import pytz
 from datetime import datetime
 import os
+import re
 from dotenv import load_dotenv
 import logging
-import re
+import threading
+import time
+from contextlib import contextmanager
+from metrics import timed_db
+from thread_index import (count_merges, extract_email_address, find_session, link_thread, locked_thread_keys,
+                          record_session_message, record_session_messages, thread_keys_for)
 
 # Load environment variables
 load_dotenv()
@@ -17,8 +24,265 @@ DB_CONFIG = {
     'database': os.getenv('DB_NAME')
 }
 
+# Whether ensure_schema() creates/migrates the schema; turn off where
+# migrations are run separately (python database.py)
+DB_SCHEMA_CHECK = os.getenv('DB_SCHEMA_CHECK', 'true').lower() in ('1', 'true', 'yes')
+
+# Connection pool settings (mysql-connector caps pool_size at 32)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+
 logger = logging.getLogger(__name__)
 
+_pool = None
+_pool_lock = threading.Lock()
+_schema_checked = False
+_schema_lock = threading.Lock()
+
+def get_pool():
+    """Return the shared connection pool, creating it on first use"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = mysql.connector.pooling.MySQLConnectionPool(
+                    pool_name="email_support",
+                    pool_size=DB_POOL_SIZE,
+                    pool_reset_session=True,
+                    **DB_CONFIG
+                )
+                logger.info(f"Created MySQL connection pool with {DB_POOL_SIZE} connections")
+    return _pool
+
+def _acquire_connection(timeout=DB_POOL_TIMEOUT):
+    """Borrow a connection, waiting up to timeout seconds if the pool is exhausted"""
+    pool = get_pool()
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            conn = pool.get_connection()
+            break
+        except mysql.connector.errors.PoolError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.05)
+
+    # Health check: connections can be dropped by the server while idle in the pool
+    if not conn.is_connected():
+        logger.info("Pooled MySQL connection was closed, reconnecting")
+        conn.reconnect(attempts=3, delay=1)
+    return conn
+
+@contextmanager
+def get_connection():
+    """
+    Context manager that borrows a pooled connection and returns it to the
+    pool afterwards, rolling back any uncommitted work on error.
+    """
+    conn = _acquire_connection()
+    try:
+        yield conn
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        raise
+    finally:
+        # close() on a pooled connection hands it back to the pool
+        conn.close()
+
+# Versioned schema migrations, applied in order by apply_migrations().
+# Each entry is (version, description, [statements]). Never edit a released
+# migration; append a new one instead.
+# SQL equivalent of thread_index.extract_email_address for a column
+SENDER_ADDRESS_SQL = "LOWER(TRIM(SUBSTRING_INDEX(SUBSTRING_INDEX({column}, '<', -1), '>', 1)))"
+
+MIGRATIONS = [
+    (1, "index emails lookups", [
+        # Remove duplicate rows left by older versions before enforcing uniqueness
+        '''DELETE e1 FROM emails e1
+           JOIN emails e2 ON e1.message_id = e2.message_id AND e1.id > e2.id''',
+        "ALTER TABLE emails ADD UNIQUE INDEX uq_emails_message_id (message_id)",
+        "ALTER TABLE emails ADD INDEX idx_emails_in_reply_to (in_reply_to)",
+        "ALTER TABLE emails ADD INDEX idx_emails_session_received (session_id, received_at)",
+        "ALTER TABLE emails ADD INDEX idx_emails_received (received_at, id)",
+        "ALTER TABLE emails ADD INDEX idx_emails_sender (sender_email)",
+        "ALTER TABLE emails ADD INDEX idx_emails_subject (subject(191))",
+    ]),
+    (2, "thread index and session aliases", [
+        # Union-find mapping of merged sessions to their root (see thread_index.py)
+        '''CREATE TABLE IF NOT EXISTS session_aliases
+           (session_id VARCHAR(255) PRIMARY KEY,
+            parent_id VARCHAR(255) NOT NULL,
+            INDEX idx_session_aliases_parent (parent_id))''',
+        # Latest session per normalized sender address / subject (SHA-1 of the key)
+        '''CREATE TABLE IF NOT EXISTS thread_keys
+           (key_type VARCHAR(10) NOT NULL,
+            key_hash CHAR(40) NOT NULL,
+            session_id VARCHAR(255) NOT NULL,
+            PRIMARY KEY (key_type, key_hash))''',
+        # Backfill from history; rows are visited oldest first so the newest session wins.
+        # Older versions already rewrote session_ids in place, so no aliases are needed.
+        '''INSERT INTO thread_keys (key_type, key_hash, session_id)
+           SELECT 'sender', SHA1(LOWER(TRIM(SUBSTRING_INDEX(SUBSTRING_INDEX(sender_email, '<', -1), '>', 1)))), session_id
+           FROM emails WHERE role = 'user' AND session_id IS NOT NULL ORDER BY id
+           ON DUPLICATE KEY UPDATE session_id = VALUES(session_id)''',
+        '''INSERT INTO thread_keys (key_type, key_hash, session_id)
+           SELECT 'subject', SHA1(LOWER(TRIM(REGEXP_REPLACE(subject, '^(re|fwd|fw):[[:space:]]*', '', 1, 1, 'i')))), session_id
+           FROM emails WHERE role = 'user' AND session_id IS NOT NULL
+             AND TRIM(REGEXP_REPLACE(subject, '^(re|fwd|fw):[[:space:]]*', '', 1, 1, 'i')) != ''
+           ORDER BY id
+           ON DUPLICATE KEY UPDATE session_id = VALUES(session_id)''',
+    ]),
+    (3, "session summaries", [
+        '''CREATE TABLE IF NOT EXISTS session_summaries
+           (session_id VARCHAR(255) PRIMARY KEY,
+            subject TEXT,
+            sender_email VARCHAR(255),
+            message_count INT NOT NULL DEFAULT 0,
+            first_at DATETIME,
+            last_at DATETIME,
+            last_role VARCHAR(10),
+            last_message_id VARCHAR(255),
+            INDEX idx_session_summaries_last (last_at, session_id))''',
+        # Backfill one row per canonical session from existing emails
+        '''INSERT IGNORE INTO session_summaries
+               (session_id, subject, sender_email, message_count, first_at, last_at, last_role, last_message_id)
+           SELECT canonical_id, first_subject, first_sender, message_count, first_at, last_at, role, message_id
+           FROM (
+               SELECT COALESCE(sa.parent_id, e.session_id) AS canonical_id, e.role, e.message_id,
+                      COUNT(*) OVER w AS message_count,
+                      MIN(e.received_at) OVER w AS first_at,
+                      MAX(e.received_at) OVER w AS last_at,
+                      FIRST_VALUE(e.subject) OVER (w ORDER BY e.received_at, e.id) AS first_subject,
+                      FIRST_VALUE(e.sender_email) OVER (w ORDER BY e.received_at, e.id) AS first_sender,
+                      ROW_NUMBER() OVER (w ORDER BY e.received_at DESC, e.id DESC) AS position
+               FROM emails e
+               LEFT JOIN session_aliases sa ON sa.session_id = e.session_id
+               WHERE e.session_id IS NOT NULL
+               WINDOW w AS (PARTITION BY COALESCE(sa.parent_id, e.session_id))
+           ) ranked
+           WHERE position = 1''',
+    ]),
+    (4, "reply cache", [
+        # Generated replies keyed by normalized subject/body (see reply_cache.py)
+        '''CREATE TABLE IF NOT EXISTS reply_cache
+           (cache_key CHAR(40) PRIMARY KEY,
+            session_id VARCHAR(255),
+            simhash BIGINT UNSIGNED NOT NULL,
+            reply TEXT NOT NULL,
+            created_at DATETIME NOT NULL,
+            INDEX idx_reply_cache_session (session_id, created_at),
+            INDEX idx_reply_cache_created (created_at))''',
+    ]),
+    (5, "email job queue", [
+        # Crash-safe processing state per inbound email (see job_queue.py)
+        '''CREATE TABLE IF NOT EXISTS email_jobs
+           (message_id VARCHAR(255) PRIMARY KEY,
+            mailbox VARCHAR(255) NOT NULL,
+            uidvalidity BIGINT,
+            uid BIGINT,
+            state VARCHAR(16) NOT NULL,
+            session_id VARCHAR(255),
+            reply TEXT,
+            reply_message_id VARCHAR(255),
+            attempts INT NOT NULL DEFAULT 0,
+            lease_owner VARCHAR(255),
+            lease_expires_at DATETIME,
+            last_error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            INDEX idx_email_jobs_mailbox (mailbox, uidvalidity, state, uid),
+            INDEX idx_email_jobs_lease (lease_owner, state))''',
+    ]),
+    (6, "full-text search on emails", [
+        # Used by /search; InnoDB builds the index in place
+        "ALTER TABLE emails ADD FULLTEXT INDEX ft_emails_subject_message (subject, message)",
+    ]),
+    (7, "worker metrics", [
+        # Latest metrics snapshot of each worker process, read by the API's /metrics
+        '''CREATE TABLE IF NOT EXISTS worker_metrics
+           (worker_id VARCHAR(255) PRIMARY KEY,
+            snapshot MEDIUMTEXT NOT NULL,
+            updated_at DATETIME NOT NULL,
+            INDEX idx_worker_metrics_updated (updated_at))''',
+    ]),
+    (8, "reply cache per sender", [
+        # Cached replies are only reused for the same sender; older entries were
+        # keyed without one and can never match again
+        "DELETE FROM reply_cache",
+        "ALTER TABLE reply_cache ADD COLUMN sender VARCHAR(255) AFTER session_id",
+        "ALTER TABLE reply_cache ADD INDEX idx_reply_cache_session_sender (session_id, sender, created_at)",
+        "ALTER TABLE reply_cache DROP INDEX idx_reply_cache_session",
+    ]),
+    (9, "emails stored at", [
+        # Set by the database clock at insert; received_at comes from the
+        # worker's clock or, for imports, from the Date header
+        "ALTER TABLE emails ADD COLUMN created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP",
+    ]),
+    (10, "session merge counter", [
+        # Number of session merges so far; part of the change feed version (see thread_index.py)
+        '''CREATE TABLE IF NOT EXISTS session_merge_counter
+           (id TINYINT PRIMARY KEY,
+            merges BIGINT UNSIGNED NOT NULL DEFAULT 0)''',
+        "INSERT IGNORE INTO session_merge_counter (id, merges) VALUES (1, 0)",
+    ]),
+    (11, "normalized sender address", [
+        # The sender filters match the bare address, as thread_index.extract_email_address
+        # returns it, while sender_email keeps the header as received ("Jane <jane@x.com>")
+        f"""ALTER TABLE emails
+            ADD COLUMN sender_address VARCHAR(255) AS ({SENDER_ADDRESS_SQL.format(column='sender_email')}) STORED,
+            ADD INDEX idx_emails_sender_address (sender_address, received_at, id)""",
+        f"""ALTER TABLE session_summaries
+            ADD COLUMN sender_address VARCHAR(255) AS ({SENDER_ADDRESS_SQL.format(column='sender_email')}) STORED,
+            ADD INDEX idx_session_summaries_sender_address (sender_address, last_at, session_id)""",
+    ]),
+]
+
+# MySQL error codes that mean a statement already took effect, so a
+# migration interrupted half-way can safely be re-run
+_ALREADY_APPLIED_ERRORS = {
+    1050,  # ER_TABLE_EXISTS_ERROR
+    1060,  # ER_DUP_FIELDNAME
+    1061,  # ER_DUP_KEYNAME
+    1091,  # ER_CANT_DROP_FIELD_OR_KEY
+}
+
+def apply_migrations(conn):
+    """Bring the schema up to the latest version, one migration at a time"""
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS schema_migrations
+                 (version INT PRIMARY KEY,
+                  description VARCHAR(255) NOT NULL,
+                  applied_at DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+
+    # Serialize concurrent workers starting up against the same database
+    c.execute("SELECT GET_LOCK('email_support_migrations', 60)")
+    if c.fetchone()[0] != 1:
+        raise RuntimeError("Timed out waiting for the schema migration lock")
+    try:
+        c.execute("SELECT version FROM schema_migrations")
+        applied = {row[0] for row in c.fetchall()}
+
+        for version, description, statements in MIGRATIONS:
+            if version in applied:
+                continue
+            print(f"Applying migration {version}: {description}")
+            for statement in statements:
+                try:
+                    c.execute(statement)
+                except mysql.connector.Error as e:
+                    if e.errno not in _ALREADY_APPLIED_ERRORS:
+                        raise
+                    logger.info(f"Migration {version}: skipping already applied statement ({e.msg})")
+            c.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                      (version, description))
+            conn.commit()
+    finally:
+        c.execute("SELECT RELEASE_LOCK('email_support_migrations')")
+        c.fetchone()
+
 def init_db():
     try:
         print("Initializing database")
@@ -47,19 +311,36 @@ def init_db():
                       role VARCHAR(10) NOT NULL,
                       received_at DATETIME DEFAULT CURRENT_TIMESTAMP)''')
         
+        # Per-mailbox IMAP checkpoint so each cycle only searches new UIDs
+        c.execute('''CREATE TABLE IF NOT EXISTS imap_checkpoints
+                     (mailbox VARCHAR(255) PRIMARY KEY,
+                      uidvalidity BIGINT NOT NULL,
+                      last_uid BIGINT NOT NULL,
+                      updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP)''')
+        
         conn.commit()
+        
+        # Upgrade existing deployments in place (indexes etc.)
+        apply_migrations(conn)
+        
         conn.close()
         print("Database initialized successfully")
     except Exception as e:
         print(f"Database initialization failed: {e}")
         raise
 
-def extract_email_address(email_string):
-    """Extract clean email address from a string like 'Name <email@example.com>'"""
-    match = re.search(r'<([^>]+)>', email_string)
-    if match:
-        return match.group(1).lower()
-    return email_string.strip().lower()
+def ensure_schema(force=False):
+    """
+    Run init_db() once per process, on the first call. Does nothing when
+    DB_SCHEMA_CHECK is off unless force is given.
+    """
+    global _schema_checked
+    if not (DB_SCHEMA_CHECK or force):
+        return
+    with _schema_lock:
+        if not _schema_checked:
+            init_db()
+            _schema_checked = True
 
 def get_conversation_id(c, sender_email, subject, in_reply_to=None):
     """
@@ -74,92 +355,431 @@ def get_conversation_id(c, sender_email, subject, in_reply_to=None):
         c.execute("SELECT session_id FROM emails WHERE message_id = %s", (in_reply_to,))
         result = c.fetchone()
         if result and result[0]:
-            logger.info(f"Found session_id {result[0]} from in_reply_to")
-            return result[0]
+            session_id = find_session(c, result[0])
+            logger.info(f"Found session_id {session_id} from in_reply_to")
+            return session_id
     
     # 2. For all other cases, create a new session_id
     # This ensures each new email starts a fresh conversation
     return None  # Returning None will cause a new session_id to be created
 
+@timed_db
 def save_email(sender_email, message_id, in_reply_to, subject, message, role='user'):
     try:
         logger.debug(f"Saving email from {sender_email} with Message-ID: {message_id}")
-        conn = mysql.connector.connect(**DB_CONFIG)
-        c = conn.cursor()
-        
-        # Generate a simple sender_id based on email hash
-        sender_id = hash(sender_email) % 10000000
-        
-        # Get current datetime
-        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
-        # First, check if this exact message already exists (avoid duplicates)
-        c.execute("SELECT id FROM emails WHERE message_id = %s", (message_id,))
-        if c.fetchone():
-            logger.debug(f"Message with ID {message_id} already exists in database. Skipping.")
-            conn.close()
-            return
-        
-        # Determine the session_id using our improved algorithm
-        session_id = get_conversation_id(c, sender_email, subject, in_reply_to)
-        
-        # If no existing session found, create a new one based on this message
-        if not session_id:
-            session_id = message_id
-            logger.info(f"Created new session_id: {session_id}")
-        
-        # Insert the email into the database
-        c.execute("""INSERT INTO emails 
-                    (sender_id, sender_email, session_id, message_id, in_reply_to, subject, message, role, received_at) 
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)""",
-                  (sender_id, sender_email, session_id, message_id, in_reply_to, subject, message, role, now))
-        
-        # Update any existing emails that might be part of this conversation but have different session_ids
-        if role == 'user':  # Only do this for incoming user emails to avoid unnecessary updates
-            # Find emails with matching sender or similar subject but different session_id
-            clean_subject = re.sub(r'^(?:Re|Fwd|FW|RE|FWD):\s*', '', subject, flags=re.IGNORECASE).strip().lower()
-            clean_sender = extract_email_address(sender_email)
+        with get_connection() as conn:
+            c = conn.cursor()
+            # Emails sharing a sender or subject are linked one at a time across workers
+            thread_keys = thread_keys_for(sender_email, subject) if role == 'user' else []
+            with locked_thread_keys(c, thread_keys) as locks:
+                # Generate a simple sender_id based on email hash
+                sender_id = hash(sender_email) % 10000000
             
-            c.execute("""
-                UPDATE emails 
-                SET session_id = %s 
-                WHERE session_id != %s 
-                AND (
-                    (sender_email = %s OR sender_email LIKE %s)
-                    OR LOWER(REPLACE(subject, 'Re: ', '')) = %s
-                )
-            """, (session_id, session_id, clean_sender, f"%{clean_sender}%", clean_subject))
+                # Get current datetime
+                now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             
-            if c.rowcount > 0:
-                logger.info(f"Updated {c.rowcount} existing emails to use session_id: {session_id}")
-        
-        conn.commit()
-        conn.close()
+                # Determine the session_id using our improved algorithm
+                session_id = get_conversation_id(c, sender_email, subject, in_reply_to)
+            
+                # If no existing session found, create a new one based on this message
+                if not session_id:
+                    session_id = message_id
+                    logger.info(f"Created new session_id: {session_id}")
+            
+                # Insert the email into the database
+                try:
+                    c.execute("""INSERT INTO emails 
+                                (sender_id, sender_email, session_id, message_id, in_reply_to, subject, message, role, received_at) 
+                                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+                              (sender_id, sender_email, session_id, message_id, in_reply_to, subject, message, role, now))
+                except mysql.connector.IntegrityError as e:
+                    # Duplicates are caught by the unique message_id index rather than a SELECT first
+                    if e.errno != 1062:
+                        raise
+                    logger.debug(f"Message with ID {message_id} already exists in database. Skipping.")
+                    # A job resumed after a crash still needs the conversation it was saved in
+                    c.execute("SELECT session_id FROM emails WHERE message_id = %s", (message_id,))
+                    existing = c.fetchone()
+                    return find_session(c, existing[0]) if existing and existing[0] else None
+            
+                # Merge any existing conversation with the same sender or subject into this one.
+                # This goes through the thread index; historical rows are never rewritten.
+                if role == 'user':  # Only do this for incoming user emails to avoid unnecessary updates
+                    session_id = link_thread(c, session_id, sender_email, subject, locks)
+            
+                # Keep the per-conversation summary used by the /sessions/ API current
+                record_session_message(c, session_id, sender_email, subject, message_id, role, now)
+                count_merges(c, locks.merges)
+            
+                conn.commit()
         logger.debug(f"Email saved successfully with session_id: {session_id}")
         return session_id
     except Exception as e:
         logger.error(f"Error saving email: {e}", exc_info=True)
         raise
 
-def get_all_emails():
-    conn = mysql.connector.connect(**DB_CONFIG)
-    c = conn.cursor()
-    
-    c.execute('''SELECT * FROM emails ORDER BY received_at DESC''')
-    emails = c.fetchall()
-    conn.close()
-    return emails
+@timed_db
+def save_emails_bulk(rows, link_threads=True):
+    """
+    Save many emails in one transaction. Each row is a dict with the
+    save_email fields (sender_email, message_id, in_reply_to, subject,
+    message, role) and optionally session_id and received_at.
+
+    Rows whose message_id is already stored are skipped. Rows without a
+    session_id join the session of the email they reply to (earlier in the
+    batch or already stored) or start a new one; with link_threads, inbound
+    emails are linked by sender/subject like save_email does. Returns the
+    number of emails inserted.
+    """
+    if not rows:
+        return 0
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with get_connection() as conn:
+        c = conn.cursor()
+        # Hold the thread locks of every inbound email, as save_email does, when linking
+        thread_keys = [key for row in rows if link_threads and row.get('role', 'user') == 'user'
+                       for key in thread_keys_for(row['sender_email'], row.get('subject'))]
+        with locked_thread_keys(c, thread_keys) as locks:
+            # One lookup for the whole batch instead of a SELECT per email
+            message_ids = list({row['message_id'] for row in rows})
+            c.execute(f"SELECT message_id FROM emails WHERE message_id IN ({', '.join(['%s'] * len(message_ids))})",
+                      message_ids)
+            seen = {result[0] for result in c.fetchall()}
+            new_rows = []
+            for row in rows:
+                if row['message_id'] not in seen:
+                    seen.add(row['message_id'])
+                    new_rows.append(row)
+            if not new_rows:
+                return 0
+
+            sessions = {}
+            parents = list({row['in_reply_to'] for row in new_rows if not row.get('session_id') and row.get('in_reply_to')})
+            if parents:
+                c.execute(f"""SELECT message_id, session_id FROM emails
+                              WHERE message_id IN ({', '.join(['%s'] * len(parents))})""", parents)
+                sessions.update(c.fetchall())
 
-def display_emails():
+            values = []
+            for row in new_rows:
+                session_id = row.get('session_id') or sessions.get(row.get('in_reply_to')) or row['message_id']
+                sessions[row['message_id']] = session_id
+                values.append((hash(row['sender_email']) % 10000000, row['sender_email'], session_id,
+                               row['message_id'], row.get('in_reply_to'), row.get('subject'), row.get('message'),
+                               row.get('role', 'user'), row.get('received_at') or now))
+            # Sent as a single multi-row INSERT; the no-op update skips rows another writer inserted
+            # meanwhile, and such a row counts 0 affected rows instead of 1
+            insert_sql = """INSERT INTO emails
+                            (sender_id, sender_email, session_id, message_id, in_reply_to, subject, message, role, received_at)
+                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                            ON DUPLICATE KEY UPDATE id = id"""
+            c.execute("SAVEPOINT bulk_insert")
+            c.executemany(insert_sql, values)
+            if c.rowcount != len(values):
+                # Redo the rows one at a time to learn which are ours, so the others are
+                # neither linked nor counted in the session summaries a second time
+                c.execute("ROLLBACK TO SAVEPOINT bulk_insert")
+                inserted = []
+                for row, value in zip(new_rows, values):
+                    c.execute(insert_sql, value)
+                    if c.rowcount == 1:
+                        inserted.append((row, value))
+                logger.info(f"{len(values) - len(inserted)} email(s) of a bulk save were stored by another writer")
+                new_rows = [row for row, value in inserted]
+                values = [value for row, value in inserted]
+                if not values:
+                    conn.commit()
+                    return 0
+
+            if link_threads:
+                for row, value in zip(new_rows, values):
+                    if value[7] == 'user':
+                        link_thread(c, value[2], row['sender_email'], row.get('subject'), locks)
+
+            # Summaries are keyed by canonical session, resolved once all merges are done
+            batch_sessions = list({value[2] for value in values})
+            c.execute(f"""SELECT session_id, parent_id FROM session_aliases
+                          WHERE session_id IN ({', '.join(['%s'] * len(batch_sessions))})""", batch_sessions)
+            roots = dict(c.fetchall())
+            record_session_messages(c, sorted(
+                ((roots.get(value[2], value[2]), value[1], value[5], value[3], value[7], value[8]) for value in values),
+                key=lambda message: str(message[5])))
+            count_merges(c, locks.merges)
+
+            conn.commit()
+    logger.debug(f"Saved {len(new_rows)} of {len(rows)} email(s) in bulk")
+    return len(new_rows)
+
+# Public email fields and the SQL that produces each of them. session_id is
+# resolved to the canonical conversation through session_aliases.
+EMAIL_COLUMNS = {
+    'sender_email': 'e.sender_email',
+    'sender_id': 'e.sender_id',
+    'session_id': 'COALESCE(sa.parent_id, e.session_id)',
+    'message_id': 'e.message_id',
+    'in_reply_to': 'e.in_reply_to',
+    'subject': 'e.subject',
+    'message': 'e.message',
+    'role': 'e.role',
+    'received_at': 'e.received_at',
+}
+
+def session_filter_sql(column='e.session_id'):
+    """
+    SQL condition matching every stored session_id that belongs to a
+    canonical session; takes the canonical session_id twice as parameters.
+    Uses the session_aliases parent index instead of filtering on COALESCE().
+    """
+    return f"""({column} = %s OR {column} IN
+               (SELECT session_id FROM session_aliases WHERE parent_id = %s))"""
+
+def build_emails_query(fields=None, session_id=None, sender=None, role=None, since=None,
+                       until=None, after=None, limit=None):
+    """
+    Build a keyset-paginated query over emails, newest first.
+
+    fields selects which EMAIL_COLUMNS are returned; the id and received_at
+    needed for the next cursor are always appended as the last two columns.
+    after is the (received_at, id) of the last row of the previous page.
+    Returns (sql, params).
+    """
+    fields = fields or list(EMAIL_COLUMNS)
+    select = [EMAIL_COLUMNS[field] for field in fields] + ['e.received_at', 'e.id']
+
+    conditions, params = email_filters_sql(session_id, sender, role, since, until)
+    if after:
+        # Expanded row comparison so MySQL can range-scan idx_emails_received
+        conditions.append("(e.received_at < %s OR (e.received_at = %s AND e.id < %s))")
+        params += [after[0], after[0], after[1]]
+
+    sql = f"""SELECT {', '.join(select)}
+              FROM emails e
+              LEFT JOIN session_aliases sa ON sa.session_id = e.session_id"""
+    if conditions:
+        sql += "\n              WHERE " + " AND ".join(conditions)
+    sql += "\n              ORDER BY e.received_at DESC, e.id DESC"
+    if limit:
+        sql += "\n              LIMIT %s"
+        params.append(limit)
+    return sql, params
+
+def build_changes_query(fields=None, since=0, settle=0, limit=None):
+    """
+    Build the change feed query: emails stored after the one with id since,
+    oldest first, served by the primary key. The id and whether the email
+    was stored more than settle seconds ago (by the database clock) are
+    appended as the last two columns.
+    Returns (sql, params).
+    """
+    fields = fields or list(EMAIL_COLUMNS)
+    select = [EMAIL_COLUMNS[field] for field in fields] + ['e.id', 'e.created_at <= NOW() - INTERVAL %s SECOND']
+    sql = f"""SELECT {', '.join(select)}
+              FROM emails e
+              LEFT JOIN session_aliases sa ON sa.session_id = e.session_id
+              WHERE e.id > %s
+              ORDER BY e.id"""
+    params = [settle, since]
+    if limit:
+        sql += "\n              LIMIT %s"
+        params.append(limit)
+    return sql, params
+
+def get_changes_version(c, since, limit, settle=0):
+    """
+    (count, highest id, settled count, session merges) of the first limit
+    emails after id since. Any email committed into that window changes the
+    first two, an email in it whose created_at becomes settle seconds old
+    changes the third, and a session merge, which changes the session_id of
+    emails already returned, changes the last. Together they version a
+    change feed page and its cursor; reading them is one short primary key
+    range and a single-row lookup.
+    """
+    c.execute("""SELECT COUNT(*), COALESCE(MAX(id), 0), COALESCE(SUM(settled), 0),
+                        COALESCE((SELECT merges FROM session_merge_counter WHERE id = 1), 0)
+                 FROM (SELECT id, created_at <= NOW() - INTERVAL %s SECOND AS settled
+                       FROM emails WHERE id > %s ORDER BY id LIMIT %s) page""", (settle, since, limit))
+    return c.fetchone()
+
+def email_filters_sql(session_id=None, sender=None, role=None, since=None, until=None):
+    """Shared WHERE conditions of the email queries; returns (conditions, params)"""
+    conditions = []
+    params = []
+    if session_id:
+        conditions.append(session_filter_sql())
+        params += [session_id, session_id]
+    if sender:
+        conditions.append("e.sender_address = %s")
+        params.append(extract_email_address(sender))
+    if role:
+        conditions.append("e.role = %s")
+        params.append(role)
+    if since:
+        conditions.append("e.received_at >= %s")
+        params.append(since)
+    if until:
+        conditions.append("e.received_at < %s")
+        params.append(until)
+    return conditions, params
+
+# How /search interprets the query text: every word required (as a prefix),
+# any word (natural language ranking), or raw MySQL boolean syntax
+SEARCH_MODES = ('all', 'any', 'boolean')
+
+def search_against(query, mode='all'):
+    """Return (AGAINST text, MySQL search modifier) for a search query, or None if it has no words"""
+    if mode == 'boolean':
+        return (query, 'IN BOOLEAN MODE') if query.strip() else None
+    words = re.findall(r'\w+', query)
+    if not words:
+        return None
+    if mode == 'any':
+        return ' '.join(words), 'IN NATURAL LANGUAGE MODE'
+    return ' '.join(f"+{word}*" for word in words), 'IN BOOLEAN MODE'
+
+def build_search_query(query, mode='all', fields=None, session_id=None, sender=None, role=None,
+                       since=None, until=None, after=None, limit=None):
+    """
+    Build a ranked full-text query over subject and message, best match first.
+
+    Like build_emails_query, but the relevance score and id are appended as
+    the last two columns, and after is the (score, id) of the last row of
+    the previous page. Returns (sql, params), or None when query has no words.
+    """
+    against = search_against(query, mode)
+    if against is None:
+        return None
+    match = f"MATCH(e.subject, e.message) AGAINST (%s {against[1]})"
+    fields = fields or list(EMAIL_COLUMNS)
+    select = [EMAIL_COLUMNS[field] for field in fields] + [f"{match} AS score", 'e.id']
+
+    conditions, params = email_filters_sql(session_id, sender, role, since, until)
+    conditions.insert(0, match)
+    params = [against[0], against[0]] + params
+    if after:
+        conditions.append(f"({match} < %s OR ({match} = %s AND e.id < %s))")
+        params += [against[0], after[0], against[0], after[0], after[1]]
+
+    sql = f"""SELECT {', '.join(select)}
+              FROM emails e
+              LEFT JOIN session_aliases sa ON sa.session_id = e.session_id
+              WHERE {" AND ".join(conditions)}
+              ORDER BY score DESC, e.id DESC"""
+    if limit:
+        sql += "\n              LIMIT %s"
+        params.append(limit)
+    return sql, params
+
+SESSION_COLUMNS = ['session_id', 'subject', 'sender_email', 'message_count', 'first_at', 'last_at', 'last_role']
+
+def build_sessions_query(sender=None, last_role=None, after=None, limit=None):
+    """
+    Build a keyset-paginated query over session_summaries, most recently
+    active first. after is the (last_at, session_id) the previous page ended on.
+    Returns (sql, params); rows follow SESSION_COLUMNS.
+    """
+    conditions = []
+    params = []
+    if sender:
+        conditions.append("sender_address = %s")
+        params.append(extract_email_address(sender))
+    if last_role:
+        conditions.append("last_role = %s")
+        params.append(last_role)
+    if after:
+        conditions.append("(last_at < %s OR (last_at = %s AND session_id < %s))")
+        params += [after[0], after[0], after[1]]
+
+    sql = f"SELECT {', '.join(SESSION_COLUMNS)} FROM session_summaries"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY last_at DESC, session_id DESC"
+    if limit:
+        sql += " LIMIT %s"
+        params.append(limit)
+    return sql, params
+
+@timed_db
+def get_session(session_id):
+    """
+    Return (summary_row, email_rows) for a conversation, or None if unknown.
+    Any merged session_id is resolved to its canonical conversation first;
+    email rows follow EMAIL_COLUMNS, oldest first.
+    """
+    with get_connection() as conn:
+        c = conn.cursor()
+        session_id = find_session(c, session_id)
+        c.execute(f"SELECT {', '.join(SESSION_COLUMNS)} FROM session_summaries WHERE session_id = %s",
+                  (session_id,))
+        summary = c.fetchone()
+        if summary is None:
+            return None
+        c.execute(f"""SELECT {', '.join(EMAIL_COLUMNS.values())}
+                      FROM emails e
+                      LEFT JOIN session_aliases sa ON sa.session_id = e.session_id
+                      WHERE {session_filter_sql()}
+                      ORDER BY e.received_at, e.id""", (session_id, session_id))
+        emails = c.fetchall()
+    return summary, emails
+
+@timed_db
+def get_session_history(session_id, sender_email=None, exclude_message_id=None, limit=50):
+    """
+    Return up to limit most recent emails of a conversation as dicts with
+    role, subject, message and received_at, oldest first. With sender_email,
+    only that sender's emails and the replies to them are returned: sessions
+    can be merged by subject across customers, and one customer's prompt must
+    never contain another's emails.
+    """
+    if not session_id:
+        return []
+    conditions = [session_filter_sql(), "e.message_id != %s"]
+    params = [session_id, session_id, exclude_message_id or '']
+    if sender_email:
+        # A reply counts as the sender's if it answers one of their emails
+        conditions.append("""LOWER(TRIM(SUBSTRING_INDEX(SUBSTRING_INDEX(
+                                 CASE WHEN e.role = 'host' THEN p.sender_email ELSE e.sender_email END,
+                                 '<', -1), '>', 1))) = %s""")
+        params.append(extract_email_address(sender_email))
     try:
-        logger.debug("Fetching emails for display")
-        conn = mysql.connector.connect(**DB_CONFIG)
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute(f"""SELECT e.role, e.subject, e.message, e.received_at
+                          FROM emails e
+                          LEFT JOIN emails p ON p.message_id = e.in_reply_to
+                          WHERE {' AND '.join(conditions)}
+                          ORDER BY e.received_at DESC, e.id DESC
+                          LIMIT %s""", params + [limit])
+            rows = c.fetchall()
+        return [dict(zip(('role', 'subject', 'message', 'received_at'), row)) for row in reversed(rows)]
+    except Exception as e:
+        logger.error(f"Error loading session history: {e}", exc_info=True)
+        return []  # Generate without history rather than not at all
+
+def get_all_emails():
+    with get_connection() as conn:
         c = conn.cursor()
         
-        c.execute('''SELECT sender_email, message_id, in_reply_to, session_id, subject, message, role, received_at 
-                     FROM emails
-                     ORDER BY received_at DESC''')
+        c.execute('''SELECT e.id, e.sender_id, e.sender_email, COALESCE(sa.parent_id, e.session_id),
+                            e.message_id, e.in_reply_to, e.subject, e.message, e.role, e.received_at
+                     FROM emails e
+                     LEFT JOIN session_aliases sa ON sa.session_id = e.session_id
+                     ORDER BY e.received_at DESC''')
         emails = c.fetchall()
+    return emails
+
+def display_emails(limit=20):
+    """Print the most recent emails"""
+    try:
+        logger.debug("Fetching emails for display")
+        with get_connection() as conn:
+            c = conn.cursor()
+            
+            c.execute('''SELECT e.sender_email, e.message_id, e.in_reply_to, COALESCE(sa.parent_id, e.session_id),
+                                e.subject, e.message, e.role, e.received_at 
+                         FROM emails e
+                         LEFT JOIN session_aliases sa ON sa.session_id = e.session_id
+                         ORDER BY e.received_at DESC LIMIT %s''', (limit,))
+            emails = c.fetchall()
         
         print("\nSaved Emails:")
         print("-" * 50)
@@ -175,26 +795,72 @@ def display_emails():
             print(f"Message: {email[5][:100]}...")  # Display first 100 chars of message
             print("-" * 50)
         
-        conn.close()
         logger.debug(f"Displayed {len(emails)} emails")
     except Exception as e:
         logger.error(f"Error displaying emails: {e}", exc_info=True)
 
+@timed_db
 def check_message_processed(message_id):
     """Check if a message has already been processed"""
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
-        c = conn.cursor()
-        
-        # Check if we have already processed this message
-        c.execute("SELECT id FROM emails WHERE message_id = %s OR in_reply_to = %s", (message_id, message_id))
-        result = c.fetchone()
-        conn.close()
+        with get_connection() as conn:
+            c = conn.cursor()
+            
+            # Check if we have already processed this message
+            c.execute("SELECT id FROM emails WHERE message_id = %s OR in_reply_to = %s", (message_id, message_id))
+            result = c.fetchone()
         
         return result is not None
     except Exception as e:
         logger.error(f"Error checking message status: {e}", exc_info=True)
         return False  # If in doubt, process the message
 
-# Initialize database when module is imported
-init_db() 
\ No newline at end of file
+@timed_db
+def get_imap_checkpoint(mailbox):
+    """Return (uidvalidity, last_uid) stored for a mailbox, or None"""
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT uidvalidity, last_uid FROM imap_checkpoints WHERE mailbox = %s", (mailbox,))
+            result = c.fetchone()
+        return result
+    except Exception as e:
+        logger.error(f"Error reading IMAP checkpoint: {e}", exc_info=True)
+        return None  # Fall back to a full search
+
+@timed_db
+def save_imap_checkpoint(mailbox, uidvalidity, last_uid):
+    """Persist the highest fully processed UID for a mailbox"""
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute("""INSERT INTO imap_checkpoints (mailbox, uidvalidity, last_uid)
+                         VALUES (%s, %s, %s)
+                         ON DUPLICATE KEY UPDATE uidvalidity = VALUES(uidvalidity), last_uid = VALUES(last_uid)""",
+                      (mailbox, uidvalidity, last_uid))
+            conn.commit()
+        logger.debug(f"Saved IMAP checkpoint for {mailbox}: UIDVALIDITY={uidvalidity}, last UID={last_uid}")
+    except Exception as e:
+        logger.error(f"Error saving IMAP checkpoint: {e}", exc_info=True)
+
+def save_metrics_snapshot(worker_id, snapshot):
+    """Store a worker's latest metrics snapshot (JSON) for the API"""
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""INSERT INTO worker_metrics (worker_id, snapshot, updated_at) VALUES (%s, %s, NOW())
+                     ON DUPLICATE KEY UPDATE snapshot = VALUES(snapshot), updated_at = VALUES(updated_at)""",
+                  (worker_id, snapshot))
+        conn.commit()
+
+def get_metrics_snapshots(max_age):
+    """Return (worker_id, snapshot JSON) of every worker that published within max_age seconds"""
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""SELECT worker_id, snapshot FROM worker_metrics
+                     WHERE updated_at >= NOW() - INTERVAL %s SECOND ORDER BY worker_id""", (max_age,))
+        return c.fetchall()
+
+# Create or upgrade the schema: python database.py
+if __name__ == "__main__":
+    init_db()
+ 
\ No newline at end of file
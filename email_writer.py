@@ -0,0 +1,125 @@
+"""
+Write-behind batching for emails that nobody waits on.
+
+Replies stored by the SMTP stage do not need their row back, so instead of
+a transaction per reply they are queued and written with save_emails_bulk:
+one multi-row INSERT and one commit per batch of up to EMAIL_WRITE_BATCH
+rows or every EMAIL_WRITE_INTERVAL seconds, whichever comes first.
+
+Rows that could not be written are remembered by message_id until a caller
+collects them with take_failed(), so the caller can keep (and later
+replay) whatever the row was built from.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from database import save_emails_bulk
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+EMAIL_WRITE_BATCH = int(os.getenv('EMAIL_WRITE_BATCH', '100'))
+EMAIL_WRITE_INTERVAL = float(os.getenv('EMAIL_WRITE_INTERVAL', '1.0'))
+
+# Sentinels placed on the queue
+_FLUSH = object()
+_STOP = object()
+
+
+class EmailWriter:
+    """Background thread, started by the first write, that saves queued email rows in batches"""
+
+    def __init__(self, batch_size=EMAIL_WRITE_BATCH, flush_interval=EMAIL_WRITE_INTERVAL, link_threads=True):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.link_threads = link_threads
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._failed = set()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="email-writer", daemon=True)
+                self._thread.start()
+
+    def write(self, row):
+        """Queue one row (a dict as accepted by save_emails_bulk)"""
+        if row.get('received_at') is None:
+            # Keep the time of the event, not of the flush
+            row = dict(row, received_at=time.strftime('%Y-%m-%d %H:%M:%S'))
+        self._start()
+        self._queue.put(row)
+
+    def flush(self):
+        """Block until every row queued so far is written"""
+        if self._thread is None:
+            return
+        done = threading.Event()
+        self._queue.put((_FLUSH, done))
+        done.wait()
+
+    def take_failed(self, message_ids):
+        """Which of message_ids failed to be written (call after flush); they are forgotten afterwards"""
+        with self._lock:
+            failed = self._failed.intersection(message_ids)
+            self._failed -= failed
+        return failed
+
+    def close(self):
+        """Write what is left and stop the thread"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._queue.put(_STOP)
+        thread.join()
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, dict):
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                if len(batch) < self.batch_size:
+                    continue
+
+            self._write(batch)
+            batch = []
+            deadline = None
+            if item is _STOP:
+                return
+            if isinstance(item, tuple):
+                item[1].set()
+
+    def _write(self, batch):
+        if not batch:
+            return
+        try:
+            save_emails_bulk(batch, link_threads=self.link_threads)
+        except Exception as e:
+            logger.error(f"Batch write of {len(batch)} email(s) failed, retrying one by one: {e}", exc_info=True)
+            # Isolate the bad row instead of losing the whole batch
+            for row in batch:
+                try:
+                    save_emails_bulk([row], link_threads=self.link_threads)
+                except Exception as e:
+                    logger.error(f"Error saving email {row.get('message_id')}: {e}", exc_info=True)
+                    with self._lock:
+                        self._failed.add(row.get('message_id'))
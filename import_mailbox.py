@@ -0,0 +1,148 @@
+"""
+Bulk import of historical mail into the emails table.
+
+    python import_mailbox.py PATH [PATH ...] [--format auto|mbox|maildir|eml]
+                             [--batch-size 1000] [--support-address ADDRESS] [--no-link-threads]
+
+Each PATH is an mbox file, a Maildir directory or a directory tree of .eml
+files. Messages are written with save_emails_bulk, one multi-row INSERT and
+one commit per batch, and threaded by In-Reply-To (plus sender/subject
+linking unless --no-link-threads is given). Messages from the support
+address are stored with role 'host', everything else as 'user'. Messages
+already in the database are skipped, so an interrupted import can simply
+be run again.
+"""
+
+import argparse
+import email
+import hashlib
+import logging
+import mailbox
+import os
+import time
+from email.utils import parsedate_to_datetime
+
+from dotenv import load_dotenv
+
+from database import ensure_schema, save_emails_bulk
+from mail_client import parse_email
+from thread_index import extract_email_address
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+def detect_format(path):
+    if os.path.isfile(path):
+        return 'eml' if path.lower().endswith('.eml') else 'mbox'
+    if all(os.path.isdir(os.path.join(path, sub)) for sub in ('cur', 'new', 'tmp')):
+        return 'maildir'
+    return 'eml'
+
+
+def iter_messages(path, fmt='auto'):
+    """Yield (raw bytes or None, email.message.Message) for every message under path"""
+    if fmt == 'auto':
+        fmt = detect_format(path)
+    if fmt == 'mbox':
+        for message in mailbox.mbox(path, create=False):
+            yield None, message
+    elif fmt == 'maildir':
+        for message in mailbox.Maildir(path, factory=None, create=False):
+            yield None, message
+    elif os.path.isfile(path):
+        with open(path, 'rb') as file:
+            raw = file.read()
+        yield raw, email.message_from_bytes(raw)
+    else:
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith('.eml'):
+                    with open(os.path.join(root, name), 'rb') as file:
+                        raw = file.read()
+                    yield raw, email.message_from_bytes(raw)
+
+
+def received_at(message):
+    """Date header as naive local time, like the timestamps save_email writes"""
+    try:
+        date = parsedate_to_datetime(message['Date'])
+    except (TypeError, ValueError, IndexError):
+        return None
+    if date.tzinfo is not None:
+        date = date.astimezone().replace(tzinfo=None)
+    return date.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def message_to_row(raw, message, support_address):
+    parsed = parse_email(message)
+    message_id = parsed['message_id']
+    if not message_id:
+        # Stable synthetic id so re-running the import does not duplicate the message
+        digest = hashlib.sha1(raw if raw is not None else message.as_bytes()).hexdigest()
+        message_id = f"<{digest}@import.invalid>"
+    sender = parsed['sender_email'] or ''
+    return {
+        'sender_email': sender,
+        'message_id': message_id.strip(),
+        'in_reply_to': parsed['in_reply_to'].strip() if parsed['in_reply_to'] else None,
+        'subject': parsed['subject'],
+        'message': parsed['message_body'],
+        'role': 'host' if support_address and extract_email_address(sender) == support_address else 'user',
+        'received_at': received_at(message),
+    }
+
+
+def import_paths(paths, fmt='auto', batch_size=1000, support_address=None, link_threads=True):
+    """Import every message under paths; returns (messages read, emails inserted, seconds)"""
+    support_address = extract_email_address(support_address) if support_address else None
+    started = time.monotonic()
+    read = inserted = 0
+    batch = []
+
+    def flush():
+        nonlocal inserted
+        inserted += save_emails_bulk(batch, link_threads=link_threads)
+        elapsed = time.monotonic() - started
+        logger.info(f"{read} read, {inserted} inserted ({read / elapsed if elapsed else 0:.0f} messages/s)")
+        batch.clear()
+
+    for path in paths:
+        logger.info(f"Importing {path}")
+        for raw, message in iter_messages(path, fmt):
+            read += 1
+            try:
+                batch.append(message_to_row(raw, message, support_address))
+            except Exception as e:
+                logger.error(f"Skipping unreadable message #{read} in {path}: {e}", exc_info=True)
+                continue
+            if len(batch) >= batch_size:
+                flush()
+    if batch:
+        flush()
+    return read, inserted, time.monotonic() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load historical mailboxes into the emails table")
+    parser.add_argument('paths', nargs='+', help="mbox files, Maildir directories or directories of .eml files")
+    parser.add_argument('--format', choices=['auto', 'mbox', 'maildir', 'eml'], default='auto')
+    parser.add_argument('--batch-size', type=int, default=1000, help="emails per INSERT/commit")
+    parser.add_argument('--support-address', default=os.getenv('EMAIL'),
+                        help="messages from this address are stored as replies (role 'host')")
+    parser.add_argument('--no-link-threads', dest='link_threads', action='store_false',
+                        help="only thread by In-Reply-To, skip sender/subject linking (faster)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    ensure_schema()
+    read, inserted, elapsed = import_paths(args.paths, args.format, args.batch_size,
+                                           args.support_address, args.link_threads)
+    print(f"Imported {inserted} of {read} messages in {elapsed:.1f}s "
+          f"({read / elapsed if elapsed else 0:.0f} messages/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+"""
+Durable, lease-based processing state for inbound emails.
+
+Each inbound email has one row in email_jobs, keyed by its Message-ID (the
+idempotency key), that moves through
+
+    fetched -> saved -> generated -> sent -> flagged
+
+fetched:   claimed from IMAP, not yet stored
+saved:     stored in emails, session_id known
+generated: reply text and the reply's Message-ID persisted
+sent:      reply delivered over SMTP; its row in emails may still be queued
+flagged:   reply row stored and Processed-By-System set in IMAP, nothing left to do
+
+A worker only works on a job while it holds the lease (lease_owner and
+lease_expires_at, computed on the database clock so hosts need not agree on
+time). Leases are renewed by a heartbeat while the job is in flight; when a
+worker dies its leases expire and the next worker that sees the email in
+IMAP resumes it from the last persisted state instead of starting over. A
+resumed 'generated' job is re-sent with the same Message-ID, so mail
+clients that de-duplicate on Message-ID show the reply once. A resumed
+'sent' job stores its reply row again from the job (a no-op if it was
+written), since sent replies are saved in batches.
+"""
+
+import logging
+import os
+import socket
+import threading
+
+from dotenv import load_dotenv
+
+from database import get_connection
+from metrics import timed_db
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+JOB_STATES = ('fetched', 'saved', 'generated', 'sent', 'flagged')
+
+# Seconds a claimed job stays reserved without a heartbeat, and the heartbeat interval
+JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', '300'))
+JOB_HEARTBEAT_INTERVAL = int(os.getenv('JOB_HEARTBEAT_INTERVAL', '60'))
+# Seconds after which an unfinished job without a live lease stops holding back the
+# IMAP checkpoint: its email has not been found by a search since (deleted, moved,
+# or flagged by a worker that lost the lease before finishing the job)
+JOB_STALE_SECONDS = int(os.getenv('JOB_STALE_SECONDS', '3600'))
+# Identifies this process in lease_owner; must be unique across hosts
+WORKER_ID = os.getenv('WORKER_ID') or f"{socket.gethostname()}:{os.getpid()}"
+
+_JOB_FIELDS = ('session_id', 'reply', 'reply_message_id')
+
+# Jobs this process is working on. The same email can be fetched twice by one
+# process (two UIDs with one Message-ID, or one email in two mailboxes); the
+# second copy must be skipped even though the lease is already ours.
+_held = set()
+_held_lock = threading.Lock()
+
+
+@timed_db
+def claim_job(message_id, mailbox, uidvalidity, uid, worker_id=WORKER_ID, lease=JOB_LEASE_SECONDS):
+    """
+    Take the lease on an email's job, creating it in the 'fetched' state if
+    it is new. Returns the job (state, session_id, reply, reply_message_id,
+    attempts) as a dict, or None when the job is already flagged, another
+    worker holds a live lease on it, or this process is already working on
+    it. A live lease of worker_id that no job in this process holds (left
+    by a previous process with the same WORKER_ID) is taken over.
+    """
+    with _held_lock:
+        if message_id in _held:
+            return None
+        _held.add(message_id)
+    try:
+        job = _claim(message_id, mailbox, uidvalidity, uid, worker_id, lease)
+    except Exception:
+        _forget(message_id)
+        raise
+    if job is None:
+        _forget(message_id)
+    return job
+
+
+def _forget(*message_ids):
+    with _held_lock:
+        _held.difference_update(message_ids)
+
+
+def _claim(message_id, mailbox, uidvalidity, uid, worker_id, lease):
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""INSERT IGNORE INTO email_jobs (message_id, mailbox, uidvalidity, uid, state)
+                     VALUES (%s, %s, %s, %s, 'fetched')""",
+                  (message_id, mailbox, uidvalidity, uid))
+        c.execute("""SELECT state, session_id, reply, reply_message_id, attempts, lease_owner,
+                            lease_expires_at > NOW()
+                     FROM email_jobs WHERE message_id = %s FOR UPDATE""", (message_id,))
+        state, session_id, reply, reply_message_id, attempts, owner, leased = c.fetchone()
+        if state == 'flagged' or (leased and owner != worker_id):
+            conn.commit()
+            return None
+        # The UID changes if the message was moved or the mailbox was rebuilt
+        c.execute("""UPDATE email_jobs
+                     SET lease_owner = %s, lease_expires_at = NOW() + INTERVAL %s SECOND,
+                         attempts = attempts + 1, mailbox = %s, uidvalidity = %s, uid = %s
+                     WHERE message_id = %s""",
+                  (worker_id, lease, mailbox, uidvalidity, uid, message_id))
+        conn.commit()
+    if attempts:
+        logger.info(f"Resuming job {message_id} from state '{state}' (attempt {attempts + 1})")
+    return {
+        'state': state,
+        'session_id': session_id,
+        'reply': reply,
+        'reply_message_id': reply_message_id,
+        'attempts': attempts + 1,
+    }
+
+
+def _update_leased(message_id, worker_id, assignments, params, lease):
+    """Apply an update only while worker_id still owns the job; returns False if the lease was lost"""
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT lease_owner FROM email_jobs WHERE message_id = %s FOR UPDATE", (message_id,))
+        row = c.fetchone()
+        if row is None or row[0] != worker_id:
+            conn.rollback()
+            logger.warning(f"Lost the lease on job {message_id} (now held by {row[0] if row else 'nobody'})")
+            return False
+        c.execute(f"""UPDATE email_jobs
+                      SET {', '.join(assignments + ['lease_expires_at = NOW() + INTERVAL %s SECOND'])}
+                      WHERE message_id = %s""",
+                  params + [lease, message_id])
+        conn.commit()
+    return True
+
+
+@timed_db
+def advance_job(message_id, state, worker_id=WORKER_ID, lease=JOB_LEASE_SECONDS, **fields):
+    """
+    Record that a job reached state, together with any of session_id, reply
+    and reply_message_id. Returns False if this worker no longer holds the lease.
+    """
+    if state not in JOB_STATES:
+        raise ValueError(f"Unknown job state: {state}")
+    assignments = ["state = %s", "last_error = NULL"]
+    params = [state]
+    for name in _JOB_FIELDS:
+        if name in fields:
+            assignments.append(f"{name} = %s")
+            params.append(fields[name])
+    return _update_leased(message_id, worker_id, assignments, params, lease)
+
+
+@timed_db
+def renew_lease(message_id, worker_id=WORKER_ID, lease=JOB_LEASE_SECONDS):
+    """Extend the lease on one job, e.g. right before an irreversible step; False if it was lost"""
+    return _update_leased(message_id, worker_id, [], [], lease)
+
+
+def release_job(message_id, error=None, worker_id=WORKER_ID):
+    """Give up a failed job so any worker can retry it from its last state"""
+    _forget(message_id)
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute("""UPDATE email_jobs SET lease_owner = NULL, lease_expires_at = NULL, last_error = %s
+                         WHERE message_id = %s AND lease_owner = %s""",
+                      (str(error) if error else None, message_id, worker_id))
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Error releasing job {message_id}: {e}", exc_info=True)
+
+
+@timed_db
+def finish_jobs(message_ids, worker_id=WORKER_ID):
+    """Mark jobs flagged (done) and drop their leases"""
+    if not message_ids:
+        return
+    _forget(*message_ids)
+    with get_connection() as conn:
+        c = conn.cursor()
+        placeholders = ', '.join(['%s'] * len(message_ids))
+        c.execute(f"""UPDATE email_jobs SET state = 'flagged', lease_owner = NULL, lease_expires_at = NULL
+                      WHERE message_id IN ({placeholders}) AND lease_owner = %s""",
+                  list(message_ids) + [worker_id])
+        conn.commit()
+
+
+def oldest_unfinished_uid(mailbox, uidvalidity, stale=JOB_STALE_SECONDS):
+    """
+    Lowest UID of a job in this mailbox that is not flagged yet and is still
+    being worked on: leased, or touched within the last stale seconds. An
+    unflagged email below the checkpoint is searched and claimed again every
+    cycle, so only jobs whose email is gone from the search go stale.
+    Returns None if there is no such job.
+    """
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute("""SELECT MIN(uid) FROM email_jobs
+                         WHERE mailbox = %s AND uidvalidity = %s AND state <> 'flagged'
+                           AND (lease_expires_at > NOW() OR updated_at > NOW() - INTERVAL %s SECOND)""",
+                      (mailbox, uidvalidity, stale))
+            result = c.fetchone()
+        return result[0] if result else None
+    except Exception as e:
+        logger.error(f"Error reading unfinished jobs: {e}", exc_info=True)
+        return None
+
+
+class LeaseHeartbeat:
+    """Background thread that keeps renewing every lease this worker holds"""
+
+    def __init__(self, worker_id=WORKER_ID, lease=JOB_LEASE_SECONDS, interval=JOB_HEARTBEAT_INTERVAL):
+        self.worker_id = worker_id
+        self.lease = lease
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="lease-heartbeat", daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                with get_connection() as conn:
+                    c = conn.cursor()
+                    c.execute("""UPDATE email_jobs SET lease_expires_at = NOW() + INTERVAL %s SECOND
+                                 WHERE lease_owner = %s AND state <> 'flagged'""",
+                              (self.lease, self.worker_id))
+                    conn.commit()
+            except Exception as e:
+                logger.error(f"Error renewing job leases: {e}", exc_info=True)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,222 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+import metrics
+from scheduler import LLMScheduler
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_URL = os.getenv('OLLAMA_URL', 'http://localhost:11434/api/generate')
+# Seconds to wait for the first token (includes model load) and for the whole reply
+OLLAMA_FIRST_TOKEN_TIMEOUT = float(os.getenv('OLLAMA_FIRST_TOKEN_TIMEOUT', '20'))
+OLLAMA_TOTAL_TIMEOUT = float(os.getenv('OLLAMA_TOTAL_TIMEOUT', '60'))
+# A reply cut off by the deadline is still used if it has at least this many characters
+OLLAMA_MIN_PARTIAL_CHARS = int(os.getenv('OLLAMA_MIN_PARTIAL_CHARS', '200'))
+
+# Model used for replies, and an optional smaller model for short emails that
+# start a new conversation (unset to always use OLLAMA_MODEL)
+OLLAMA_MODEL = os.getenv('OLLAMA_MODEL', 'llama2')
+OLLAMA_SMALL_MODEL = os.getenv('OLLAMA_SMALL_MODEL')
+OLLAMA_SMALL_MODEL_MAX_CHARS = int(os.getenv('OLLAMA_SMALL_MODEL_MAX_CHARS', '400'))
+
+# Requests allowed in flight at the model server; the limit is lowered (down to
+# LLM_MIN_IN_FLIGHT) while time to first token exceeds LLM_LATENCY_TOLERANCE
+# times its best recent level, and raised again when it recovers
+LLM_MAX_IN_FLIGHT = int(os.getenv('LLM_MAX_IN_FLIGHT', '4'))
+LLM_MIN_IN_FLIGHT = int(os.getenv('LLM_MIN_IN_FLIGHT', '1'))
+LLM_LATENCY_TOLERANCE = float(os.getenv('LLM_LATENCY_TOLERANCE', '2.0'))
+
+FALLBACK_REPLY = "Thank you for your email. We'll get back to you shortly."
+
+_SENTENCE_END_RE = re.compile(r'[.!?](?:\s|$)|\n')
+
+# One pooled HTTP session per thread (generation workers run in parallel)
+_local = threading.local()
+
+# Shared by every thread that calls the model server
+llm_scheduler = LLMScheduler(max_in_flight=LLM_MAX_IN_FLIGHT, min_in_flight=LLM_MIN_IN_FLIGHT,
+                             latency_tolerance=LLM_LATENCY_TOLERANCE)
+
+LLM_REQUESTS = metrics.counter('email_llm_requests_total', "Requests to the model server by outcome")
+LLM_RETRIES = metrics.counter('email_llm_retries_total', "Retried requests to the model server")
+LLM_TOKENS = metrics.counter('email_llm_tokens_total', "Tokens generated")
+LLM_TTFT = metrics.histogram('email_llm_ttft_seconds', "Time to first token")
+LLM_GENERATION = metrics.histogram('email_llm_generation_seconds', "Time from request to last token")
+LLM_SCHEDULER = metrics.gauge('email_llm_scheduler', "Model server scheduler state")
+for _field in ('limit', 'in_flight', 'waiting'):
+    LLM_SCHEDULER.set_function(lambda field=_field: llm_scheduler.stats()[field], state=_field)
+
+
+def get_session():
+    """Return this thread's keep-alive HTTP session to the Ollama server"""
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        _local.session = session
+    return session
+
+
+def truncate_reply(text):
+    """Cut a partial reply back to its last complete sentence"""
+    ends = [match.end() for match in _SENTENCE_END_RE.finditer(text)]
+    return text[:ends[-1]].rstrip() if ends else text.rstrip()
+
+
+def _record(result, retries):
+    model = result['model']
+    if retries:
+        LLM_RETRIES.inc(retries, model=model)
+    if result['ttft'] is None:
+        LLM_REQUESTS.inc(model=model, outcome='failed')
+    else:
+        LLM_REQUESTS.inc(model=model, outcome='truncated' if result['truncated'] else 'ok')
+        LLM_TTFT.observe(result['ttft'], model=model)
+        LLM_GENERATION.observe(result['generation_seconds'], model=model)
+        LLM_TOKENS.inc(result['tokens'], model=model)
+
+
+def select_model(message_body, has_history=False):
+    """
+    Pick the model for an email: short emails opening a new conversation go
+    to OLLAMA_SMALL_MODEL when one is configured. Ongoing conversations stay
+    on OLLAMA_MODEL so replies (and reusable contexts) come from one model.
+    """
+    if OLLAMA_SMALL_MODEL and not has_history and len((message_body or '').strip()) <= OLLAMA_SMALL_MODEL_MAX_CHARS:
+        return OLLAMA_SMALL_MODEL
+    return OLLAMA_MODEL
+
+
+def generate(prompt, model=None, max_retries=3, first_token_timeout=None, total_timeout=None,
+             options=None, enqueued_at=None, session_id=None, **fields):
+    """
+    Stream a completion from Ollama's /api/generate.
+
+    The call first waits for a slot from llm_scheduler; enqueued_at (when the
+    email arrived) and session_id decide its place in line. Tokens are
+    consumed as they arrive. An attempt that produces no token
+    within first_token_timeout is retried while the overall deadline allows;
+    once the overall deadline passes mid-reply, or the stream breaks after
+    the first token, the partial text is kept, cut back to a sentence
+    boundary, if it is long enough to be useful.
+    Extra keyword arguments (e.g. system, context) are passed to Ollama.
+
+    Returns a dict with text, model, ttft, tokens, tokens_per_second,
+    generation_seconds, truncated and, when Ollama sent it, context.
+    """
+    model = model or OLLAMA_MODEL
+    with llm_scheduler.slot(enqueued_at=enqueued_at, session_id=session_id) as ticket:
+        result = _stream_generate(prompt, model, max_retries, first_token_timeout, total_timeout,
+                                  options, fields)
+        # Time to first token tracks queueing at the server; without one, the whole failed attempt counts
+        ticket['latency'] = result['ttft']
+    return result
+
+
+def _set_read_timeout(response, timeout):
+    """Set the timeout of the next socket read of a streaming response"""
+    sock = getattr(getattr(response.raw, 'connection', None), 'sock', None)
+    if sock is not None:
+        # A zero timeout would make the socket non-blocking instead of expiring at once
+        sock.settimeout(max(timeout, 0.001))
+
+
+def _finish(result, chunks, started):
+    """Fill in the reply and its stats once an attempt produced tokens"""
+    result['generation_seconds'] = time.monotonic() - started
+    result['tokens'] = result['tokens'] or len(chunks)
+    if result['tokens_per_second'] is None and result['generation_seconds'] > 0:
+        result['tokens_per_second'] = result['tokens'] / result['generation_seconds']
+
+    text = ''.join(chunks)
+    if result['truncated']:
+        # Cut off by the deadline or a broken stream: use the partial reply only if it is long enough
+        text = truncate_reply(text)
+        if len(text) < OLLAMA_MIN_PARTIAL_CHARS:
+            logger.warning(f"Ollama reply cut off after {len(text)} characters, too short to use")
+            text = ''
+        else:
+            logger.warning(f"Using the first {len(text)} characters of the cut-off Ollama reply")
+    result['text'] = text
+
+
+def _stream_generate(prompt, model, max_retries, first_token_timeout, total_timeout, options, fields):
+    first_token_timeout = first_token_timeout or OLLAMA_FIRST_TOKEN_TIMEOUT
+    total_timeout = total_timeout or OLLAMA_TOTAL_TIMEOUT
+    data = {"model": model, "prompt": prompt, "stream": True}
+    data.update({name: value for name, value in fields.items() if value is not None})
+    if options:
+        data["options"] = options
+
+    deadline = time.monotonic() + total_timeout
+    result = {'text': '', 'model': model, 'ttft': None, 'tokens': 0, 'tokens_per_second': None,
+              'generation_seconds': 0.0, 'truncated': False, 'context': None}
+
+    retries = 0
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        started = time.monotonic()
+        chunks = []
+        try:
+            logger.info(f"Sending prompt to Ollama model: {model}")
+            # The read timeout bounds the wait for the first token and any stall between tokens
+            with get_session().post(OLLAMA_URL, json=data, stream=True,
+                                    timeout=(5, min(first_token_timeout, remaining))) as response:
+                response.raise_for_status()  # Raise exception for HTTP errors
+                for line in response.iter_lines():
+                    # Recomputed before every read, so a stall late in the reply cannot overrun the deadline
+                    _set_read_timeout(response, min(first_token_timeout, deadline - time.monotonic()))
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    if chunk.get('error'):
+                        raise requests.exceptions.RequestException(chunk['error'])
+                    if chunk.get('response'):
+                        if result['ttft'] is None:
+                            result['ttft'] = time.monotonic() - started
+                        chunks.append(chunk['response'])
+                    if chunk.get('done'):
+                        result['context'] = chunk.get('context')
+                        if chunk.get('eval_count') and chunk.get('eval_duration'):
+                            result['tokens'] = chunk['eval_count']
+                            result['tokens_per_second'] = chunk['eval_count'] / (chunk['eval_duration'] / 1e9)
+                        break
+                    if time.monotonic() >= deadline:
+                        # Out of time: stop generating and commit to what we have
+                        result['truncated'] = True
+                        break
+
+        except (requests.exceptions.RequestException, ValueError) as e:
+            if result['ttft'] is None:
+                retries += 1
+                logger.warning(f"Ollama request failed (attempt {retries}/{max_retries}): {e}")
+                if retries >= max_retries or deadline - time.monotonic() <= 2:
+                    break
+                time.sleep(2)  # Wait before retrying
+                continue
+            # Tokens were already streamed; keep them rather than starting over
+            result['truncated'] = True
+            logger.warning(f"Ollama stream broke after the first token: {e}")
+
+        _finish(result, chunks, started)
+        logger.info(f"Received response from Ollama "
+                    f"(ttft={result['ttft'] or 0:.2f}s, {result['tokens_per_second'] or 0:.1f} tokens/s)")
+        break
+
+    if result['ttft'] is None:
+        logger.error(f"Failed to get response from Ollama after {retries} attempts")
+    _record(result, retries)
+    return result
@@ -0,0 +1,83 @@
+import asyncio
+import os
+
+# Bytes read per step when scanning a file backwards
+BLOCK_SIZE = 8192
+
+
+def read_log_tail(log_file, count=100):
+    """
+    Return the last count lines of a file, reading it backwards in blocks so
+    time and memory depend on the size of the tail, not of the file.
+    """
+    if count <= 0:
+        return []
+    with open(log_file, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        blocks = []
+        newlines = 0
+        # One extra newline is needed to know the first returned line is complete
+        while position > 0 and newlines <= count:
+            size = min(BLOCK_SIZE, position)
+            position -= size
+            f.seek(position)
+            block = f.read(size)
+            blocks.append(block)
+            newlines += block.count(b'\n')
+
+    data = b''.join(reversed(blocks))
+    lines = data.decode('utf-8', errors='replace').splitlines(keepends=True)
+    return lines[-count:]
+
+
+async def follow_log(log_file, poll_interval=0.5, is_disconnected=None):
+    """
+    Yield lines appended to a log file as they are written, like tail -F.
+    Starts at the current end of the file and reopens it when it is rotated
+    or truncated. is_disconnected is an optional coroutine function; following
+    stops once it returns True.
+    """
+    f = None
+    partial = ''
+    try:
+        while True:
+            if is_disconnected is not None and await is_disconnected():
+                return
+
+            if f is None:
+                try:
+                    f = open(log_file, 'r', errors='replace')
+                    f.seek(0, os.SEEK_END)
+                except FileNotFoundError:
+                    await asyncio.sleep(poll_interval)
+                    continue
+
+            line = f.readline()
+            if line.endswith('\n'):
+                yield partial + line
+                partial = ''
+                continue
+            # Hold back a line the writer has not finished yet
+            partial += line
+
+            await asyncio.sleep(poll_interval)
+            # Detect rotation (a new file at the path) or truncation
+            try:
+                current = os.stat(log_file)
+            except FileNotFoundError:
+                continue
+            opened = os.fstat(f.fileno())
+            if current.st_ino != opened.st_ino or current.st_size < f.tell():
+                # Read anything written to the old file before it was rotated
+                for line in f.readlines():
+                    yield partial + line
+                    partial = ''
+                if partial:
+                    yield partial
+                    partial = ''
+                f.close()
+                f = open(log_file, 'r', errors='replace')
+    finally:
+        if f is not None:
+            f.close()
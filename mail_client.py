@@ -0,0 +1,597 @@
+import base64
+import binascii
+import email
+import imaplib
+import logging
+import quopri
+import re
+import select
+import smtplib
+import socket
+import time
+from email.header import decode_header, make_header
+from email.utils import formataddr, parseaddr
+from html.parser import HTMLParser
+from itertools import takewhile
+
+logger = logging.getLogger(__name__)
+
+_UID_RE = re.compile(rb'UID (\d+)')
+# Tokens of a FETCH response: parentheses, quoted strings, literal markers and atoms
+_FETCH_TOKEN_RE = re.compile(rb'\s*(?:([()])|"((?:[^"\\]|\\.)*)"|\{\d+\}$|([^\s()"]+))', re.S)
+_PARTIAL_RE = re.compile(rb'<\d+>$')
+_BLOCK_TAGS = {'br', 'p', 'div', 'li', 'tr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'pre', 'table'}
+
+
+def to_sequence_set(ids):
+    """Compress message numbers or UIDs into an IMAP sequence set such as '1,2,5:9'"""
+    ranges = []
+    for value in sorted(set(int(i) for i in ids)):
+        if ranges and value == ranges[-1][1] + 1:
+            ranges[-1][1] = value
+        else:
+            ranges.append([value, value])
+    return ','.join(str(start) if start == end else f"{start}:{end}" for start, end in ranges)
+
+
+def chunked(items, size):
+    """Split a list into consecutive chunks of at most size items"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def uid_fetch(mail, uids, items='BODY.PEEK[]'):
+    """
+    Fetch several messages with a single UID FETCH and return (uid, data)
+    pairs in server order.
+    """
+    if not uids:
+        return []
+    status, data = mail.uid('FETCH', to_sequence_set(uids), f'(UID {items})')
+    if status != 'OK':
+        raise imaplib.IMAP4.error(f"UID FETCH failed: {data}")
+
+    messages = []
+    for part in data:
+        if isinstance(part, tuple):
+            match = _UID_RE.search(part[0])
+            messages.append([int(match.group(1)) if match else None, part[1]])
+        elif isinstance(part, bytes) and messages and messages[-1][0] is None:
+            # Some servers (e.g. Gmail) send the UID after the literal
+            match = _UID_RE.search(part)
+            if match:
+                messages[-1][0] = int(match.group(1))
+    return [(uid, body) for uid, body in messages if uid is not None]
+
+
+def decode_header_value(value):
+    """Decode RFC 2047 encoded words (e.g. =?iso-8859-1?q?...?=) in a header value"""
+    if value is None:
+        return None
+    try:
+        return str(make_header(decode_header(str(value))))
+    except (LookupError, UnicodeDecodeError, ValueError):
+        return str(value)
+
+
+def reply_address(value):
+    """
+    A From header as a To header value. decode_header_value() is for
+    storage and display only: an encoded word cannot hold the address, so
+    the display name is decoded and re-encoded and the address left bare.
+    """
+    name, address = parseaddr(str(value or ''))
+    return formataddr((decode_header_value(name) or '', address))
+
+
+def decode_transfer(data, encoding):
+    """Undo a part's Content-Transfer-Encoding; data may be cut off by a size cap"""
+    encoding = (encoding or '7bit').lower()
+    if encoding == 'base64':
+        # Re-pad after dropping line breaks; a cut-off tail may leave an incomplete quantum
+        data = re.sub(rb'[^A-Za-z0-9+/]', b'', data)
+        if len(data) % 4 == 1:
+            data = data[:-1]
+        try:
+            return base64.b64decode(data + b'=' * (-len(data) % 4))
+        except binascii.Error:
+            return b''
+    if encoding == 'quoted-printable':
+        return quopri.decodestring(data)
+    return data
+
+
+def decode_text(payload, charset=None):
+    """Decode a text part with its declared charset, guessing when none is declared or it is unknown"""
+    if charset:
+        try:
+            return payload.decode(charset, errors='replace')
+        except LookupError:
+            logger.debug(f"Unknown charset {charset!r}, guessing")
+    try:
+        return payload.decode('utf-8')
+    except UnicodeDecodeError as e:
+        if e.reason == 'unexpected end of data':
+            # A size cap cut a multi-byte character in half
+            return payload[:e.start].decode('utf-8', errors='replace')
+        # Undeclared 8-bit text is most often Windows-1252
+        return payload.decode('cp1252', errors='replace')
+
+
+class _TextExtractor(HTMLParser):
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style', 'head'):
+            self._skip += 1
+        elif tag in _BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style', 'head'):
+            self._skip = max(self._skip - 1, 0)
+        elif tag in _BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
+
+
+def html_to_text(html):
+    """Plain text of an HTML body, one line per block element"""
+    extractor = _TextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    lines = (' '.join(line.split()) for line in ''.join(extractor.parts).splitlines())
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip()
+
+
+def parse_email(msg):
+    """Extract the fields we care about from a parsed email.message.Message"""
+    # Prefer the first inline text/plain part, else convert the first text/html part
+    body_part = None
+    for content_type in ('text/plain', 'text/html'):
+        for part in msg.walk():
+            if part.get_content_type() == content_type and part.get_content_disposition() != 'attachment':
+                body_part = part
+                break
+        if body_part is not None:
+            break
+
+    message_body = ""
+    if body_part is not None:
+        payload = body_part.get_payload(decode=True)
+        if payload is not None:
+            message_body = decode_text(payload, body_part.get_content_charset())
+            if body_part.get_content_type() == 'text/html':
+                message_body = html_to_text(message_body)
+
+    return {
+        'sender_email': decode_header_value(msg['from']),
+        'reply_address': reply_address(msg['from']),
+        'subject': decode_header_value(msg['subject']),
+        'message_id': msg['Message-ID'],
+        'in_reply_to': msg['In-Reply-To'],
+        'message_body': message_body,
+    }
+
+
+def _fetch_tokens(data):
+    for item in data:
+        if isinstance(item, tuple):
+            # (text ending in a {n} literal marker, literal)
+            yield from _tokenize(item[0])
+            yield 'value', item[1]
+        elif isinstance(item, bytes):
+            yield from _tokenize(item)
+
+
+def _tokenize(text):
+    for match in _FETCH_TOKEN_RE.finditer(text):
+        paren, quoted, atom = match.groups()
+        if paren:
+            yield paren.decode(), None
+        elif quoted is not None:
+            yield 'value', re.sub(rb'\\(.)', rb'\1', quoted)
+        elif atom is not None:
+            yield 'value', None if atom.upper() == b'NIL' else atom
+
+
+def parse_fetch_response(data):
+    """
+    Parse the raw data of a FETCH response (as returned by imaplib) into one
+    dict per message, e.g. {'UID': b'12', 'BODYSTRUCTURE': [...], 'BODY[1]': b'...'}.
+    Lists become Python lists, NIL becomes None, and a partial fetch origin
+    such as the <0> in BODY[1]<0> is dropped from the key.
+    """
+    messages = []
+    stack = []
+    for kind, value in _fetch_tokens(data):
+        if kind == '(':
+            stack.append([])
+        elif kind == ')':
+            if not stack:
+                continue
+            done = stack.pop()
+            if stack:
+                stack[-1].append(done)
+            else:
+                keys = done[0::2]
+                messages.append({_PARTIAL_RE.sub(b'', key).decode().upper(): item
+                                 for key, item in zip(keys, done[1::2]) if isinstance(key, bytes)})
+        elif stack:
+            stack[-1].append(value)
+        # Values outside parentheses are message sequence numbers
+    return messages
+
+
+def _text(value):
+    return value.decode('ascii', errors='replace').lower() if isinstance(value, bytes) else None
+
+
+def walk_bodystructure(node, number=''):
+    """
+    Yield a dict per leaf part of a parsed BODYSTRUCTURE: part (the section
+    number for BODY[...]), type, subtype, params, encoding, size and disposition.
+    Encapsulated messages (message/rfc822) are not descended into.
+    """
+    if node and isinstance(node[0], list):
+        # Multipart: the child parts come first, then the subtype and extension data
+        for index, child in enumerate(takewhile(lambda item: isinstance(item, list), node), 1):
+            yield from walk_bodystructure(child, f"{number}.{index}" if number else str(index))
+        return
+
+    content_type, subtype = _text(node[0]), _text(node[1])
+    params = node[2] if isinstance(node[2], list) else []
+    # Extension data starts after the type-specific fields
+    if content_type == 'text':
+        extension = 8
+    elif content_type == 'message' and subtype == 'rfc822':
+        extension = 10
+    else:
+        extension = 7
+    disposition = node[extension + 1] if len(node) > extension + 1 else None
+    yield {
+        'part': number or '1',
+        'type': content_type,
+        'subtype': subtype,
+        'params': {_text(key): value.decode('ascii', errors='replace')
+                   for key, value in zip(params[0::2], params[1::2]) if isinstance(value, bytes)},
+        'encoding': _text(node[5]),
+        'size': int(node[6]) if node[6] and node[6].isdigit() else 0,
+        'disposition': _text(disposition[0]) if isinstance(disposition, list) and disposition else None,
+    }
+
+
+def select_text_part(structure):
+    """The part holding the message text: the first inline text/plain, else the first inline text/html"""
+    parts = [part for part in walk_bodystructure(structure)
+             if part['type'] == 'text' and part['disposition'] != 'attachment']
+    for subtype in ('plain', 'html'):
+        for part in parts:
+            if part['subtype'] == subtype:
+                return part
+    return None
+
+
+def fetch_text_emails(mail, uids, max_body_bytes=262144, accept=None):
+    """
+    Fetch several messages without downloading their attachments.
+
+    One UID FETCH gets BODYSTRUCTURE and the headers of every message; the
+    text part of each (text/plain, else text/html converted to text) is then
+    fetched with BODY.PEEK[n]<0.max_body_bytes>, one request per distinct
+    part number. Returns (uid, fields) pairs in UID order, where fields are
+    those of parse_email. Messages whose structure cannot be read are
+    fetched whole and parsed the old way. When accept is given, messages
+    for which accept(sender) is false are left out without fetching their text.
+    """
+    if not uids:
+        return []
+    status, data = mail.uid('FETCH', to_sequence_set(uids), '(UID BODYSTRUCTURE BODY.PEEK[HEADER])')
+    if status != 'OK':
+        raise imaplib.IMAP4.error(f"UID FETCH failed: {data}")
+
+    headers = {}
+    parts = {}
+    fallback = []
+    for fields in parse_fetch_response(data):
+        try:
+            uid = int(fields['UID'])
+        except (KeyError, TypeError, ValueError):
+            continue
+        try:
+            header = email.message_from_bytes(fields.get('BODY[HEADER]') or b'')
+            if accept is not None and not accept(decode_header_value(header['from'])):
+                continue
+            parts[uid] = select_text_part(fields['BODYSTRUCTURE'])
+            headers[uid] = header
+        except (KeyError, IndexError, TypeError, AttributeError) as e:
+            logger.warning(f"Could not read the structure of message {uid}, fetching it whole: {e}")
+            fallback.append(uid)
+
+    # Messages with the same text part number share one FETCH
+    by_number = {}
+    for uid, part in parts.items():
+        if part is not None:
+            by_number.setdefault(part['part'], []).append(uid)
+    bodies = {}
+    for number, part_uids in by_number.items():
+        status, data = mail.uid('FETCH', to_sequence_set(part_uids), f'(UID BODY.PEEK[{number}]<0.{max_body_bytes}>)')
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"UID FETCH failed: {data}")
+        for fields in parse_fetch_response(data):
+            if fields.get('UID') is not None:
+                bodies[int(fields['UID'])] = fields.get(f'BODY[{number}]') or b''
+
+    messages = []
+    for uid, header in headers.items():
+        part = parts[uid]
+        message_body = ""
+        if part is not None:
+            raw = bodies.get(uid, b'')
+            if part['size'] > max_body_bytes:
+                logger.info(f"Message {uid}: text part of {part['size']} bytes cut to {max_body_bytes}")
+            message_body = decode_text(decode_transfer(raw, part['encoding']), part['params'].get('charset'))
+            if part['subtype'] == 'html':
+                message_body = html_to_text(message_body)
+        messages.append((uid, {
+            'sender_email': decode_header_value(header['from']),
+            'reply_address': reply_address(header['from']),
+            'subject': decode_header_value(header['subject']),
+            'message_id': header['Message-ID'],
+            'in_reply_to': header['In-Reply-To'],
+            'message_body': message_body,
+        }))
+    for uid, raw_message in uid_fetch(mail, fallback):
+        fields = parse_email(email.message_from_bytes(raw_message))
+        if accept is None or accept(fields['sender_email']):
+            messages.append((uid, fields))
+    return sorted(messages, key=lambda message: message[0])
+
+
+def uid_store(mail, uids, flags, command='+FLAGS'):
+    """Apply flags to several messages with a single UID STORE"""
+    if not uids:
+        return
+    status, data = mail.uid('STORE', to_sequence_set(uids), command, flags)
+    if status != 'OK':
+        raise imaplib.IMAP4.error(f"UID STORE failed: {data}")
+
+
+class ImapSession:
+    """
+    Long-lived IMAP connection to a single mailbox.
+
+    Keeps one logged-in connection open across polling cycles, waits for new
+    mail with IDLE when the server supports it (NOOP polling otherwise) and
+    reconnects with exponential backoff when the connection drops.
+    """
+
+    def __init__(self, host, user, password, mailbox='inbox', port=993,
+                 idle_timeout=300, poll_interval=5, max_backoff=60, use_ssl=True):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.mailbox = mailbox
+        self.port = port
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self.use_ssl = use_ssl
+        self.mail = None
+        self.uidvalidity = None
+        self._backoff = 1
+        # interrupt() writes to this pair to end a wait early (e.g. on shutdown)
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+
+    def connect(self):
+        """
+        Connect, log in and select the mailbox, retrying with backoff until it
+        succeeds. Raises InterruptedError if interrupt() is called meanwhile.
+        """
+        while True:
+            try:
+                logger.info(f"Connecting to IMAP server {self.host}")
+                # Plain IMAP is only meant for local test servers
+                mail = imaplib.IMAP4_SSL(self.host, self.port) if self.use_ssl else imaplib.IMAP4(self.host, self.port)
+                mail.login(self.user, self.password)
+                mail.select(self.mailbox)
+                # UIDs are only comparable across sessions while UIDVALIDITY is unchanged
+                typ, data = mail.response('UIDVALIDITY')
+                self.uidvalidity = int(data[0]) if data and data[0] else None
+                self.mail = mail
+                self._backoff = 1
+                return mail
+            except Exception as e:
+                logger.warning(f"IMAP connection failed: {e}. Retrying in {self._backoff}s")
+                if self._wait_for_wakeup(self._backoff):
+                    raise InterruptedError("IMAP connection attempts interrupted")
+                self._backoff = min(self._backoff * 2, self.max_backoff)
+
+    def ensure_connected(self):
+        """Return a live connection, reconnecting if the previous one was lost"""
+        if self.mail is None:
+            return self.connect()
+        try:
+            self.mail.noop()
+            return self.mail
+        except Exception as e:
+            logger.warning(f"IMAP connection lost: {e}")
+            self.close()
+            return self.connect()
+
+    def supports_idle(self):
+        return self.mail is not None and 'IDLE' in self.mail.capabilities
+
+    def wait_for_changes(self):
+        """
+        Block until the server reports mailbox changes, the wait times out or
+        interrupt() is called. Returns True if the server pushed an update.
+        """
+        # New mail announced during the last cycle (with a FETCH, STORE or
+        # SEARCH response) would otherwise wait for the next IDLE timeout
+        if self._take_pending_changes():
+            return True
+        if self.supports_idle():
+            return self._idle(self.idle_timeout)
+        if self._wait_for_wakeup(self.poll_interval):
+            return False
+        self.mail.noop()
+        return self._take_pending_changes()
+
+    def _take_pending_changes(self):
+        """Pop the EXISTS/RECENT updates imaplib kept from earlier responses; True if there were any"""
+        exists = self.mail.untagged_responses.pop('EXISTS', None)
+        self.mail.untagged_responses.pop('RECENT', None)
+        return bool(exists)
+
+    def interrupt(self):
+        """End the current (or next) wait_for_changes() right away; safe from any thread"""
+        try:
+            self._wakeup_writer.send(b'x')
+        except OSError as e:
+            logger.debug(f"Could not interrupt IMAP wait: {e}")
+
+    def _consume_wakeup(self):
+        try:
+            return bool(self._wakeup_reader.recv(64))
+        except BlockingIOError:
+            return False
+
+    def _wait_for_wakeup(self, timeout):
+        if select.select([self._wakeup_reader], [], [], timeout)[0]:
+            return self._consume_wakeup()
+        return False
+
+    def _idle(self, timeout):
+        # imaplib has no IDLE support before Python 3.14, so speak the
+        # protocol (RFC 2177) directly on the underlying connection
+        mail = self.mail
+        tag = mail._new_tag()
+        mail.send(tag + b' IDLE\r\n')
+        line = mail.readline()
+        if not line.startswith(b'+'):
+            raise imaplib.IMAP4.error(f"IDLE rejected: {line!r}")
+
+        sock = mail.socket()
+        changed = False
+        readable = [sock] if self._buffered() else select.select([sock, self._wakeup_reader], [], [], timeout)[0]
+        if self._wakeup_reader in readable:
+            self._consume_wakeup()
+        elif readable:
+            line = mail.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("connection closed during IDLE")
+            logger.debug(f"IDLE update: {line!r}")
+            changed = True
+
+        mail.send(b'DONE\r\n')
+        # Consume untagged updates until the tagged completion of IDLE
+        while True:
+            line = mail.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("connection closed while ending IDLE")
+            if line.startswith(tag):
+                break
+        return changed
+
+    def _buffered(self):
+        """
+        Whether a response was already read off the socket, into imaplib's
+        buffered file or the TLS layer, where select() cannot see it
+        """
+        sock = self.mail.socket()
+        if getattr(sock, 'pending', lambda: 0)():
+            return True
+        timeout = sock.gettimeout()
+        # Non-blocking for one peek: it returns what is buffered without waiting for more
+        sock.settimeout(0)
+        try:
+            return bool(self.mail.file.peek())
+        except (OSError, ValueError):
+            return False
+        finally:
+            sock.settimeout(timeout)
+
+    def close(self):
+        if self.mail is not None:
+            try:
+                self.mail.logout()
+            except Exception as e:
+                logger.error(f"Error closing IMAP connection: {e}")
+            self.mail = None
+
+
+class SmtpSession:
+    """
+    Persistent SMTP connection that is reused across batches.
+
+    Connections idle longer than keepalive seconds are checked with NOOP
+    before use, and a dropped connection is re-established once per send.
+    """
+
+    def __init__(self, host, port, user, password, keepalive=60, starttls=True):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.keepalive = keepalive
+        self.starttls = starttls
+        self.server = None
+        self._last_used = 0
+
+    def connect(self):
+        logger.info(f"Connecting to SMTP server {self.host}")
+        server = smtplib.SMTP(self.host, self.port)
+        if self.starttls:
+            server.starttls()
+        server.login(self.user, self.password)
+        self.server = server
+        self._last_used = time.monotonic()
+        return server
+
+    def _ensure_connected(self):
+        if self.server is None:
+            return self.connect()
+        if time.monotonic() - self._last_used > self.keepalive:
+            try:
+                status, _ = self.server.noop()
+                if status != 250:
+                    raise smtplib.SMTPServerDisconnected(f"NOOP returned {status}")
+            except (smtplib.SMTPException, OSError) as e:
+                logger.info(f"SMTP connection went stale ({e}), reconnecting")
+                self._drop()
+                return self.connect()
+        return self.server
+
+    def send_message(self, msg):
+        try:
+            result = self._ensure_connected().send_message(msg)
+        except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+            logger.warning(f"SMTP connection lost ({e}), retrying once")
+            self._drop()
+            result = self.connect().send_message(msg)
+        self._last_used = time.monotonic()
+        return result
+
+    def _drop(self):
+        try:
+            if self.server is not None:
+                self.server.close()
+        finally:
+            self.server = None
+
+    def quit(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception as e:
+                logger.error(f"Error closing SMTP connection: {e}")
+            self.server = None
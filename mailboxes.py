@@ -0,0 +1,168 @@
+"""
+Support inboxes served by the worker processes.
+
+Mailboxes are listed in MAILBOXES_FILE (YAML):
+
+    mailboxes:
+      - name: billing
+        email: billing@example.com
+        password_env: BILLING_PASSWORD    # or password: ...
+        imap_server: imap.example.com     # defaults: IMAP_SERVER/IMAP_PORT/SMTP_SERVER/SMTP_PORT
+        folder: inbox
+        senders: [customer@example.com]   # only answer these senders; omit to answer everyone
+        shards: 2                         # split the mailbox's senders across 2 workers
+
+Without the file, the single account from EMAIL/PASSWORD is served and
+only mail from MONITORED_EMAIL (comma separated; empty for everyone) is
+answered.
+
+A mailbox with shards > 1 is served by that many independent workers. Each
+worker only handles the senders whose normalized address hashes to its
+shard, so all emails of a customer go to the same worker, in order. A
+session can still span shards, since thread_index links sessions by subject
+across senders, and emails of such a session from different senders are
+not ordered with each other. The merges themselves are serialized between
+workers by named locks on the thread keys and on the sessions being merged
+(thread_index.locked_thread_keys and lock_sessions). Shards keep their own IMAP
+checkpoint and job partition, keyed by Mailbox.key.
+"""
+
+import logging
+import os
+import zlib
+
+import yaml
+from dotenv import load_dotenv
+
+from thread_index import extract_email_address
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+MAILBOXES_FILE = os.getenv('MAILBOXES_FILE', 'mailboxes.yml')
+MONITORED_EMAIL = os.getenv('MONITORED_EMAIL', 'mtembhare50@gmail.com')
+
+
+class Mailbox:
+    """One IMAP/SMTP account (or one shard of it) and the senders it answers"""
+
+    def __init__(self, name, email, password, imap_server, imap_port=993, smtp_server=None, smtp_port=587,
+                 folder='inbox', senders=(), shard=0, shards=1):
+        self.name = name
+        self.email = email
+        self.password = password
+        self.imap_server = imap_server
+        self.imap_port = int(imap_port)
+        self.smtp_server = smtp_server or imap_server
+        self.smtp_port = int(smtp_port)
+        self.folder = folder
+        self.senders = [sender.strip() for sender in senders if sender and sender.strip()]
+        self.shard = shard
+        self.shards = shards
+
+    @property
+    def key(self):
+        """Identifies the mailbox (and shard) in IMAP checkpoints and email_jobs"""
+        key = f"{self.email}/{self.folder}"
+        return key if self.shards == 1 else f"{key}#{self.shard}/{self.shards}"
+
+    def split(self):
+        """One Mailbox per shard"""
+        return [Mailbox(self.name, self.email, self.password, self.imap_server, self.imap_port,
+                        self.smtp_server, self.smtp_port, self.folder, self.senders, shard, self.shards)
+                for shard in range(self.shards)]
+
+    def owns(self, sender_email):
+        """Whether this shard answers mail from sender_email"""
+        if self.shards == 1:
+            return True
+        address = extract_email_address(sender_email or '')
+        return zlib.crc32(address.encode()) % self.shards == self.shard
+
+    def search_criteria(self, last_uid=0):
+        """IMAP SEARCH for unanswered mail from the monitored senders, above last_uid"""
+        criteria = ['UNSEEN']
+        if last_uid:
+            criteria.insert(0, f'UID {last_uid + 1}:*')
+        if self.senders:
+            criteria.append(_any_sender(self.senders))
+        criteria.append('NOT KEYWORD "Processed-By-System"')
+        return f"({' '.join(criteria)})"
+
+    def __repr__(self):
+        return f"Mailbox({self.name!r}, {self.key!r})"
+
+
+def _any_sender(senders):
+    # OR takes exactly two keys: OR FROM "a" OR FROM "b" FROM "c"
+    if len(senders) == 1:
+        return f'FROM "{senders[0]}"'
+    return f'OR FROM "{senders[0]}" {_any_sender(senders[1:])}'
+
+
+def default_mailbox():
+    """The single mailbox configured through EMAIL/PASSWORD and friends"""
+    return Mailbox(
+        name='default',
+        email=os.getenv('EMAIL'),
+        password=os.getenv('PASSWORD'),
+        imap_server=os.getenv('IMAP_SERVER'),
+        imap_port=os.getenv('IMAP_PORT', '993'),
+        smtp_server=os.getenv('SMTP_SERVER'),
+        smtp_port=os.getenv('SMTP_PORT', '587'),
+        senders=MONITORED_EMAIL.split(','),
+    )
+
+
+def load_mailboxes(path=MAILBOXES_FILE):
+    """All configured mailboxes (not yet split into shards)"""
+    if not os.path.exists(path):
+        return [default_mailbox()]
+    with open(path, 'r') as file:
+        config = yaml.safe_load(file) or {}
+
+    mailboxes = []
+    for index, entry in enumerate(config.get('mailboxes') or []):
+        name = entry.get('name') or entry.get('email') or f"mailbox-{index}"
+        password = entry.get('password')
+        if password is None and entry.get('password_env'):
+            password = os.getenv(entry['password_env'])
+        if not entry.get('email') or password is None:
+            raise ValueError(f"Mailbox {name} in {path} needs an email and a password (or password_env)")
+        senders = entry.get('senders') or []
+        if isinstance(senders, str):
+            senders = senders.split(',')
+        shards = int(entry.get('shards', 1))
+        if shards < 1:
+            raise ValueError(f"Mailbox {name} in {path}: shards must be at least 1")
+        mailboxes.append(Mailbox(
+            name=name,
+            email=entry['email'],
+            password=password,
+            imap_server=entry.get('imap_server') or os.getenv('IMAP_SERVER'),
+            imap_port=entry.get('imap_port') or os.getenv('IMAP_PORT', '993'),
+            smtp_server=entry.get('smtp_server') or os.getenv('SMTP_SERVER'),
+            smtp_port=entry.get('smtp_port') or os.getenv('SMTP_PORT', '587'),
+            folder=entry.get('folder', 'inbox'),
+            senders=senders,
+            shards=shards,
+        ))
+    if not mailboxes:
+        raise ValueError(f"No mailboxes listed in {path}")
+    keys = [f"{mailbox.email}/{mailbox.folder}" for mailbox in mailboxes]
+    if len(set(keys)) != len(keys):
+        raise ValueError(f"The same email/folder is listed twice in {path}")
+    logger.info(f"Loaded {len(mailboxes)} mailbox(es) from {path}")
+    return mailboxes
+
+
+def assign_mailboxes(mailboxes, processes):
+    """
+    Split the mailboxes into shards and spread them over at most processes
+    workers, round-robin, so the shards of one mailbox land on different
+    workers. Returns one list of Mailbox per worker.
+    """
+    units = [shard for mailbox in mailboxes for shard in mailbox.split()]
+    processes = max(1, min(processes, len(units)))
+    return [units[index::processes] for index in range(processes)]
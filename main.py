@@ -1,268 +1,548 @@
-import smtplib
-import imaplib
-import email
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.utils import make_msgid
+import signal
+import threading
 import time
 import os
 from dotenv import load_dotenv
-from database import save_email, display_emails, check_message_processed
+from database import (save_email, display_emails, check_message_processed, ensure_schema,
+                      get_imap_checkpoint, save_imap_checkpoint, get_session_history)
+from pipeline import EmailPipeline
+from job_queue import (WORKER_ID, LeaseHeartbeat, advance_job, claim_job, finish_jobs, oldest_unfinished_uid,
+                       release_job, renew_lease)
+from llm import generate, select_model, FALLBACK_REPLY, OLLAMA_MODEL
+from prompts import SYSTEM_PROMPT, SessionContextCache, build_prompt
+from reply_cache import ReplyCache
+from email_writer import EmailWriter
+from metrics import STAGE_SECONDS, MetricsPublisher, Trace, counter, gauge
+from mail_client import ImapSession, SmtpSession, chunked, fetch_text_emails, to_sequence_set, uid_store
+from mailboxes import default_mailbox, load_mailboxes
+from thread_index import extract_email_address
 import yaml
 import logging
-import requests
+from logging.handlers import RotatingFileHandler
 import json
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("email_service.log"),
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger(__name__)
-
 # Load environment variables
 load_dotenv()
 
-# Email credentials from environment variables
-EMAIL = os.getenv('EMAIL')
-PASSWORD = os.getenv('PASSWORD')
-SMTP_SERVER = os.getenv('SMTP_SERVER')
-IMAP_SERVER = os.getenv('IMAP_SERVER')
-SMTP_PORT = int(os.getenv('SMTP_PORT'))
-IMAP_PORT = int(os.getenv('IMAP_PORT'))
+logger = logging.getLogger(__name__)
+
+# Accounts and monitored senders are configured per mailbox, see mailboxes.py
+
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+TEMPLATES_FILE = os.getenv('TEMPLATES_FILE', 'templates.yml')
+
+# Pipeline concurrency: generation workers, SMTP connections, and the maximum
+# number of fetched emails waiting in the generation/send stages. Requests to
+# the model server are further limited by LLM_MAX_IN_FLIGHT; workers beyond
+# that wait in the scheduler, which admits the oldest emails first
+GENERATION_WORKERS = int(os.getenv('GENERATION_WORKERS', '8'))
+SMTP_WORKERS = int(os.getenv('SMTP_WORKERS', '1'))
+PIPELINE_MAX_PENDING = int(os.getenv('PIPELINE_MAX_PENDING', '100'))
+
+# Long-lived IMAP session: seconds to wait in IDLE before re-checking, and the
+# NOOP polling interval used when the server does not support IDLE
+IMAP_IDLE_TIMEOUT = int(os.getenv('IMAP_IDLE_TIMEOUT', '300'))
+IMAP_POLL_INTERVAL = int(os.getenv('IMAP_POLL_INTERVAL', '5'))
+SMTP_KEEPALIVE = int(os.getenv('SMTP_KEEPALIVE', '60'))
+
+# Number of messages fetched/flagged per IMAP round-trip
+IMAP_FETCH_BATCH = int(os.getenv('IMAP_FETCH_BATCH', '50'))
+# Bytes of an email's text part downloaded at most; attachments are never downloaded
+IMAP_MAX_BODY_BYTES = int(os.getenv('IMAP_MAX_BODY_BYTES', '262144'))
+
+# Seconds between health reports of a worker process to its supervisor
+WORKER_HEALTH_INTERVAL = int(os.getenv('WORKER_HEALTH_INTERVAL', '15'))
+
+# Shared by all generation workers
+reply_cache = ReplyCache()
+session_contexts = SessionContextCache()
+# Sent replies are stored in batches off the SMTP threads
+reply_writer = EmailWriter()
+
+EMAILS_PROCESSED = counter('email_processed_total', "Emails finished, by outcome")
+EMAILS_SKIPPED = counter('email_skipped_total', "Fetched emails that needed no work, by reason")
+FALLBACK_REPLIES = counter('email_fallback_replies_total', "Replies sent from a fallback template")
+REPLY_CACHE_HITS = counter('email_reply_cache_hits_total', "Replies reused from the reply cache")
+PIPELINE_PENDING = gauge('email_pipeline_pending', "Emails in the generation/send stages")
 
-def load_email_templates():
-    """Load email templates from YAML file"""
+# Fallback template in case the file can't be loaded
+DEFAULT_TEMPLATES = {
+    "default_reply": {
+        "subject": "Re: {subject}",
+        "body": "Thank you for your email. We have received your message and will respond shortly.\n\nYour message:\n{message_preview}..."
+    }
+}
+
+# (path, mtime, templates) of the last successful load
+_templates_cache = (None, None, None)
+_templates_lock = threading.Lock()
+
+def configure_logging():
+    """Log to the console and to email_service.log; the log file is rotated so it cannot grow without bound"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            RotatingFileHandler("email_service.log", maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT),
+            logging.StreamHandler()
+        ]
+    )
+
+def load_email_templates(path=TEMPLATES_FILE):
+    """
+    Load email templates from the YAML file. The parsed templates are cached
+    and the file is only read again when its modification time changes.
+    """
+    global _templates_cache
     try:
-        with open('templates.yml', 'r') as file:
-            return yaml.safe_load(file)
+        mtime = os.stat(path).st_mtime_ns
+        cached_path, cached_mtime, templates = _templates_cache
+        if cached_path == path and cached_mtime == mtime:
+            return templates
+        with _templates_lock:
+            with open(path, 'r') as file:
+                templates = yaml.safe_load(file)
+            _templates_cache = (path, mtime, templates)
+        logger.info(f"Loaded email templates from {path}")
+        return templates
     except Exception as e:
         logger.error(f"Error loading templates: {e}")
-        # Fallback template in case file can't be loaded
-        return {
-            "default_reply": {
-                "subject": "Re: {subject}",
-                "body": "Thank you for your email. We have received your message and will respond shortly.\n\nYour message:\n{message_preview}..."
-            }
-        }
-
-def read_emails():
+        # Keep using the last version that loaded
+        cached_path, _, templates = _templates_cache
+        return templates if cached_path == path else DEFAULT_TEMPLATES
+
+def bootstrap():
+    """One-time start-up of the worker process: logging and the schema check"""
+    configure_logging()
+    ensure_schema()
+
+def connect_smtp(mailbox):
+    """Open a persistent, self-reconnecting SMTP session for the mailbox's account"""
+    smtp_session = SmtpSession(mailbox.smtp_server, mailbox.smtp_port, mailbox.email, mailbox.password,
+                               keepalive=SMTP_KEEPALIVE)
+    smtp_session.connect()
+    return smtp_session
+
+def generate_stage(job):
+    """Pipeline generation stage: produce and persist the AI reply for a saved job"""
+    if job.get('state') == 'generated':
+        # Resumed after a restart; the reply was generated before
+        return job['reply']
+    logger.info(f"Creating AI-generated reply for {job['message_id']}...")
+    with job['trace'].span('generate'):
+        reply = generate_email_reply(job['sender_email'], job['subject'], job['message_body'],
+                                     job['session_id'], job['message_id'], job.get('enqueued_at'))
+    # The reply's Message-ID is fixed now so a re-send after a crash reuses it
+    job['reply_message_id'] = make_msgid(domain=job['mailbox'].email.split('@')[1])
+    with job['trace'].span('persist_reply'):
+        advanced = advance_job(job['message_id'], 'generated', reply=reply, reply_message_id=job['reply_message_id'])
+    if not advanced:
+        raise RuntimeError(f"Lease on job {job['message_id']} was lost during generation")
+    job['state'] = 'generated'
+    return reply
+
+def reply_subject(subject):
+    return f"Re: {subject}" if not subject.startswith("Re:") else subject
+
+def reply_row(job):
+    """The emails row of a job's sent reply, as queued on reply_writer"""
+    return {
+        'sender_email': job['mailbox'].email,
+        'message_id': job['reply_message_id'].strip('<>'),
+        'in_reply_to': job['message_id'],
+        'subject': reply_subject(job['subject']),
+        'message': job['reply'],
+        'role': 'host',
+        'session_id': job['session_id'],
+    }
+
+def send_stage(smtp_server, job):
+    """Pipeline send stage: build, send and store the reply for a generated job"""
+    sender_email = job['sender_email']
+    subject = job['subject']
+    message_id = job['message_id']
+    in_reply_to = job['in_reply_to']
+    ai_reply = job['reply']
+
+    # Create reply message
+    reply_msg = MIMEMultipart()
+    reply_msg['From'] = job['mailbox'].email
+    reply_msg['To'] = job['reply_address']
+
+    # Set subject
+    reply_msg['Subject'] = reply_subject(subject)
+
+    # Message-ID persisted with the generated reply
+    reply_message_id = job['reply_message_id']
+    reply_msg['Message-ID'] = reply_message_id
+
+    # Set threading headers
+    if in_reply_to:
+        reply_msg['In-Reply-To'] = in_reply_to
+        reply_msg['References'] = in_reply_to
+    else:
+        reply_msg['In-Reply-To'] = message_id
+        reply_msg['References'] = message_id
+
+    # Attach the AI-generated reply
+    reply_msg.attach(MIMEText(ai_reply, 'plain'))
+
+    # Make sure no other worker has taken over the job before sending
+    if not renew_lease(message_id):
+        raise RuntimeError(f"Lease on job {message_id} was lost before sending")
+
+    # Send the reply
+    logger.info(f"Sending AI-generated reply to {sender_email}")
+    with job['trace'].span('send'):
+        smtp_server.send_message(reply_msg)
+    logger.info("AI reply sent successfully")
+
+    # Queue the reply for the database. The job is only flagged once the row is
+    # written; until then it can be rebuilt from the job row (see read_emails)
+    reply_writer.write(reply_row(job))
+    advance_job(message_id, 'sent')
+    job['state'] = 'sent'
+
+def create_pipeline(mailbox):
+    """Build the generation/send pipeline of a mailbox with the configured concurrency"""
+    pipeline = EmailPipeline(
+        generate=generate_stage,
+        send=send_stage,
+        connect_smtp=lambda: connect_smtp(mailbox),
+        generation_workers=GENERATION_WORKERS,
+        smtp_workers=SMTP_WORKERS,
+        max_pending=PIPELINE_MAX_PENDING,
+    )
+    PIPELINE_PENDING.set_function(pipeline.pending, mailbox=mailbox.key)
+    return pipeline
+
+def create_imap_session(mailbox):
+    """Build the long-lived IMAP session for a support inbox"""
+    return ImapSession(mailbox.imap_server, mailbox.email, mailbox.password, mailbox=mailbox.folder,
+                       port=mailbox.imap_port, idle_timeout=IMAP_IDLE_TIMEOUT, poll_interval=IMAP_POLL_INTERVAL)
+
+def read_emails(imap_session=None, pipeline=None, mailbox=None, stop=None):
+    """
+    Process new emails of a mailbox (by default the one configured through
+    EMAIL) once. When called without a session and pipeline fresh ones are
+    opened and closed again; run_live passes its long-lived ones instead.
+    Once stop is set no further batches are fetched; what is in flight is
+    finished and the checkpoint only covers the batches that were handled.
+    """
+    mailbox = mailbox or default_mailbox()
+    owns_session = imap_session is None
+    owns_pipeline = pipeline is None
+    heartbeat = None
+    processed_jobs = []
     try:
-        # Specify which email address to monitor
-        monitored_email = "mtembhare50@gmail.com"  # You can change this or load from config
-        
-        logger.info(f"Checking for new emails from {monitored_email}...")
+        logger.info(f"Checking {mailbox.key} for new emails...")
         
         # Load email templates
         templates = load_email_templates()
         
         # Connect to IMAP server
-        mail = imaplib.IMAP4_SSL(IMAP_SERVER)
-        mail.login(EMAIL, PASSWORD)
-        mail.select('inbox')
-
-        # Search for unread emails from specific sender that don't have our custom flag
-        search_criteria = f'(UNSEEN FROM "{monitored_email}" NOT KEYWORD "Processed-By-System")'
-        status, messages = mail.search(None, search_criteria)
-        email_ids = messages[0].split()
+        if owns_session:
+            imap_session = create_imap_session(mailbox)
+            imap_session.connect()
+        mail = imap_session.mail
+
+        # Search for unread emails from the monitored senders that don't have our custom flag.
+        # With a valid checkpoint only UIDs above the last fully processed one are searched.
+        checkpoint_key = mailbox.key
+        checkpoint = get_imap_checkpoint(checkpoint_key)
+        last_uid = 0
+        if checkpoint and imap_session.uidvalidity is not None and checkpoint[0] == imap_session.uidvalidity:
+            last_uid = checkpoint[1]
+        elif checkpoint:
+            logger.info(f"UIDVALIDITY changed for {checkpoint_key}, running a full search")
+
+        with STAGE_SECONDS.time(stage='imap_search'):
+            status, messages = mail.uid('SEARCH', None, mailbox.search_criteria(last_uid))
+        # 'n:*' always matches the newest message, even when its UID is below n
+        email_uids = [int(uid) for uid in messages[0].split() if int(uid) > last_uid]
         
-        if not email_ids:
+        if not email_uids:
             logger.info("No new emails found.")
             return
             
-        logger.info(f"Found {len(email_ids)} new email(s) from {monitored_email}")
-        
-        # Connect to SMTP server
-        smtp_server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        smtp_server.starttls()
-        smtp_server.login(EMAIL, PASSWORD)
+        logger.info(f"Found {len(email_uids)} new email(s) in {mailbox.key}")
+
+        failed_uids = []
+
+        def mark_processed(job):
+            if job.get('error'):
+                logger.warning(f"Email {job['uid']} not marked as processed due to earlier error")
+                failed_uids.append(job['uid'])
+                # Any worker may pick it up again from its last persisted state
+                release_job(job['message_id'], job['error'])
+                EMAILS_PROCESSED.inc(outcome='failed')
+                job['trace'].finish('failed')
+            else:
+                processed_jobs.append(job)
+
+        def flush_processed():
+            if not processed_jobs:
+                return
+            # Only flag jobs whose reply row is stored; the others stay 'sent' and store it again when resumed
+            reply_writer.flush()
+            unsaved = reply_writer.take_failed([reply_row(job)['message_id'] for job in processed_jobs])
+            for job in [job for job in processed_jobs if reply_row(job)['message_id'] in unsaved]:
+                processed_jobs.remove(job)
+                job['error'] = f"Reply {job['reply_message_id']} could not be stored"
+                mark_processed(job)
+            # IMAP flags are only touched from this (the fetch) thread, one STORE per batch
+            if processed_jobs:
+                with STAGE_SECONDS.time(stage='imap_flag'):
+                    uid_store(mail, [job['uid'] for job in processed_jobs], '(Processed-By-System)')
+                finish_jobs([job['message_id'] for job in processed_jobs])
+                logger.info(f"Marked {len(processed_jobs)} email(s) as processed")
+                for job in processed_jobs:
+                    EMAILS_PROCESSED.inc(outcome='replied')
+                    job['trace'].finish('replied')
+                del processed_jobs[:]
 
-        for email_id in email_ids:
+        if owns_pipeline:
+            pipeline = create_pipeline(mailbox)
+            heartbeat = LeaseHeartbeat().start()
+
+        first_unfetched_uid = None
+        for uid_chunk in chunked(email_uids, IMAP_FETCH_BATCH):
+            if stop is not None and stop.is_set():
+                logger.info(f"Stopping: leaving emails from UID {uid_chunk[0]} of {mailbox.key} for later")
+                first_unfetched_uid = uid_chunk[0]
+                break
             try:
-                logger.info(f"Processing email ID: {email_id.decode()}")
-                status, msg_data = mail.fetch(email_id, '(BODY.PEEK[])')
-                for response_part in msg_data:
-                    if isinstance(response_part, tuple):
-                        msg = email.message_from_bytes(response_part[1])
-                        sender_email = msg['from']
-                        subject = msg['subject']
-                        message_id = msg['Message-ID']
-                        in_reply_to = msg['In-Reply-To']
-                        
-                        logger.info(f"Processing email - Subject: {subject}, From: {sender_email}")
+                seen_uids = []
+                # Other shards' senders are skipped before their text is downloaded
+                with STAGE_SECONDS.time(stage='imap_fetch'):
+                    fetched = fetch_text_emails(mail, uid_chunk, IMAP_MAX_BODY_BYTES, accept=mailbox.owns)
+                for uid, job in fetched:
+                    claim = None
+                    try:
+                        logger.info(f"Processing email UID: {uid}")
+                        job['uid'] = uid
+                        job['mailbox'] = mailbox
+                        # Older emails are sent to the model first when generation is backlogged
+                        job['enqueued_at'] = time.time()
+                        message_id = job['message_id']
+                        job['trace'] = trace = Trace(message_id, uid=uid, mailbox=checkpoint_key)
                         
-                        # Get message body
-                        message_body = ""
-                        if msg.is_multipart():
-                            for part in msg.walk():
-                                if part.get_content_type() == 'text/plain':
-                                    payload = part.get_payload(decode=True)
-                                    if payload is not None:
-                                        message_body = payload.decode('utf-8', errors='replace')
-                                    break
-                        else:
-                            payload = msg.get_payload(decode=True)
-                            if payload is not None:
-                                message_body = payload.decode('utf-8', errors='replace')
+                        logger.info(f"Processing email - Subject: {job['subject']}, From: {job['sender_email']}")
                         
-                        # Check if we've already processed this message_id
-                        if check_message_processed(message_id):
+                        # Claim the job; it may be finished already or in progress on another worker
+                        with trace.span('claim'):
+                            claim = claim_job(message_id, checkpoint_key, imap_session.uidvalidity, uid)
+                        if claim is None:
+                            logger.info(f"Email with Message-ID {message_id} is done or claimed by another worker. Skipping.")
+                            EMAILS_SKIPPED.inc(reason='claimed')
+                            continue
+
+                        # Emails handled before the job table existed
+                        if claim['attempts'] == 1 and check_message_processed(message_id):
                             logger.info(f"Email with Message-ID {message_id} already processed. Skipping.")
                             # Optionally mark as read to avoid future processing
-                            mail.store(email_id, '+FLAGS', '\\Seen')
+                            seen_uids.append(uid)
+                            finish_jobs([message_id])
+                            EMAILS_SKIPPED.inc(reason='already_processed')
                             continue
-                        
-                        # Save to database
-                        logger.info(f"Saving email from {sender_email} to database")
-                        save_email(sender_email, message_id, in_reply_to, subject, message_body, 'user')
-                        
-                        # Create reply message
-                        logger.info("Creating AI-generated reply...")
-                        reply_msg = MIMEMultipart()
-                        reply_msg['From'] = EMAIL
-                        reply_msg['To'] = sender_email
-                        
-                        # Generate AI reply
-                        ai_reply = generate_email_reply(sender_email, subject, message_body)
-                        
-                        # Set subject
-                        reply_subject = f"Re: {subject}" if not subject.startswith("Re:") else subject
-                        reply_msg['Subject'] = reply_subject
-                        
-                        # Generate Message-ID for reply
-                        domain = EMAIL.split('@')[1]
-                        reply_message_id = make_msgid(domain=domain)
-                        reply_msg['Message-ID'] = reply_message_id
-                        
-                        # Set threading headers
-                        if in_reply_to:
-                            reply_msg['In-Reply-To'] = in_reply_to
-                            reply_msg['References'] = in_reply_to
-                        else:
-                            reply_msg['In-Reply-To'] = message_id
-                            reply_msg['References'] = message_id
-                        
-                        # Attach the AI-generated reply
-                        reply_msg.attach(MIMEText(ai_reply, 'plain'))
-                        
-                        # Send the reply
-                        logger.info(f"Sending AI-generated reply to {sender_email}")
-                        smtp_server.send_message(reply_msg)
-                        logger.info("AI reply sent successfully")
-                        
-                        # Save the reply to the database
-                        logger.info("Saving AI reply to database")
-                        clean_reply_id = reply_message_id.strip('<>')
-                        save_email(EMAIL, clean_reply_id, message_id, reply_msg['Subject'], ai_reply, 'host')
-                        logger.info("AI reply saved to database")
-                        
-                        # After successful processing, mark with our custom flag
-                        mail.store(email_id, '+FLAGS', '(Processed-By-System)')
-                        logger.info(f"Marked email {email_id.decode()} as processed")
+                        job.update(claim)
+
+                        if job['state'] == 'fetched':
+                            # Save to database
+                            logger.info(f"Saving email from {job['sender_email']} to database")
+                            with trace.span('save'):
+                                session_id = save_email(job['sender_email'], message_id, job['in_reply_to'],
+                                                        job['subject'], job['message_body'], 'user')
+                                job['session_id'] = session_id or message_id
+                                advanced = advance_job(message_id, 'saved', session_id=job['session_id'])
+                            if not advanced:
+                                # Another worker took over; drop our claim so a later copy is not skipped
+                                release_job(message_id)
+                                EMAILS_SKIPPED.inc(reason='claimed')
+                                continue
+                            job['state'] = 'saved'
+
+                        if job['state'] == 'sent':
+                            # The reply went out before a restart; its row may not have been written
+                            reply_writer.write(reply_row(job))
+                            processed_jobs.append(job)
+                            continue
+
+                        # Hand off to the generation/send stages
+                        pipeline.submit(job)
+
+                    except Exception as e:
+                        logger.error(f"Failed to process email {uid}: {str(e)}", exc_info=True)
+                        failed_uids.append(uid)
+                        EMAILS_PROCESSED.inc(outcome='failed')
+                        if claim is not None:
+                            release_job(message_id, e)
+
+                uid_store(mail, seen_uids, '\\Seen')
                             
             except Exception as e:
-                logger.error(f"Failed to process email {email_id}: {str(e)}", exc_info=True)
+                logger.error(f"Failed to fetch emails {to_sequence_set(uid_chunk)}: {str(e)}", exc_info=True)
+                failed_uids.extend(uid_chunk)
                 continue
 
+            # Flag whatever has already finished while we keep fetching
+            for job in pipeline.completed():
+                mark_processed(job)
+            flush_processed()
+
+        # Wait for the remaining replies before the next cycle
+        pipeline.drain(mark_processed)
+        flush_processed()
+        # Make this cycle's replies visible as history to the next one
+        reply_writer.flush()
+
+        # Advance the checkpoint past everything handled; failed emails are retried next cycle,
+        # and so are emails another worker has not finished yet (it may have died)
+        new_last_uid = min(failed_uids) - 1 if failed_uids else max(email_uids)
+        if first_unfetched_uid is not None:
+            new_last_uid = min(new_last_uid, first_unfetched_uid - 1)
+        unfinished_uid = oldest_unfinished_uid(checkpoint_key, imap_session.uidvalidity)
+        if unfinished_uid is not None:
+            new_last_uid = min(new_last_uid, unfinished_uid - 1)
+        if imap_session.uidvalidity is not None and (new_last_uid > last_uid or not checkpoint):
+            save_imap_checkpoint(checkpoint_key, imap_session.uidvalidity, new_last_uid)
+
     except Exception as e:
         logger.error(f"Email processing failed: {str(e)}", exc_info=True)
+        # Replied emails whose flag was not stored are handed back, so they are flagged next time they are seen
+        for job in processed_jobs:
+            release_job(job['message_id'], e)
     finally:
         try:
-            if 'mail' in locals():
-                mail.logout()
-            if 'smtp_server' in locals():
-                smtp_server.quit()
+            if owns_pipeline and pipeline is not None:
+                pipeline.close()
+            if heartbeat is not None:
+                heartbeat.stop()
+            if owns_session and imap_session is not None:
+                imap_session.close()
         except Exception as e:
             logger.error(f"Error closing connections: {str(e)}")
 
-def run_live():
-    logger.info("Starting email monitoring service")
-    while True:
-        try:
-            read_emails()
-            time.sleep(1)
-        except Exception as e:
-            logger.error(f"Error in run_live: {e}", exc_info=True)
-            time.sleep(5)
-
-def ask_ollama(prompt, model="llama2", max_retries=3, timeout=60):
-    """Send a prompt to Ollama and get a response"""
-    url = "http://localhost:11434/api/generate"
-    data = {
-        "model": model,
-        "prompt": prompt,
-        "stream": False  # Set to True if you want streaming responses
-    }
-    
-    retries = 0
-    while retries < max_retries:
-        try:
-            logger.info(f"Sending prompt to Ollama model: {model}")
-            response = requests.post(url, json=data, timeout=timeout)
-            response.raise_for_status()  # Raise exception for HTTP errors
-            
-            result = response.json()
-            logger.info("Successfully received response from Ollama")
-            return result.get("response", "")
-        except requests.exceptions.RequestException as e:
-            retries += 1
-            logger.warning(f"Ollama request failed (attempt {retries}/{max_retries}): {e}")
-            if retries < max_retries:
-                time.sleep(2)  # Wait before retrying
-            else:
-                logger.error(f"Failed to get response from Ollama after {max_retries} attempts")
-                return "Thank you for your email. We'll get back to you shortly."
+def run_live(mailbox, stop, imap_session=None, status=None):
+    """
+    Serve one mailbox until stop is set: process new mail, then wait for
+    more. status (a dict) is kept up to date for health reports.
+    """
+    logger.info(f"Starting email monitoring of {mailbox.key}")
+    status = status if status is not None else {}
+    imap_session = imap_session or create_imap_session(mailbox)
+    pipeline = create_pipeline(mailbox)
+    try:
+        while not stop.is_set():
+            try:
+                status['state'] = 'connecting'
+                imap_session.ensure_connected()
+                status['state'] = 'processing'
+                read_emails(imap_session, pipeline, mailbox, stop)
+                status.update(state='idle', last_cycle=time.time(), last_error=None)
+                if not stop.is_set():
+                    # Block until the server pushes new mail (IDLE), the poll interval passes or we stop
+                    imap_session.wait_for_changes()
+            except Exception as e:
+                logger.error(f"Error in run_live for {mailbox.key}: {e}", exc_info=True)
+                status.update(state='error', last_error=str(e))
+                imap_session.close()
+                stop.wait(5)
+    finally:
+        status['state'] = 'stopped'
+        pipeline.close()
+        imap_session.close()
+        logger.info(f"Stopped email monitoring of {mailbox.key}")
+
+def run_worker(mailboxes, stop=None, report=None):
+    """
+    Serve several mailboxes (or shards) in this process, one thread each,
+    until stop is set or SIGTERM/SIGINT arrives. Then no new batches are
+    fetched, the emails in flight are finished, and everything is closed
+    (graceful drain). report, if given, is called every
+    WORKER_HEALTH_INTERVAL seconds with a health dict.
+    """
+    stop = stop or threading.Event()
+    # Handlers only set a local event; setting a multiprocessing.Event from a
+    # signal handler can deadlock with a wait() in the same thread
+    signalled = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: signalled.set())
+
+    # Keep claimed jobs leased for as long as they sit in the pipelines
+    heartbeat = LeaseHeartbeat().start()
+    # Make this worker's metrics visible to the API's /metrics
+    publisher = MetricsPublisher(WORKER_ID).start()
+    sessions = {mailbox.key: create_imap_session(mailbox) for mailbox in mailboxes}
+    statuses = {mailbox.key: {'state': 'starting', 'last_cycle': None, 'last_error': None} for mailbox in mailboxes}
+    threads = []
+    for mailbox in mailboxes:
+        thread = threading.Thread(target=run_live, name=f"mailbox-{mailbox.key}",
+                                  args=(mailbox, stop, sessions[mailbox.key], statuses[mailbox.key]))
+        thread.start()
+        threads.append(thread)
 
-def generate_email_reply(sender_email, subject, message_body):
+    started = time.time()
+    next_report = started
+    try:
+        while not signalled.wait(1) and not stop.is_set():
+            if report is not None and time.time() >= next_report:
+                next_report = time.time() + WORKER_HEALTH_INTERVAL
+                try:
+                    report({'worker_id': WORKER_ID, 'pid': os.getpid(), 'started_at': started,
+                            'reported_at': time.time(), 'mailboxes': {key: dict(value) for key, value in statuses.items()}})
+                except Exception as e:
+                    logger.error(f"Error reporting worker health: {e}", exc_info=True)
+            if not any(thread.is_alive() for thread in threads):
+                break
+    finally:
+        logger.info(f"Worker {WORKER_ID} draining")
+        stop.set()
+        # Wake the mailboxes waiting in IDLE so they notice the stop
+        for imap_session in sessions.values():
+            imap_session.interrupt()
+        for thread in threads:
+            thread.join()
+        reply_writer.close()
+        heartbeat.stop()
+        publisher.stop()
+        logger.info(f"Worker {WORKER_ID} stopped")
+
+def generate_email_reply(sender_email, subject, message_body, session_id=None, message_id=None, enqueued_at=None):
     """Generate a reply to an email using Ollama"""
-    # Create a prompt that gives context to the AI model
-    prompt = f"""
-You are an official customer support email assistant. Your role is to:
-1. Provide professional and helpful responses to customer queries
-2. Collect necessary information to create support tickets
-3. Follow standard templates for different types of queries
-4. Maintain a friendly yet professional tone
-
-For each email, follow these steps:
-1. Analyze the customer's issue
-2. Identify what type of issue it is (payment, account, technical, etc.)
-3. Request any missing information needed to create a support ticket
-4. Provide a clear resolution path or next steps
-
-Required Information to Collect:
-- Customer ID if applicable
-- Transaction ID or Reference Number
-- Contact number associated with the account
-- Date and time of the issue
-- Detailed description of the problem
-
-Response Template:
-1. Greeting: "Dear Customer,"
-2. Acknowledge: "Thank you for reaching out to customer support."
-3. Issue Summary: "We understand you're facing [briefly describe issue]."
-4. Information Request: "To assist you better, we need the following details:"
-5. Next Steps: "Once we receive this information, we will [explain next steps]."
-6. Closing: "We appreciate your patience and look forward to resolving your issue."
-
-Current Email Details:
-From: {sender_email}
-Subject: {subject}
-Message:
-{message_body}
-
-Please generate an appropriate response following the above guidelines.
-"""
-
-    # Get response from Ollama
-    reply = ask_ollama(prompt)
+    # Reuse the reply to an identical email from this sender, or a near-identical one in the same conversation
+    cached = reply_cache.lookup(sender_email, subject, message_body, session_id)
+    if cached is not None:
+        REPLY_CACHE_HITS.inc()
+        return cached
+    
+    # Continue from the model's own context of this conversation when we have it,
+    # otherwise include a window of the stored history
+    # Both are limited to this sender: sessions merged by subject can span customers
+    context_key = (session_id, extract_email_address(sender_email or ''))
+    context = session_contexts.get(context_key, OLLAMA_MODEL) if session_id else None
+    history = [] if context else get_session_history(session_id, sender_email, exclude_message_id=message_id)
+    prompt = build_prompt(sender_email, subject, message_body, history)
+    model = OLLAMA_MODEL if context else select_model(message_body, bool(history))
+
+    # Get response from Ollama; the static instructions go in the system field
+    result = generate(prompt, model=model, system=SYSTEM_PROMPT, context=context,
+                      enqueued_at=enqueued_at, session_id=session_id)
+    # No reply at all, or one cut off too early to use
+    reply = result['text'] or FALLBACK_REPLY
+    if reply == FALLBACK_REPLY:
+        FALLBACK_REPLIES.inc(reason='model_failed')
+    if session_id:
+        session_contexts.put(context_key, model, result['context'])
     
     # Ensure we have a fallback if Ollama fails
     if not reply or len(reply.strip()) < 10:
         logger.warning("Ollama response was too short or empty, using fallback")
+        FALLBACK_REPLIES.inc(reason='too_short')
         return f"""Dear Customer,
 
 Thank you for reaching out to customer support. We're currently reviewing your query regarding '{subject}'. 
@@ -278,10 +558,15 @@ We look forward to resolving your issue at the earliest.
 Best regards,
 Customer Support Team"""
 
+    # Only genuine model output is cached, never a fallback
+    if reply != FALLBACK_REPLY:
+        reply_cache.store(sender_email, subject, message_body, reply, session_id)
     return reply
 
 # Start the email monitoring
 if __name__ == "__main__":
+    bootstrap()
     logger.info("Email service starting up")
     display_emails()
-    run_live()
+    # Every configured mailbox in this process; supervisor.py spreads them over several
+    run_worker([shard for mailbox in load_mailboxes() for shard in mailbox.split()])
@@ -0,0 +1,311 @@
+"""
+In-process metrics and per-email traces, rendered in the Prometheus text format.
+
+Modules declare their metrics at import time (counter(), gauge(),
+histogram()) and update them as they work. Each email carries a Trace
+whose spans time the stages it goes through; every span is also observed
+in the email_stage_seconds histogram, and finished traces are kept in a
+small ring buffer.
+
+The worker and the API are separate processes (possibly on separate hosts),
+so a worker publishes snapshot() to the worker_metrics table every
+METRICS_PUBLISH_INTERVAL seconds with MetricsPublisher, and the API renders
+its own registry together with every recent worker snapshot, each series
+labelled with the worker it came from.
+"""
+
+import bisect
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+METRICS_PUBLISH_INTERVAL = int(os.getenv('METRICS_PUBLISH_INTERVAL', '15'))
+# Worker snapshots older than this are left out of /metrics (the worker is gone)
+METRICS_STALE_SECONDS = int(os.getenv('METRICS_STALE_SECONDS', '300'))
+METRICS_TRACE_BUFFER = int(os.getenv('METRICS_TRACE_BUFFER', '100'))
+
+# Seconds; covers a fast DB lookup up to a slow LLM reply
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_lock = threading.Lock()
+_metrics = {}
+_traces = deque(maxlen=METRICS_TRACE_BUFFER)
+
+
+def _label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._series = {}
+
+    def _samples(self):
+        with _lock:
+            return [[dict(key), value] for key, value in self._series.items()]
+
+    def snapshot(self):
+        return {'type': self.type, 'help': self.help, 'series': self._samples()}
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = _label_key(labels)
+        with _lock:
+            self._series[key] = self._series.get(key, 0) + value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name, help):
+        super().__init__(name, help)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        with _lock:
+            self._series[_label_key(labels)] = value
+
+    def set_function(self, function, **labels):
+        """Read the value from function() whenever metrics are collected (e.g. a queue length)"""
+        with _lock:
+            self._functions[_label_key(labels)] = function
+
+    def _samples(self):
+        samples = super()._samples()
+        with _lock:
+            functions = list(self._functions.items())
+        for key, function in functions:
+            try:
+                samples.append([dict(key), function()])
+            except Exception as e:
+                logger.debug(f"Gauge {self.name} callback failed: {e}")
+        return samples
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with _lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket (not cumulative) counts, the last one for +Inf, then sum
+                series = self._series[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0}
+            series['counts'][bisect.bisect_left(self.buckets, value)] += 1
+            series['sum'] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self):
+        with _lock:
+            return [[dict(key), {'counts': list(series['counts']), 'sum': series['sum']}]
+                    for key, series in self._series.items()]
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot['buckets'] = list(self.buckets)
+        return snapshot
+
+
+def _register(metric):
+    with _lock:
+        existing = _metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        _metrics[metric.name] = metric
+        return metric
+
+
+def counter(name, help):
+    return _register(Counter(name, help))
+
+
+def gauge(name, help):
+    return _register(Gauge(name, help))
+
+
+def histogram(name, help, buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, help, buckets))
+
+
+STAGE_SECONDS = histogram('email_stage_seconds', "Time spent per processing stage")
+DB_SECONDS = histogram('email_db_seconds', "Time spent per database operation")
+
+
+def timed_db(function):
+    """Decorator observing a database function's duration in email_db_seconds"""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with DB_SECONDS.time(operation=function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+class Trace:
+    """Timeline of one email through the pipeline; spans may come from different threads"""
+
+    def __init__(self, trace_id, **attributes):
+        self.trace_id = trace_id
+        self.attributes = attributes
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+        self.spans = []
+
+    @contextmanager
+    def span(self, name):
+        """Time a stage; also recorded in email_stage_seconds"""
+        started = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            STAGE_SECONDS.observe(duration, stage=name)
+            span = {'name': name, 'start_ms': round((started - self._started) * 1000, 1),
+                    'duration_ms': round(duration * 1000, 1)}
+            if error:
+                span['error'] = error
+            with self._lock:
+                self.spans.append(span)
+
+    def finish(self, outcome):
+        """Close the trace and keep it in the recent traces buffer"""
+        total = time.perf_counter() - self._started
+        with self._lock:
+            spans = list(self.spans)
+        record = {'trace_id': self.trace_id, 'outcome': outcome, 'started_at': self.started_at,
+                  'duration_ms': round(total * 1000, 1), 'attributes': self.attributes, 'spans': spans}
+        with _lock:
+            _traces.append(record)
+        logger.info(f"Trace {self.trace_id} {outcome} in {total:.2f}s: "
+                    + ", ".join(f"{span['name']}={span['duration_ms']:.0f}ms" for span in spans))
+        return record
+
+
+def snapshot():
+    """All metrics and recent traces of this process as a JSON-serializable dict"""
+    with _lock:
+        metrics = list(_metrics.values())
+        traces = list(_traces)
+    return {'metrics': {metric.name: metric.snapshot() for metric in metrics}, 'traces': traces}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in sorted(labels.items())) + '}'
+
+
+def _format_value(value):
+    if value is None:
+        return 'NaN'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_prometheus(snapshots):
+    """
+    Render snapshots as Prometheus text exposition format. snapshots is a
+    list of (labels, snapshot) pairs; the labels (e.g. the worker) are added
+    to every series of that snapshot.
+    """
+    merged = {}
+    for extra_labels, process_snapshot in snapshots:
+        for name, metric in process_snapshot['metrics'].items():
+            entry = merged.setdefault(name, {'type': metric['type'], 'help': metric['help'],
+                                             'buckets': metric.get('buckets'), 'series': []})
+            for labels, value in metric['series']:
+                entry['series'].append(({**labels, **extra_labels}, value))
+
+    lines = []
+    for name in sorted(merged):
+        entry = merged[name]
+        if not entry['series']:
+            continue
+        lines.append(f"# HELP {name} {entry['help']}")
+        lines.append(f"# TYPE {name} {entry['type']}")
+        for labels, value in entry['series']:
+            if entry['type'] != 'histogram':
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(list(entry['buckets']) + ['+Inf'], value['counts']):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels({**labels, 'le': bound})} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value['sum'])}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsPublisher:
+    """Background thread that writes this process's snapshot to the shared worker_metrics table"""
+
+    def __init__(self, worker_id, interval=METRICS_PUBLISH_INTERVAL):
+        self.worker_id = worker_id
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="metrics-publisher", daemon=True)
+            self._thread.start()
+        return self
+
+    def publish(self):
+        # Imported here so metrics can be used without a database
+        from database import save_metrics_snapshot
+        save_metrics_snapshot(self.worker_id, json.dumps(snapshot()))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.publish()
+            except Exception as e:
+                logger.error(f"Error publishing metrics: {e}", exc_info=True)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            try:
+                self.publish()
+            except Exception as e:
+                logger.error(f"Error publishing metrics: {e}", exc_info=True)
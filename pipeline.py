@@ -0,0 +1,178 @@
+import logging
+import queue
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Sentinel placed on the send queues to stop the SMTP lanes
+_STOP = object()
+
+
+class SessionSerialExecutor:
+    """
+    Thread pool that runs jobs concurrently across sessions but strictly in
+    submission order within a single session_id.
+    """
+
+    def __init__(self, workers):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="generate")
+        self._lock = threading.Lock()
+        # Notified when the last session finishes its queue
+        self._idle = threading.Condition(self._lock)
+        # session_id -> deque of jobs waiting behind the one currently running
+        self._pending = {}
+
+    def submit(self, key, fn, job):
+        with self._lock:
+            if key in self._pending:
+                self._pending[key].append((fn, job))
+                return
+            self._pending[key] = deque()
+        self._pool.submit(self._run, key, fn, job)
+
+    def _run(self, key, fn, job):
+        try:
+            fn(job)
+        except Exception as e:
+            logger.error(f"Unhandled error in generation worker: {e}", exc_info=True)
+        finally:
+            with self._lock:
+                waiting = self._pending[key]
+                if waiting:
+                    next_fn, next_job = waiting.popleft()
+                else:
+                    del self._pending[key]
+                    next_fn = None
+                    if not self._pending:
+                        self._idle.notify_all()
+            if next_fn is not None:
+                self._pool.submit(self._run, key, next_fn, next_job)
+
+    def shutdown(self):
+        """Wait for every submitted job, including those queued behind their session, then stop"""
+        # The pool refuses new work once shut down, so queued jobs must be handed to it first
+        with self._idle:
+            self._idle.wait_for(lambda: not self._pending)
+        self._pool.shutdown(wait=True)
+
+
+class EmailPipeline:
+    """
+    Staged processing pipeline for inbound emails.
+
+    The caller (the IMAP fetch stage) submits parsed and saved jobs. A bounded
+    worker pool generates replies, and one or more SMTP lanes send them.
+    Jobs are plain dicts and must carry a 'session_id' key; jobs of the same
+    session are generated and sent in the order they were submitted.
+
+    Completed jobs are handed back through completed() so the fetch stage can
+    update IMAP flags on its own connection (imaplib is not thread-safe).
+    """
+
+    def __init__(self, generate, send, connect_smtp, generation_workers=4,
+                 smtp_workers=1, max_pending=100):
+        self._generate = generate
+        self._send = send
+        self._connect_smtp = connect_smtp
+        self._generator = SessionSerialExecutor(generation_workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._done = queue.Queue()
+        self._inflight = 0
+        self._inflight_lock = threading.Lock()
+
+        # Each SMTP lane owns its own connection; sessions are pinned to a lane
+        # so replies within a conversation leave in order
+        self._send_queues = [queue.Queue(maxsize=max_pending) for _ in range(smtp_workers)]
+        self._senders = []
+        for index, send_queue in enumerate(self._send_queues):
+            thread = threading.Thread(target=self._send_loop, args=(send_queue,),
+                                      name=f"smtp-{index}", daemon=True)
+            thread.start()
+            self._senders.append(thread)
+
+    def submit(self, job):
+        """Queue a job for generation; blocks when max_pending jobs are in flight"""
+        self._slots.acquire()
+        with self._inflight_lock:
+            self._inflight += 1
+        self._generator.submit(job['session_id'], self._generate_stage, job)
+
+    def _generate_stage(self, job):
+        try:
+            job['reply'] = self._generate(job)
+        except Exception as e:
+            logger.error(f"Failed to generate reply for {job.get('message_id')}: {e}", exc_info=True)
+            job['error'] = e
+            self._finish(job)
+            return
+        lane = zlib.crc32(str(job['session_id']).encode()) % len(self._send_queues)
+        self._send_queues[lane].put(job)
+
+    def _send_loop(self, send_queue):
+        smtp_server = None
+        while True:
+            job = send_queue.get()
+            if job is _STOP:
+                break
+            try:
+                if smtp_server is None:
+                    smtp_server = self._connect_smtp()
+                self._send(smtp_server, job)
+            except Exception as e:
+                logger.error(f"Failed to send reply for {job.get('message_id')}: {e}", exc_info=True)
+                job['error'] = e
+                # Drop the connection so the next job reconnects
+                smtp_server = _close_smtp(smtp_server)
+            self._finish(job)
+        _close_smtp(smtp_server)
+
+    def _finish(self, job):
+        self._done.put(job)
+        self._slots.release()
+        with self._inflight_lock:
+            self._inflight -= 1
+
+    def completed(self, timeout=None):
+        """Yield jobs that finished since the last call, waiting up to timeout for the first"""
+        try:
+            job = self._done.get(timeout=timeout) if timeout else self._done.get_nowait()
+        except queue.Empty:
+            return
+        yield job
+        while True:
+            try:
+                yield self._done.get_nowait()
+            except queue.Empty:
+                return
+
+    def pending(self):
+        with self._inflight_lock:
+            return self._inflight
+
+    def drain(self, on_complete):
+        """Wait for every submitted job to finish, passing each to on_complete"""
+        while True:
+            for job in self.completed(timeout=0.5):
+                on_complete(job)
+            with self._inflight_lock:
+                if self._inflight == 0 and self._done.empty():
+                    return
+
+    def close(self):
+        self._generator.shutdown()
+        for send_queue in self._send_queues:
+            send_queue.put(_STOP)
+        for thread in self._senders:
+            thread.join()
+
+
+def _close_smtp(smtp_server):
+    if smtp_server is not None:
+        try:
+            smtp_server.quit()
+        except Exception as e:
+            logger.error(f"Error closing SMTP connection: {e}")
+    return None
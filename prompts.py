@@ -0,0 +1,184 @@
+"""
+Prompt construction for reply generation.
+
+The long, static instructions are sent as Ollama's `system` field and never
+change byte-for-byte, so the model server can reuse the cached prefix
+instead of re-reading it for every email. The per-email prompt carries only
+the conversation history and the current email.
+
+History comes from one of two places:
+- the `context` Ollama returned after the previous reply in the same session
+  (the model's own encoding of the conversation so far), kept in
+  SessionContextCache; only the new email needs to be sent then
+- otherwise, prior messages of the session from the database, newest first
+  within PROMPT_HISTORY_TOKENS, with older turns condensed into a short
+  extractive summary
+"""
+
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Rough token budget for prior messages in the prompt, and the cap per message
+PROMPT_HISTORY_TOKENS = int(os.getenv('PROMPT_HISTORY_TOKENS', '1500'))
+PROMPT_TURN_TOKENS = int(os.getenv('PROMPT_TURN_TOKENS', '400'))
+# Sessions whose Ollama context is kept in memory, and the longest context
+# reused before falling back to the history window (it grows with every reply)
+PROMPT_CONTEXT_SESSIONS = int(os.getenv('PROMPT_CONTEXT_SESSIONS', '200'))
+PROMPT_CONTEXT_MAX_TOKENS = int(os.getenv('PROMPT_CONTEXT_MAX_TOKENS', '3000'))
+
+SYSTEM_PROMPT = """You are an official customer support email assistant. Your role is to:
+1. Provide professional and helpful responses to customer queries
+2. Collect necessary information to create support tickets
+3. Follow standard templates for different types of queries
+4. Maintain a friendly yet professional tone
+
+For each email, follow these steps:
+1. Analyze the customer's issue
+2. Identify what type of issue it is (payment, account, technical, etc.)
+3. Request any missing information needed to create a support ticket
+4. Provide a clear resolution path or next steps
+
+Required Information to Collect:
+- Customer ID if applicable
+- Transaction ID or Reference Number
+- Contact number associated with the account
+- Date and time of the issue
+- Detailed description of the problem
+
+Response Template:
+1. Greeting: "Dear Customer,"
+2. Acknowledge: "Thank you for reaching out to customer support."
+3. Issue Summary: "We understand you're facing [briefly describe issue]."
+4. Information Request: "To assist you better, we need the following details:"
+5. Next Steps: "Once we receive this information, we will [explain next steps]."
+6. Closing: "We appreciate your patience and look forward to resolving your issue."
+
+Use the earlier messages of the conversation, when given, to avoid asking for
+details the customer has already provided."""
+
+_SENTENCE_RE = re.compile(r'(.+?[.!?])(?:\s|$)')
+
+
+def estimate_tokens(text):
+    """Cheap token estimate (about four characters per token for English text)"""
+    return len(text) // 4 + 1
+
+
+def clean_turn(text):
+    """Drop quoted lines and blank runs that replies carry along"""
+    lines = [line for line in (text or '').splitlines() if not line.lstrip().startswith('>')]
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip()
+
+
+def trim_to_tokens(text, max_tokens):
+    limit = max_tokens * 4
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(' ', 1)[0] + " [...]"
+
+
+def first_sentence(text):
+    match = _SENTENCE_RE.match(' '.join(text.split()))
+    return match.group(1) if match else ' '.join(text.split())[:120]
+
+
+def format_turn(turn):
+    speaker = "Customer" if turn['role'] == 'user' else "Support"
+    return f"{speaker} ({turn['received_at']}):\n{trim_to_tokens(clean_turn(turn['message']), PROMPT_TURN_TOKENS)}"
+
+
+def history_window(history, budget=PROMPT_HISTORY_TOKENS):
+    """
+    Select prior turns (oldest first) that fit the token budget. Returns
+    (summary, turns): the most recent turns in full, and a one-line-per-turn
+    summary of the older ones that did not fit, or None.
+    """
+    kept = []
+    used = 0
+    older = []
+    for turn in reversed(history):
+        text = format_turn(turn)
+        cost = estimate_tokens(text)
+        if older or used + cost > budget:
+            older.append(turn)
+        else:
+            kept.append(text)
+            used += cost
+    kept.reverse()
+    older.reverse()
+
+    summary = None
+    if older:
+        # Extractive summary: the opening sentence of each older turn, within what is left of the budget
+        lines = []
+        remaining = max(budget - used, 0)
+        for turn in older:
+            speaker = "Customer" if turn['role'] == 'user' else "Support"
+            line = f"- {speaker}: {first_sentence(clean_turn(turn['message']))}"
+            if estimate_tokens(line) > remaining:
+                break
+            lines.append(line)
+            remaining -= estimate_tokens(line)
+        omitted = len(older) - len(lines)
+        if omitted:
+            lines.insert(0, f"- ({omitted} earlier message(s) omitted)")
+        summary = "\n".join(lines)
+    return summary, kept
+
+
+def build_prompt(sender_email, subject, message_body, history=None):
+    """Per-email prompt; the instructions live in SYSTEM_PROMPT"""
+    parts = []
+    if history:
+        summary, turns = history_window(history)
+        parts.append("Earlier messages in this conversation:")
+        if summary:
+            parts.append(f"Summary of older messages:\n{summary}")
+        parts.extend(turns)
+    parts.append(f"""Current Email Details:
+From: {sender_email}
+Subject: {subject}
+Message:
+{message_body}
+
+Please generate an appropriate response following the above guidelines.""")
+    return "\n\n".join(parts)
+
+
+class SessionContextCache:
+    """
+    LRU of the Ollama context returned for the latest reply in each
+    conversation. Keys are (session_id, sender address): a session merged
+    across customers must not continue from another customer's context.
+    """
+
+    def __init__(self, max_sessions=PROMPT_CONTEXT_SESSIONS, max_tokens=PROMPT_CONTEXT_MAX_TOKENS):
+        self.max_sessions = max_sessions
+        self.max_tokens = max_tokens
+        self._lock = threading.Lock()
+        self._contexts = OrderedDict()
+
+    def get(self, key, model):
+        with self._lock:
+            entry = self._contexts.get(key)
+            # A context is only meaningful to the model that produced it
+            if entry is None or entry[0] != model:
+                return None
+            self._contexts.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, model, context):
+        with self._lock:
+            if not context or len(context) > self.max_tokens:
+                self._contexts.pop(key, None)
+                return
+            self._contexts[key] = (model, context)
+            self._contexts.move_to_end(key)
+            while len(self._contexts) > self.max_sessions:
+                self._contexts.popitem(last=False)
@@ -0,0 +1,188 @@
+"""
+Cache of generated replies, so repeated or near-identical customer emails
+do not each pay for an LLM call.
+
+Exact repeats are found by a key over the sender's address and the
+normalized subject and body, held in an in-process LRU with a TTL.
+Near-duplicates (small edits, different signatures, re-sent with extra
+whitespace) are found by comparing 64-bit SimHash fingerprints against
+recent emails of the same sender in the same session_id. Replies draw on
+the sender's history, so they are never reused for another sender, not
+even within a session merged across senders. With
+REPLY_CACHE_PERSIST=mysql every entry is also written to the reply_cache
+table, so the cache survives restarts and is shared between workers.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+
+from thread_index import extract_email_address, normalize_subject
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+REPLY_CACHE_TTL = int(os.getenv('REPLY_CACHE_TTL', '86400'))
+REPLY_CACHE_SIZE = int(os.getenv('REPLY_CACHE_SIZE', '1000'))
+# Maximum differing SimHash bits for two bodies to count as near-duplicates
+# (short emails need a looser bound than the usual 3 used for web pages)
+REPLY_CACHE_NEAR_DUP_DISTANCE = int(os.getenv('REPLY_CACHE_NEAR_DUP_DISTANCE', '8'))
+# Recent emails per session compared for near-duplicates
+REPLY_CACHE_SESSION_DEPTH = int(os.getenv('REPLY_CACHE_SESSION_DEPTH', '20'))
+# 'mysql' to persist entries in the reply_cache table, 'none' for memory only
+REPLY_CACHE_PERSIST = os.getenv('REPLY_CACHE_PERSIST', 'mysql')
+
+_WORD_RE = re.compile(r'\w+')
+_SIMHASH_BITS = 64
+
+
+def normalize_body(body):
+    """Lower-cased body without quoted reply lines and with collapsed whitespace"""
+    lines = [line for line in (body or '').splitlines() if not line.lstrip().startswith('>')]
+    return ' '.join(' '.join(lines).lower().split())
+
+
+def cache_key(sender_email, subject, body):
+    normalized = f"{extract_email_address(sender_email or '')}\n{normalize_subject(subject)}\n{normalize_body(body)}"
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+def simhash(text):
+    """64-bit SimHash over the words of a normalized text"""
+    weights = [0] * _SIMHASH_BITS
+    for word in _WORD_RE.findall(text):
+        value = int.from_bytes(hashlib.md5(word.encode('utf-8')).digest()[:8], 'big')
+        for bit in range(_SIMHASH_BITS):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit in range(_SIMHASH_BITS) if weights[bit] > 0)
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class ReplyCache:
+    """Thread-safe LRU/TTL reply cache with per-session near-duplicate lookup"""
+
+    def __init__(self, max_size=REPLY_CACHE_SIZE, ttl=REPLY_CACHE_TTL,
+                 max_distance=REPLY_CACHE_NEAR_DUP_DISTANCE, session_depth=REPLY_CACHE_SESSION_DEPTH,
+                 persist=REPLY_CACHE_PERSIST == 'mysql'):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.session_depth = session_depth
+        self.persist = persist
+        self._lock = threading.Lock()
+        # cache key -> (reply, stored_at)
+        self._entries = OrderedDict()
+        # (session_id, sender address) -> deque of (fingerprint, cache key)
+        self._sessions = OrderedDict()
+
+    def _get_entry(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if now - entry[1] > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def lookup(self, sender_email, subject, body, session_id=None):
+        """Return a cached reply for this email or a near-duplicate by the same sender in its session, else None"""
+        key = cache_key(sender_email, subject, body)
+        sender = extract_email_address(sender_email or '')
+        now = time.time()
+        with self._lock:
+            reply = self._get_entry(key, now)
+            if reply is not None:
+                logger.info("Reply cache hit (exact match)")
+                return reply
+
+            fingerprint = simhash(normalize_body(body))
+            for other_fingerprint, other_key in reversed(self._sessions.get((session_id, sender), ())):
+                if hamming_distance(fingerprint, other_fingerprint) <= self.max_distance:
+                    reply = self._get_entry(other_key, now)
+                    if reply is not None:
+                        logger.info(f"Reply cache hit (near-duplicate in session {session_id})")
+                        return reply
+
+        if self.persist:
+            return self._lookup_persisted(key, fingerprint, session_id, sender)
+        return None
+
+    def store(self, sender_email, subject, body, reply, session_id=None):
+        key = cache_key(sender_email, subject, body)
+        sender = extract_email_address(sender_email or '')
+        fingerprint = simhash(normalize_body(body))
+        self._remember(key, fingerprint, reply, session_id, sender, time.time())
+        if self.persist:
+            self._store_persisted(key, fingerprint, reply, session_id, sender)
+
+    def _remember(self, key, fingerprint, reply, session_id, sender, stored_at):
+        with self._lock:
+            self._entries[key] = (reply, stored_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+            if session_id is not None:
+                recent = self._sessions.setdefault((session_id, sender), deque(maxlen=self.session_depth))
+                self._sessions.move_to_end((session_id, sender))
+                recent.append((fingerprint, key))
+                while len(self._sessions) > self.max_size:
+                    self._sessions.popitem(last=False)
+
+    def _lookup_persisted(self, key, fingerprint, session_id, sender):
+        # Imported here so the cache can be used without a database
+        from database import get_connection
+        cutoff = datetime.now() - timedelta(seconds=self.ttl)
+        try:
+            with get_connection() as conn:
+                c = conn.cursor()
+                c.execute("SELECT reply FROM reply_cache WHERE cache_key = %s AND created_at >= %s",
+                          (key, cutoff))
+                row = c.fetchone()
+                if row:
+                    logger.info("Reply cache hit (exact match, persisted)")
+                    self._remember(key, fingerprint, row[0], session_id, sender, time.time())
+                    return row[0]
+                if session_id is None:
+                    return None
+                c.execute("""SELECT cache_key, simhash, reply FROM reply_cache
+                             WHERE session_id = %s AND sender = %s AND created_at >= %s
+                             ORDER BY created_at DESC LIMIT %s""",
+                          (session_id, sender, cutoff, self.session_depth))
+                for other_key, other_fingerprint, reply in c.fetchall():
+                    if hamming_distance(fingerprint, int(other_fingerprint)) <= self.max_distance:
+                        logger.info(f"Reply cache hit (near-duplicate in session {session_id}, persisted)")
+                        self._remember(other_key, int(other_fingerprint), reply, session_id, sender, time.time())
+                        return reply
+        except Exception as e:
+            logger.error(f"Error reading reply cache: {e}", exc_info=True)
+        return None
+
+    def _store_persisted(self, key, fingerprint, reply, session_id, sender):
+        from database import get_connection
+        try:
+            with get_connection() as conn:
+                c = conn.cursor()
+                c.execute("""INSERT INTO reply_cache (cache_key, session_id, sender, simhash, reply, created_at)
+                             VALUES (%s, %s, %s, %s, %s, %s)
+                             ON DUPLICATE KEY UPDATE session_id = VALUES(session_id), sender = VALUES(sender),
+                                 simhash = VALUES(simhash), reply = VALUES(reply), created_at = VALUES(created_at)""",
+                          (key, session_id, sender, fingerprint, reply, datetime.now()))
+                # Opportunistically drop a batch of expired entries
+                c.execute("DELETE FROM reply_cache WHERE created_at < %s LIMIT 100",
+                          (datetime.now() - timedelta(seconds=self.ttl),))
+                conn.commit()
+        except Exception as e:
+            logger.error(f"Error saving reply cache entry: {e}", exc_info=True)
@@ -0,0 +1,106 @@
+"""
+Admission control for requests to the model server.
+
+Generation workers ask the scheduler for a slot before calling Ollama. At
+most `limit` requests are in flight; waiting requests are admitted oldest
+email first, with sessions that already have a request in flight going
+last. The limit adapts to the server (AIMD): when the observed latency
+(time to first token, which mostly measures queueing inside Ollama) rises
+well above the best level seen so far, the limit is cut back, and it grows
+again one step at a time while latency stays near that baseline.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class LLMScheduler:
+
+    def __init__(self, max_in_flight=4, min_in_flight=1, latency_tolerance=2.0, smoothing=0.3):
+        self.max_in_flight = max_in_flight
+        self.min_in_flight = min_in_flight
+        self.limit = max_in_flight
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._in_flight = 0
+        self._session_in_flight = Counter()
+        self._latency = None
+        self._baseline = None
+        self._last_decrease = 0.0
+
+    @contextmanager
+    def slot(self, enqueued_at=None, session_id=None):
+        """
+        Block until this request may call the model server. Yields a dict the
+        caller can set 'latency' on (e.g. time to first token); otherwise the
+        time spent inside the block is used.
+        """
+        with self._cond:
+            entry = (self._session_in_flight[session_id] if session_id else 0,
+                     enqueued_at or time.time(), next(self._sequence))
+            heapq.heappush(self._waiting, entry)
+            while self._waiting[0] is not entry or self._in_flight >= self.limit:
+                self._cond.wait()
+            heapq.heappop(self._waiting)
+            self._in_flight += 1
+            if session_id:
+                self._session_in_flight[session_id] += 1
+            # The next waiter may also fit under the limit
+            self._cond.notify_all()
+
+        ticket = {'latency': None}
+        started = time.monotonic()
+        try:
+            yield ticket
+        finally:
+            latency = ticket['latency'] if ticket['latency'] is not None else time.monotonic() - started
+            with self._cond:
+                self._in_flight -= 1
+                if session_id:
+                    self._session_in_flight[session_id] -= 1
+                    if not self._session_in_flight[session_id]:
+                        del self._session_in_flight[session_id]
+                self._observe(latency)
+                self._cond.notify_all()
+
+    def _observe(self, latency):
+        if self._latency is None:
+            self._latency = latency
+        else:
+            self._latency = self.smoothing * latency + (1 - self.smoothing) * self._latency
+        if self._baseline is None or self._latency < self._baseline:
+            self._baseline = self._latency
+
+        now = time.monotonic()
+        if self._latency > self._baseline * self.latency_tolerance:
+            # Back off at most once per smoothed latency period so one slow burst is not punished repeatedly
+            if self.limit > self.min_in_flight and now - self._last_decrease > self._latency:
+                self.limit = max(self.min_in_flight, int(self.limit * 0.75))
+                self._last_decrease = now
+                logger.info(f"Model server latency {self._latency:.2f}s (baseline {self._baseline:.2f}s), "
+                            f"reducing in-flight limit to {self.limit}")
+        elif self.limit < self.max_in_flight and self._latency < self._baseline * (1 + self.latency_tolerance) / 2:
+            self.limit += 1
+            logger.debug(f"Increasing in-flight limit to {self.limit}")
+        # Let the baseline drift up slowly so a permanently slower server is not treated as overloaded forever
+        self._baseline *= 1.01
+
+    def stats(self):
+        with self._cond:
+            return {
+                'limit': self.limit,
+                'in_flight': self._in_flight,
+                'waiting': len(self._waiting),
+                'latency_seconds': self._latency,
+                'baseline_seconds': self._baseline,
+            }
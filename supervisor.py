@@ -0,0 +1,251 @@
+"""
+Runs the email service as several worker processes.
+
+    python supervisor.py [--processes N]
+
+The mailboxes from mailboxes.py, split into their shards, are spread over
+WORKER_PROCESSES processes (default: one per CPU core, at most one per
+shard). Each worker runs main.run_worker for its share; their logs are
+written by the supervisor to email_service.log.
+
+Workers report their health every WORKER_HEALTH_INTERVAL seconds. A worker
+whose process died is restarted with exponential backoff. GET /health on
+SUPERVISOR_HEALTH_HOST:SUPERVISOR_HEALTH_PORT returns the state of every
+worker and mailbox, with status 200 when all are healthy and 503 otherwise.
+
+On SIGTERM or SIGINT the workers stop fetching new mail, finish the emails
+in flight and exit (graceful drain); workers still running after
+SUPERVISOR_DRAIN_TIMEOUT seconds are killed, and their jobs are picked up
+again once their leases expire.
+"""
+
+import argparse
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from dotenv import load_dotenv
+
+from mailboxes import assign_mailboxes, load_mailboxes
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', str(os.cpu_count() or 1)))
+SUPERVISOR_DRAIN_TIMEOUT = int(os.getenv('SUPERVISOR_DRAIN_TIMEOUT', '120'))
+SUPERVISOR_HEALTH_HOST = os.getenv('SUPERVISOR_HEALTH_HOST', '127.0.0.1')
+# 0 disables the health endpoint
+SUPERVISOR_HEALTH_PORT = int(os.getenv('SUPERVISOR_HEALTH_PORT', '8081'))
+# A worker that has not reported for this many seconds is unhealthy
+SUPERVISOR_STALE_SECONDS = int(os.getenv('SUPERVISOR_STALE_SECONDS', '60'))
+SUPERVISOR_MAX_BACKOFF = 60
+
+
+def _worker_main(worker_id, mailboxes, stop, log_queue, health_queue):
+    """Entry point of a worker process"""
+    if worker_id:
+        # Must be set before job_queue is imported; leases are owned per process
+        os.environ['WORKER_ID'] = worker_id
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(logging.INFO)
+
+    import main
+    main.run_worker(mailboxes, stop, report=health_queue.put)
+
+
+class Supervisor:
+    """Starts, watches, restarts and drains the worker processes"""
+
+    def __init__(self, assignments, log_queue, drain_timeout=SUPERVISOR_DRAIN_TIMEOUT,
+                 stale_seconds=SUPERVISOR_STALE_SECONDS):
+        # Spawned workers start clean instead of inheriting this process's threads and connections
+        self._context = multiprocessing.get_context('spawn')
+        self._stop = self._context.Event()
+        self._health_queue = self._context.Queue()
+        self._log_queue = log_queue
+        self._lock = threading.Lock()
+        self.drain_timeout = drain_timeout
+        self.stale_seconds = stale_seconds
+        self.stopping = False
+        self.workers = [{'index': index, 'mailboxes': mailboxes, 'process': None, 'restarts': 0,
+                         'backoff': 1, 'start_at': 0, 'health': None}
+                        for index, mailboxes in enumerate(assignments)]
+
+    def _start(self, worker):
+        base_id = os.getenv('WORKER_ID')
+        process = self._context.Process(
+            target=_worker_main, name=f"email-worker-{worker['index']}",
+            args=(f"{base_id}-{worker['index']}" if base_id else None, worker['mailboxes'],
+                  self._stop, self._log_queue, self._health_queue))
+        process.start()
+        with self._lock:
+            worker['process'] = process
+            worker['started_at'] = time.time()
+            worker['health'] = None
+        logger.info(f"Started worker {worker['index']} (pid {process.pid}) for "
+                    + ", ".join(mailbox.key for mailbox in worker['mailboxes']))
+
+    def _collect_health(self, timeout):
+        try:
+            report = self._health_queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+        while True:
+            with self._lock:
+                for worker in self.workers:
+                    if worker['process'] is not None and worker['process'].pid == report['pid']:
+                        worker['health'] = report
+            try:
+                report = self._health_queue.get_nowait()
+            except queue.Empty:
+                return
+
+    def _restart_dead(self):
+        now = time.time()
+        for worker in self.workers:
+            process = worker['process']
+            if process is not None and not process.is_alive():
+                logger.error(f"Worker {worker['index']} (pid {process.pid}) exited with code {process.exitcode}, "
+                             f"restarting in {worker['backoff']}s")
+                process.close()
+                with self._lock:
+                    worker['process'] = None
+                    worker['start_at'] = now + worker['backoff']
+                    # A worker that ran for a while gets a fresh backoff next time
+                    ran = now - worker.get('started_at', now)
+                    worker['backoff'] = 1 if ran > SUPERVISOR_MAX_BACKOFF else min(worker['backoff'] * 2,
+                                                                                  SUPERVISOR_MAX_BACKOFF)
+            elif process is None and now >= worker['start_at']:
+                worker['restarts'] += 1
+                self._start(worker)
+
+    def run(self, signalled):
+        """Supervise until signalled (a threading.Event) is set, then drain"""
+        for worker in self.workers:
+            self._start(worker)
+        try:
+            while not signalled.is_set():
+                self._collect_health(timeout=1)
+                self._restart_dead()
+        finally:
+            self.drain()
+
+    def drain(self):
+        logger.info(f"Draining {len(self.workers)} worker(s), up to {self.drain_timeout}s")
+        self.stopping = True
+        self._stop.set()
+        deadline = time.monotonic() + self.drain_timeout
+        for worker in self.workers:
+            process = worker['process']
+            if process is None:
+                continue
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"Worker {worker['index']} (pid {process.pid}) did not drain in time, killing it")
+                process.kill()
+                process.join()
+        logger.info("All workers stopped")
+
+    def health(self):
+        """(healthy, report) over all workers and their mailboxes"""
+        now = time.time()
+        workers = []
+        with self._lock:
+            for worker in self.workers:
+                process = worker['process']
+                report = worker['health'] or {}
+                mailboxes = report.get('mailboxes') or {mailbox.key: {'state': 'starting'}
+                                                        for mailbox in worker['mailboxes']}
+                reported_at = report.get('reported_at')
+                problems = []
+                if process is None or not process.is_alive():
+                    problems.append('not running')
+                elif reported_at is None:
+                    if now - worker.get('started_at', now) > self.stale_seconds:
+                        problems.append('no health report')
+                elif now - reported_at > self.stale_seconds:
+                    problems.append(f"last report {now - reported_at:.0f}s ago")
+                problems += [f"{key}: {state.get('last_error')}" for key, state in mailboxes.items()
+                             if state.get('state') == 'error']
+                workers.append({
+                    'index': worker['index'],
+                    'pid': process.pid if process is not None else None,
+                    'worker_id': report.get('worker_id'),
+                    'healthy': not problems,
+                    'problems': problems,
+                    'restarts': worker['restarts'],
+                    'mailboxes': mailboxes,
+                })
+        healthy = not self.stopping and all(worker['healthy'] for worker in workers)
+        return healthy, {'healthy': healthy, 'stopping': self.stopping, 'workers': workers}
+
+
+def serve_health(supervisor, host, port):
+    """Background HTTP server answering GET /health"""
+
+    class HealthHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') != '/health':
+                self.send_error(404)
+                return
+            healthy, report = supervisor.health()
+            body = json.dumps(report, default=str).encode()
+            self.send_response(200 if healthy else 503)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    server = ThreadingHTTPServer((host, port), HealthHandler)
+    threading.Thread(target=server.serve_forever, name="supervisor-health", daemon=True).start()
+    logger.info(f"Health endpoint on http://{host}:{server.server_port}/health")
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the email service as several worker processes")
+    parser.add_argument('--processes', type=int, default=WORKER_PROCESSES,
+                        help="worker processes (at most one per mailbox shard)")
+    args = parser.parse_args()
+
+    # Workers log through this queue; only the supervisor writes the log file
+    from main import configure_logging
+    from database import ensure_schema
+    configure_logging()
+    log_queue = multiprocessing.get_context('spawn').Queue()
+    listener = logging.handlers.QueueListener(log_queue, *logging.getLogger().handlers, respect_handler_level=True)
+    listener.start()
+
+    # Migrate once here rather than racing from every worker
+    ensure_schema()
+    assignments = assign_mailboxes(load_mailboxes(), args.processes)
+    supervisor = Supervisor(assignments, log_queue)
+    health_server = serve_health(supervisor, SUPERVISOR_HEALTH_HOST, SUPERVISOR_HEALTH_PORT) \
+        if SUPERVISOR_HEALTH_PORT else None
+
+    # Handlers only set a threading.Event; the main loop notices within a second
+    signalled = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: signalled.set())
+    try:
+        supervisor.run(signalled)
+    finally:
+        if health_server is not None:
+            health_server.shutdown()
+        listener.stop()
+
+
+if __name__ == "__main__":
+    main()
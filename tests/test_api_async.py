@@ -0,0 +1,128 @@
+import contextlib
+import re
+from datetime import datetime
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import api
+import api_async
+
+ROWS = [
+    ('b@example.com', 2, 's2', '<3@x>', None, 'Refund', 'Any news?', 'user', datetime(2024, 1, 3, 9, 0), 3),
+    ('a@example.com', 1, 's1', '<2@x>', '<1@x>', 'Re: Hi', 'Hello.', 'assistant', datetime(2024, 1, 2, 9, 0), 2),
+    ('a@example.com', 1, 's1', '<1@x>', None, 'Hi', 'Hi.', 'user', datetime(2024, 1, 1, 9, 0), 1),
+]
+
+
+class FakeEmailsDatabase:
+    """Answers a build_emails_query with ROWS projected to the selected columns, up to its LIMIT"""
+
+    def __init__(self):
+        self.queries = []
+
+    def rows(self, sql, params):
+        self.queries.append((sql, params))
+        select = sql.split('SELECT', 1)[1].split('FROM', 1)[0].strip()
+        # The selected fields, then the received_at and id of the cursor; commas inside COALESCE() do not split
+        columns = re.split(r',\s*(?![^()]*\))', select)[:-2]
+        positions = [list(api.EMAIL_COLUMNS.values()).index(column) for column in columns]
+        return [tuple(row[i] for i in positions) + row[-2:] for row in ROWS][:params[-1]]
+
+
+class AsyncCursor:
+    def __init__(self, database):
+        self.database = database
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, sql, params):
+        self.result = self.database.rows(sql, params)
+
+    async def fetchall(self):
+        return self.result
+
+
+class AsyncPool:
+    def __init__(self, database):
+        self.database = database
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        class Connection:
+            def cursor(inner):
+                return AsyncCursor(self.database)
+        yield Connection()
+
+
+class SyncCursor:
+    def __init__(self, database):
+        self.database = database
+
+    def execute(self, sql, params):
+        self.result = self.database.rows(sql, params)
+
+    def fetchall(self):
+        return self.result
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    """(blocking client, async client) over the same fake database"""
+    database = FakeEmailsDatabase()
+
+    @contextlib.contextmanager
+    def get_connection():
+        class Connection:
+            def cursor(self):
+                return SyncCursor(database)
+        yield Connection()
+
+    monkeypatch.setattr(api, 'get_connection', get_connection)
+    async_app = FastAPI()
+    async_app.include_router(api_async.router)
+    async_app.state.db_pool = AsyncPool(database)
+    return TestClient(api.app), TestClient(async_app), database
+
+
+@pytest.mark.parametrize('query', ['/emails/?limit=2', '/emails/?limit=5&fields=subject,role',
+                                   '/emails/?sender=A%40Example.com&role=user'])
+def test_async_emails_match_the_blocking_route(clients, query):
+    blocking, non_blocking, database = clients
+    expected = blocking.get(query)
+    response = non_blocking.get(query)
+    assert response.status_code == expected.status_code == 200
+    assert response.json() == expected.json()
+    assert response.headers.get('X-Next-Cursor') == expected.headers.get('X-Next-Cursor')
+    assert database.queries[0] == database.queries[1]
+
+
+def test_async_emails_pages_with_the_cursor(clients):
+    _, client, database = clients
+    first = client.get('/emails/?limit=2&fields=message_id')
+    assert [email['message_id'] for email in first.json()] == ['<3@x>', '<2@x>']
+    cursor = first.headers['X-Next-Cursor']
+    assert api.decode_cursor(cursor) == (datetime(2024, 1, 2, 9, 0), 2)
+
+    client.get(f'/emails/?limit=2&cursor={cursor}')
+    assert database.queries[-1][1] == [datetime(2024, 1, 2, 9, 0), datetime(2024, 1, 2, 9, 0), 2, 3]
+
+
+def test_async_emails_rejects_bad_input(clients):
+    _, client, _ = clients
+    assert client.get('/emails/?fields=password').status_code == 400
+    assert client.get('/emails/?cursor=not-a-cursor').status_code == 400
+
+
+def test_async_logs(clients, tmp_path, monkeypatch):
+    _, client, _ = clients
+    log = tmp_path / 'email_service.log'
+    monkeypatch.setattr(api_async, 'LOG_FILE', str(log))
+    assert client.get('/logs/').json() == {"error": "Log file not found"}
+    log.write_text("one\ntwo\nthree\n")
+    assert client.get('/logs/?lines=2').json() == {"logs": ["two\n", "three\n"]}
@@ -0,0 +1,86 @@
+import imaplib
+
+import pytest
+
+import benchmark
+from benchmark import (SyntheticMailbox, compare, histogram_quantile, percentile, start_imap, summarize)
+from mail_client import fetch_text_emails, uid_store
+
+
+def test_percentile_is_nearest_rank():
+    samples = list(range(1, 101))
+    assert percentile(samples, 0.5) == 50
+    assert percentile(samples, 0.99) == 99
+    assert percentile([7], 0.99) == 7
+    assert percentile([], 0.5) is None
+
+
+def test_summarize():
+    assert summarize([0.003, 0.001, 0.002]) == {'count': 3, 'mean_ms': 2.0, 'p50_ms': 2.0, 'p99_ms': 3.0}
+    assert summarize([]) == {'count': 0}
+
+
+def test_histogram_quantile_interpolates_within_the_bucket():
+    assert histogram_quantile((1, 2), [0, 4, 0], 0.5) == pytest.approx(1.5)
+    assert histogram_quantile((1, 2), [2, 2, 0], 0.5) == pytest.approx(1.0)
+    # Beyond the last bound the best estimate is the bound itself
+    assert histogram_quantile((1, 2), [0, 0, 3], 0.99) == 2
+    assert histogram_quantile((1, 2), [0, 0, 0], 0.5) is None
+
+
+def test_compare_reports_regressions_beyond_the_tolerance():
+    baseline = {'scenarios': {'api': {'throughput': 100, 'unit': 'req/s',
+                                      'stages': {'page': {'p99_ms': 10}, 'tiny': {'p99_ms': 0.1}}}}}
+    same = {'scenarios': {'api': {'throughput': 90, 'unit': 'req/s',
+                                  'stages': {'page': {'p99_ms': 11.5}, 'tiny': {'p99_ms': 0.9}}}}}
+    assert compare(same, baseline, 0.2) == []
+    worse = {'scenarios': {'api': {'throughput': 70, 'unit': 'req/s', 'stages': {'page': {'p99_ms': 13}}},
+                           'pipeline': {'throughput': 1, 'unit': 'emails/s', 'stages': {}}}}
+    assert compare(worse, baseline, 0.2) == ["api: throughput 100 -> 70 req/s", "api/page: p99 10 -> 13 ms"]
+
+
+def test_synthetic_mailbox_is_deterministic():
+    first, second = SyntheticMailbox(300, seed=3), SyntheticMailbox(300, seed=3)
+    assert [first.fields(uid) for uid in (1, 150, 300)] == [second.fields(uid) for uid in (1, 150, 300)]
+    assert first.message(150)[0] == second.message(150)[0]
+    assert SyntheticMailbox(300, seed=4).fields(150) != first.fields(150)
+
+
+def test_synthetic_replies_point_back_into_the_mailbox():
+    mailbox = SyntheticMailbox(500, seed=1)
+    replies = [mailbox.fields(uid) for uid in range(1, 501) if mailbox.fields(uid)['in_reply_to']]
+    assert 50 < len(replies) < 250
+    message_ids = {mailbox.message_id(uid) for uid in range(1, 501)}
+    assert all(reply['in_reply_to'] in message_ids and reply['subject'].startswith("Re: ") for reply in replies)
+
+
+def test_uid_sets():
+    assert benchmark._uids('1:3,7,9:*', 10) == [1, 2, 3, 7, 9, 10]
+    assert benchmark._uids('*', 10) == [10]
+
+
+def test_imap_stand_in_serves_the_real_client():
+    mailbox = SyntheticMailbox(40, seed=2)
+    server = start_imap(mailbox)
+    try:
+        mail = imaplib.IMAP4('127.0.0.1', server.server_port)
+        mail.login('support', 'benchmark')
+        mail.select('inbox')
+        status, data = mail.uid('SEARCH', None, 'UID 1:*')
+        assert status == 'OK' and data[0].split() == [str(uid).encode() for uid in range(1, 41)]
+
+        emails = dict(fetch_text_emails(mail, list(range(1, 41))))
+        assert sorted(emails) == list(range(1, 41))
+        for uid, fields in emails.items():
+            expected = mailbox.fields(uid)
+            assert fields['message_id'] == expected['message_id']
+            assert fields['subject'] == expected['subject']
+            assert expected['message'].split()[0] in fields['message_body']
+
+        uid_store(mail, [1, 2, 3], '(Processed-By-System)')
+        status, data = mail.uid('SEARCH', None, 'UID 1:*')
+        assert data[0].split()[0] == b'4'
+        mail.logout()
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,136 @@
+import contextlib
+import json
+
+import pytest
+
+from change_feed import ResponseCache, etag_matches, make_etag, next_cursor
+
+
+def test_make_etag_depends_on_every_part():
+    base = make_etag(10, 500, ['subject'], (3, 13, 1, 0))
+    assert base.startswith('"') and base.endswith('"')
+    assert base == make_etag(10, 500, ['subject'], (3, 13, 1, 0))
+    for other in (make_etag(11, 500, ['subject'], (3, 13, 1, 0)),
+                  make_etag(10, 100, ['subject'], (3, 13, 1, 0)),
+                  make_etag(10, 500, ['message'], (3, 13, 1, 0)),
+                  make_etag(10, 500, ['subject'], (3, 13, 2, 0)),
+                  make_etag(10, 500, ['subject'], (3, 13, 1, 1))):
+        assert other != base
+
+
+def test_etag_matches():
+    etag = '"abc"'
+    assert etag_matches('"abc"', etag)
+    assert etag_matches('"x", W/"abc"', etag)
+    assert etag_matches('*', etag)
+    assert not etag_matches('"x"', etag)
+    assert not etag_matches(None, etag)
+
+
+def test_next_cursor_moves_over_consecutive_ids():
+    assert next_cursor(10, [(11, False), (12, False), (13, False)]) == 13
+
+
+def test_next_cursor_stops_at_an_unsettled_gap():
+    assert next_cursor(10, [(12, False), (13, False)]) == 10
+    assert next_cursor(10, [(11, False), (13, False), (14, True)]) == 11
+
+
+def test_next_cursor_passes_a_settled_gap():
+    assert next_cursor(10, [(12, True), (13, False)]) == 13
+
+
+def test_next_cursor_of_an_empty_page():
+    assert next_cursor(7, []) == 7
+
+
+def test_response_cache_evicts_least_recently_used():
+    cache = ResponseCache(max_size=2)
+    cache.put('a', b'1')
+    cache.put('b', b'2')
+    assert cache.get('a') == b'1'
+    cache.put('c', b'3')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1' and cache.get('c') == b'3'
+
+
+def test_response_cache_disabled():
+    cache = ResponseCache(max_size=0)
+    cache.put('a', b'1')
+    assert cache.get('a') is None
+
+
+class FakeFeedDatabase:
+    """emails as {id: (seconds since stored)}, answering the version and page queries"""
+
+    def __init__(self, ages, merges=0):
+        self.ages = ages
+        self.merges = merges
+
+    def _ids(self, since, limit):
+        return sorted(email_id for email_id in self.ages if email_id > since)[:limit]
+
+    def cursor(self):
+        database = self
+
+        class Cursor:
+            def execute(self, sql, params):
+                settle, since, limit = params[0], params[1], params[-1]
+                ids = database._ids(since, limit)
+                if 'COUNT(*)' in sql:
+                    self.rows = [(len(ids), max(ids, default=0),
+                                  sum(database.ages[i] >= settle for i in ids), database.merges)]
+                else:
+                    self.rows = [(f"subject {i}", i, database.ages[i] >= settle) for i in ids]
+
+            def fetchone(self):
+                return self.rows[0]
+
+            def fetchall(self):
+                return self.rows
+
+        return Cursor()
+
+
+@pytest.fixture
+def feed(monkeypatch):
+    import api
+    from fastapi.testclient import TestClient
+
+    database = FakeFeedDatabase({12: 0, 13: 0})
+
+    @contextlib.contextmanager
+    def get_connection():
+        yield database
+
+    monkeypatch.setattr(api, 'get_connection', get_connection)
+    monkeypatch.setattr(api, 'changes_cache', ResponseCache())
+    return database, TestClient(api.app)
+
+
+def test_cursor_moves_once_the_gap_settles(feed):
+    database, client = feed
+    first = client.get('/emails/changes?since=10&fields=subject')
+    assert first.status_code == 200
+    assert first.json()['cursor'] == 10
+    assert client.get('/emails/changes?since=10&fields=subject',
+                      headers={'If-None-Match': first.headers['etag']}).status_code == 304
+
+    # Id 11 never appeared; once 12 is old enough the cursor moves past the gap
+    database.ages[12] = database.ages[13] = 3600
+    revalidated = client.get('/emails/changes?since=10&fields=subject',
+                             headers={'If-None-Match': first.headers['etag']})
+    assert revalidated.status_code == 200
+    assert revalidated.json()['cursor'] == 13
+    assert client.get('/emails/changes?since=10&fields=subject').json()['cursor'] == 13
+
+
+def test_session_merge_changes_the_etag(feed):
+    database, client = feed
+    database.ages[12] = database.ages[13] = 3600
+    first = client.get('/emails/changes?since=10&fields=subject')
+    database.merges += 1
+    second = client.get('/emails/changes?since=10&fields=subject', headers={'If-None-Match': first.headers['etag']})
+    assert second.status_code == 200
+    assert second.headers['etag'] != first.headers['etag']
+    assert json.loads(second.content)['emails'][0]['id'] == 12
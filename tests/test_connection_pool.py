@@ -0,0 +1,87 @@
+import mysql.connector
+import pytest
+
+import database
+from database import _acquire_connection, get_connection
+
+
+class FakePooledConnection:
+    def __init__(self, connected=True):
+        self.connected = connected
+        self.reconnects = 0
+        self.rolled_back = self.closed = False
+
+    def is_connected(self):
+        return self.connected
+
+    def reconnect(self, attempts=1, delay=0):
+        self.reconnects += 1
+        self.connected = True
+
+    def rollback(self):
+        self.rolled_back = True
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool:
+    """Hands out connections once busy pool errors have been raised"""
+
+    def __init__(self, connection, busy=0):
+        self.connection = connection
+        self.busy = busy
+        self.requests = 0
+
+    def get_connection(self):
+        self.requests += 1
+        if self.busy:
+            self.busy -= 1
+            raise mysql.connector.errors.PoolError("Failed getting connection; pool exhausted")
+        return self.connection
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    def install(connection, busy=0):
+        fake = FakePool(connection, busy)
+        monkeypatch.setattr(database, 'get_pool', lambda: fake)
+        return fake
+    return install
+
+
+def test_waits_for_a_free_connection(pool):
+    conn = FakePooledConnection()
+    fake = pool(conn, busy=2)
+    assert _acquire_connection(timeout=5) is conn
+    assert fake.requests == 3
+
+
+def test_gives_up_after_the_timeout(pool):
+    pool(FakePooledConnection(), busy=10 ** 6)
+    with pytest.raises(mysql.connector.errors.PoolError):
+        _acquire_connection(timeout=0.1)
+
+
+def test_reconnects_a_dropped_connection(pool):
+    conn = FakePooledConnection(connected=False)
+    pool(conn)
+    assert _acquire_connection() is conn
+    assert conn.reconnects == 1
+
+
+def test_connection_goes_back_to_the_pool(pool):
+    conn = FakePooledConnection()
+    pool(conn)
+    with get_connection() as borrowed:
+        assert borrowed is conn
+    assert conn.closed and not conn.rolled_back
+
+
+def test_error_rolls_back_before_returning_the_connection(pool):
+    conn = FakePooledConnection()
+    pool(conn)
+    with pytest.raises(ValueError):
+        with get_connection():
+            raise ValueError("bad row")
+    assert conn.rolled_back and conn.closed
@@ -0,0 +1,81 @@
+import database
+from database import build_emails_query, email_filters_sql
+
+
+def squash(sql):
+    return ' '.join(sql.split())
+
+
+def test_email_filters_match_the_normalized_sender():
+    conditions, params = email_filters_sql(sender='Jane Doe <Jane@Example.COM>', role='user',
+                                           since='2024-01-01', until='2024-02-01')
+    assert conditions == ["e.sender_address = %s", "e.role = %s", "e.received_at >= %s", "e.received_at < %s"]
+    assert params == ['jane@example.com', 'user', '2024-01-01', '2024-02-01']
+
+
+def test_email_filters_expand_the_session_to_its_aliases():
+    conditions, params = email_filters_sql(session_id='s1')
+    assert squash(conditions[0]) == ("(e.session_id = %s OR e.session_id IN "
+                                     "(SELECT session_id FROM session_aliases WHERE parent_id = %s))")
+    assert params == ['s1', 's1']
+
+
+def test_emails_query_selects_fields_and_cursor_columns():
+    sql, params = build_emails_query(fields=['subject', 'session_id'], limit=51)
+    sql = squash(sql)
+    assert sql.startswith("SELECT e.subject, COALESCE(sa.parent_id, e.session_id), e.received_at, e.id FROM emails e")
+    assert "WHERE" not in sql
+    assert sql.endswith("ORDER BY e.received_at DESC, e.id DESC LIMIT %s")
+    assert params == [51]
+
+
+def test_emails_query_continues_after_the_cursor():
+    sql, params = build_emails_query(sender='a@example.com', after=('2024-01-02 10:00:00', 7), limit=10)
+    assert ("WHERE e.sender_address = %s AND (e.received_at < %s OR (e.received_at = %s AND e.id < %s))"
+            in squash(sql))
+    assert params == ['a@example.com', '2024-01-02 10:00:00', '2024-01-02 10:00:00', 7, 10]
+
+
+def test_every_field_is_selectable():
+    sql, _ = build_emails_query()
+    select = ', '.join(list(database.EMAIL_COLUMNS.values()) + ['e.received_at', 'e.id'])
+    assert squash(sql).startswith(f"SELECT {select} FROM emails e")
+
+
+def test_sessions_query_filters_the_summaries():
+    sql, params = database.build_sessions_query(sender='<B@Example.com>', last_role='user',
+                                                after=('2024-01-02 10:00:00', 's9'), limit=21)
+    assert sql == ("SELECT session_id, subject, sender_email, message_count, first_at, last_at, last_role "
+                   "FROM session_summaries WHERE sender_address = %s AND last_role = %s "
+                   "AND (last_at < %s OR (last_at = %s AND session_id < %s)) "
+                   "ORDER BY last_at DESC, session_id DESC LIMIT %s")
+    assert params == ['b@example.com', 'user', '2024-01-02 10:00:00', '2024-01-02 10:00:00', 's9', 21]
+
+
+def test_sessions_query_without_filters():
+    sql, params = database.build_sessions_query()
+    assert sql.endswith("FROM session_summaries ORDER BY last_at DESC, session_id DESC")
+    assert params == []
+
+
+def test_search_against_modes():
+    assert database.search_against("refund, order #42") == ("+refund* +order* +42*", 'IN BOOLEAN MODE')
+    assert database.search_against("refund order", mode='any') == ("refund order", 'IN NATURAL LANGUAGE MODE')
+    assert database.search_against('+refund -"gift card"', mode='boolean') == (
+        '+refund -"gift card"', 'IN BOOLEAN MODE')
+    assert database.search_against("  !? ") is None
+    assert database.search_against("  ", mode='boolean') is None
+
+
+def test_search_query_ranks_and_pages_by_score():
+    match = "MATCH(e.subject, e.message) AGAINST (%s IN BOOLEAN MODE)"
+    sql, params = database.build_search_query("refund", fields=['subject'], role='user', after=(1.5, 30), limit=11)
+    sql = squash(sql)
+    assert sql.startswith(f"SELECT e.subject, {match} AS score, e.id FROM emails e")
+    assert f"WHERE {match} AND e.role = %s AND ({match} < %s OR ({match} = %s AND e.id < %s))" in sql
+    assert sql.endswith("ORDER BY score DESC, e.id DESC LIMIT %s")
+    assert params == ['+refund*', '+refund*', 'user', '+refund*', 1.5, '+refund*', 1.5, 30, 11]
+
+
+def test_search_query_without_words():
+    assert database.build_search_query("...") is None
@@ -0,0 +1,85 @@
+import threading
+
+import pytest
+
+import email_writer
+from email_writer import EmailWriter
+
+
+@pytest.fixture
+def saved(monkeypatch):
+    """Batches passed to save_emails_bulk; rows whose message_id starts with 'bad' make it fail"""
+    batches = []
+
+    def save_emails_bulk(rows, link_threads=True):
+        if any(row['message_id'].startswith('bad') for row in rows):
+            raise RuntimeError("constraint violated")
+        batches.append([row['message_id'] for row in rows])
+        return len(rows)
+
+    monkeypatch.setattr(email_writer, 'save_emails_bulk', save_emails_bulk)
+    return batches
+
+
+def row(message_id):
+    return {'message_id': message_id, 'sender': 'a@example.com', 'subject': 'Hi', 'content': 'x'}
+
+
+def test_full_batches_are_written_without_waiting(saved):
+    writer = EmailWriter(batch_size=2, flush_interval=60)
+    for message_id in 'abcd':
+        writer.write(row(message_id))
+    writer.flush()
+    assert saved == [['a', 'b'], ['c', 'd']]
+    writer.close()
+
+
+def test_flush_writes_a_partial_batch(saved):
+    writer = EmailWriter(batch_size=10, flush_interval=60)
+    writer.write(row('a'))
+    writer.flush()
+    assert saved == [['a']]
+    writer.close()
+
+
+def test_interval_writes_a_partial_batch(saved):
+    writer = EmailWriter(batch_size=10, flush_interval=0.05)
+    writer.write(row('a'))
+    for _ in range(100):
+        if saved:
+            break
+        threading.Event().wait(0.01)
+    assert saved == [['a']]
+    writer.close()
+
+
+def test_close_writes_what_is_left(saved):
+    writer = EmailWriter(batch_size=10, flush_interval=60)
+    writer.write(row('a'))
+    writer.write(row('b'))
+    writer.close()
+    assert saved == [['a', 'b']]
+    # Closing twice, or flushing a closed writer, is harmless
+    writer.close()
+    writer.flush()
+
+
+def test_bad_row_is_isolated_and_reported_once(saved):
+    writer = EmailWriter(batch_size=3, flush_interval=60)
+    for message_id in ('a', 'bad', 'c'):
+        writer.write(row(message_id))
+    writer.flush()
+    assert saved == [['a'], ['c']]
+    assert writer.take_failed(['a', 'bad']) == {'bad'}
+    assert writer.take_failed(['bad']) == set()
+    writer.close()
+
+
+def test_received_at_is_stamped_at_write_time(saved, monkeypatch):
+    rows = []
+    monkeypatch.setattr(email_writer, 'save_emails_bulk', lambda batch, link_threads=True: rows.extend(batch))
+    writer = EmailWriter(batch_size=10, flush_interval=60)
+    writer.write(row('a'))
+    writer.write(dict(row('b'), received_at='2024-01-01 00:00:00'))
+    writer.close()
+    assert rows[0]['received_at'] and rows[1]['received_at'] == '2024-01-01 00:00:00'
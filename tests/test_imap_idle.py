@@ -0,0 +1,118 @@
+import socketserver
+import threading
+import time
+
+import pytest
+
+from mail_client import ImapSession
+
+
+class FakeImapServer:
+    """
+    Plain IMAP server with just enough LOGIN/SELECT/NOOP/IDLE for ImapSession.
+    idle_updates is what follows the IDLE continuation: (delay, data) steps.
+    """
+
+    def __init__(self):
+        self.idle_updates = []
+        self.idle_count = 0
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def send(self, data):
+                self.wfile.write(data)
+                self.wfile.flush()
+
+            def handle(self):
+                self.send(b'* OK [CAPABILITY IMAP4rev1 IDLE] ready\r\n')
+                for line in self.rfile:
+                    tag, command = line.split(b' ', 2)[:2]
+                    command = command.strip().upper()
+                    if command == b'CAPABILITY':
+                        self.send(b'* CAPABILITY IMAP4rev1 IDLE\r\n' + tag + b' OK done\r\n')
+                    elif command == b'SELECT':
+                        self.send(b'* 4 EXISTS\r\n* OK [UIDVALIDITY 77] ok\r\n' + tag + b' OK [READ-WRITE] done\r\n')
+                    elif command == b'IDLE':
+                        fake.idle_count += 1
+                        updates = fake.idle_updates.pop(0) if fake.idle_updates else []
+                        if updates and updates[0][0] == 0:
+                            # Continuation and update in one segment, so imaplib buffers the update
+                            self.send(b'+ idling\r\n' + updates.pop(0)[1])
+                        else:
+                            self.send(b'+ idling\r\n')
+                        for delay, data in updates:
+                            time.sleep(delay)
+                            self.send(data)
+                        if self.rfile.readline().strip().upper() != b'DONE':
+                            return
+                        self.send(tag + b' OK IDLE terminated\r\n')
+                    elif command == b'LOGOUT':
+                        self.send(b'* BYE\r\n' + tag + b' OK done\r\n')
+                        return
+                    else:
+                        self.send(tag + b' OK done\r\n')
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.port = self.server.server_address[1]
+
+
+@pytest.fixture
+def server():
+    fake = FakeImapServer()
+    yield fake
+    fake.server.shutdown()
+    fake.server.server_close()
+
+
+@pytest.fixture
+def session(server):
+    session = ImapSession('127.0.0.1', 'user', 'secret', port=server.port, idle_timeout=5, use_ssl=False)
+    session.connect()
+    # The EXISTS of SELECT is not news
+    session.mail.untagged_responses.pop('EXISTS', None)
+    yield session
+    session.close()
+
+
+def timed(function):
+    started = time.monotonic()
+    return function(), time.monotonic() - started
+
+
+def test_connect_reads_uidvalidity(session):
+    assert session.uidvalidity == 77
+    assert session.supports_idle()
+
+
+def test_idle_returns_when_the_server_pushes_new_mail(session, server):
+    server.idle_updates.append([(0.2, b'* 5 EXISTS\r\n')])
+    changed, seconds = timed(session.wait_for_changes)
+    assert changed and seconds < 2
+
+
+def test_idle_sees_an_update_imaplib_already_buffered(session, server):
+    server.idle_updates.append([(0, b'* 5 EXISTS\r\n')])
+    changed, seconds = timed(session.wait_for_changes)
+    assert changed and seconds < 2
+
+
+def test_idle_times_out_without_changes(session, server):
+    session.idle_timeout = 0.2
+    assert session.wait_for_changes() is False
+    assert server.idle_count == 1
+    # The connection is usable afterwards
+    assert session.ensure_connected() is session.mail
+
+
+def test_interrupt_ends_the_wait(session):
+    threading.Timer(0.2, session.interrupt).start()
+    changed, seconds = timed(session.wait_for_changes)
+    assert changed is False and seconds < 2
+
+
+def test_changes_reported_in_earlier_responses_skip_idle(session, server):
+    session.mail.untagged_responses['EXISTS'] = [b'9']
+    assert session.wait_for_changes() is True
+    assert server.idle_count == 0
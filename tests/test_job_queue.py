@@ -0,0 +1,127 @@
+import pytest
+
+import job_queue
+from job_queue import advance_job, claim_job, finish_jobs, release_job
+
+
+class FakeJobCursor:
+    """Serves the lease_owner lookup of _update_leased and records every statement"""
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.executed = []
+
+    def execute(self, sql, params=()):
+        self.executed.append((' '.join(sql.split()), params))
+
+    def fetchone(self):
+        return None if self.owner is None else (self.owner,)
+
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.committed = self.rolled_back = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def cursor(self):
+        return self._cursor
+
+    def commit(self):
+        self.committed = True
+
+    def rollback(self):
+        self.rolled_back = True
+
+
+@pytest.fixture
+def claims(monkeypatch):
+    """Calls of _claim, which hands out a fresh job unless the message_id starts with 'taken'"""
+    calls = []
+
+    def _claim(message_id, mailbox, uidvalidity, uid, worker_id, lease):
+        calls.append(message_id)
+        if message_id.startswith('taken'):
+            return None
+        return {'state': 'fetched', 'session_id': None, 'reply': None, 'reply_message_id': None, 'attempts': 1}
+
+    monkeypatch.setattr(job_queue, '_claim', _claim)
+    monkeypatch.setattr(job_queue, '_held', set())
+    return calls
+
+
+@pytest.fixture
+def connection(monkeypatch):
+    def connect(owner='me'):
+        conn = FakeConnection(FakeJobCursor(owner))
+        monkeypatch.setattr(job_queue, 'get_connection', lambda: conn)
+        return conn
+    return connect
+
+
+def test_second_copy_in_this_process_is_skipped(claims):
+    assert claim_job('<a@x>', 'INBOX', 1, 10)['state'] == 'fetched'
+    assert claim_job('<a@x>', 'INBOX', 1, 11) is None
+    assert claims == ['<a@x>']
+
+
+def test_refused_claim_is_not_held(claims):
+    assert claim_job('taken<a@x>', 'INBOX', 1, 10) is None
+    assert claim_job('taken<a@x>', 'INBOX', 1, 10) is None
+    assert claims == ['taken<a@x>', 'taken<a@x>']
+
+
+def test_failed_claim_is_not_held(claims, monkeypatch):
+    def fail(*args):
+        raise RuntimeError("connection lost")
+
+    monkeypatch.setattr(job_queue, '_claim', fail)
+    with pytest.raises(RuntimeError):
+        claim_job('<a@x>', 'INBOX', 1, 10)
+    assert '<a@x>' not in job_queue._held
+
+
+def test_release_and_finish_let_the_job_be_claimed_again(claims, connection):
+    connection()
+    claim_job('<a@x>', 'INBOX', 1, 10)
+    release_job('<a@x>', error='smtp down', worker_id='me')
+    assert claim_job('<a@x>', 'INBOX', 1, 10) is not None
+    finish_jobs(['<a@x>'], worker_id='me')
+    assert claim_job('<a@x>', 'INBOX', 1, 10) is not None
+    assert claims == ['<a@x>'] * 3
+
+
+def test_advance_job_updates_while_the_lease_is_held(connection):
+    conn = connection(owner='me')
+    assert advance_job('<a@x>', 'generated', worker_id='me', lease=30, reply='Hi', reply_message_id='<r@x>')
+    sql, params = conn._cursor.executed[-1]
+    assert sql.startswith("UPDATE email_jobs SET state = %s, last_error = NULL, reply = %s, reply_message_id = %s, "
+                          "lease_expires_at = NOW() + INTERVAL %s SECOND")
+    assert params == ['generated', 'Hi', '<r@x>', 30, '<a@x>']
+    assert conn.committed
+
+
+@pytest.mark.parametrize('owner', ['someone else', None])
+def test_advance_job_refuses_after_losing_the_lease(connection, owner):
+    conn = connection(owner=owner)
+    assert advance_job('<a@x>', 'saved', worker_id='me', session_id='s') is False
+    assert len(conn._cursor.executed) == 1 and conn.rolled_back
+
+
+def test_unknown_state_is_rejected():
+    with pytest.raises(ValueError):
+        advance_job('<a@x>', 'done')
+
+
+def test_oldest_unfinished_uid_ignores_stale_jobs(connection):
+    conn = connection()
+    conn._cursor.fetchone = lambda: (42,)
+    assert job_queue.oldest_unfinished_uid('INBOX', 1, stale=600) == 42
+    sql, params = conn._cursor.executed[-1]
+    assert "lease_expires_at > NOW() OR updated_at > NOW() - INTERVAL %s SECOND" in sql
+    assert params == ('INBOX', 1, 600)
@@ -0,0 +1,134 @@
+import json
+import socket
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import llm
+from llm import generate, select_model, truncate_reply
+
+
+@pytest.mark.parametrize('text, expected', [
+    ("First sentence. Second one is cut", "First sentence."),
+    ("Is it shipped? Yes! And then", "Is it shipped? Yes!"),
+    ("Line one\nline two without end", "Line one"),
+    ("no boundary at all   ", "no boundary at all"),
+    ("Version 2.5 is out. Next", "Version 2.5 is out."),
+])
+def test_truncate_reply(text, expected):
+    assert truncate_reply(text) == expected
+
+
+def test_select_model(monkeypatch):
+    monkeypatch.setattr(llm, 'OLLAMA_MODEL', 'big')
+    monkeypatch.setattr(llm, 'OLLAMA_SMALL_MODEL', 'small')
+    monkeypatch.setattr(llm, 'OLLAMA_SMALL_MODEL_MAX_CHARS', 20)
+    assert select_model("Where is my order?") == 'small'
+    assert select_model("Where is my order?", has_history=True) == 'big'
+    assert select_model("A much longer email than twenty characters") == 'big'
+    monkeypatch.setattr(llm, 'OLLAMA_SMALL_MODEL', None)
+    assert select_model("Hi") == 'big'
+
+
+class FakeOllama:
+    """Streams /api/generate chunks from a script of (delay, chunk) steps; 'drop' closes the connection"""
+
+    def __init__(self):
+        self.scripts = []
+        self.requests = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                fake.requests.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+                script = fake.scripts.pop(0) if fake.scripts else []
+                self.send_response(200)
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                for delay, chunk in script:
+                    time.sleep(delay)
+                    if chunk == 'drop':
+                        self.connection.shutdown(socket.SHUT_RDWR)
+                        return
+                    body = (json.dumps(chunk) + '\n').encode()
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(body), body))
+                    self.wfile.flush()
+                self.wfile.write(b'0\r\n\r\n')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/api/generate"
+
+
+@pytest.fixture
+def ollama(monkeypatch):
+    fake = FakeOllama()
+    monkeypatch.setattr(llm, 'OLLAMA_URL', fake.url)
+    monkeypatch.setattr(llm, 'OLLAMA_MIN_PARTIAL_CHARS', 10)
+    # Retries wait two seconds in production; llm.time is the shared module, so swap in a copy
+    monkeypatch.setattr(llm, 'time', types.SimpleNamespace(monotonic=time.monotonic, sleep=lambda seconds: None))
+    yield fake
+    fake.server.shutdown()
+
+
+def tokens(*words):
+    return [(0, {'response': word}) for word in words]
+
+
+def test_complete_reply(ollama):
+    ollama.scripts.append(tokens("Your order ", "ships today.") +
+                          [(0, {'done': True, 'context': [1, 2], 'eval_count': 2, 'eval_duration': 10 ** 9})])
+    result = generate("prompt", model='m', system='be nice', context=[9])
+    assert result['text'] == "Your order ships today."
+    assert result['context'] == [1, 2]
+    assert result['tokens'] == 2 and result['tokens_per_second'] == 2
+    assert not result['truncated'] and result['ttft'] is not None
+    assert ollama.requests[0] == {'model': 'm', 'prompt': 'prompt', 'stream': True, 'system': 'be nice',
+                                  'context': [9]}
+
+
+def test_deadline_keeps_a_long_enough_partial_reply(ollama):
+    ollama.scripts.append(tokens("Your order ships today. ", "It will") + [(1.5, {'response': " arrive"})])
+    result = generate("prompt", total_timeout=0.5, first_token_timeout=5)
+    assert result['truncated']
+    assert result['text'] == "Your order ships today."
+    assert result['generation_seconds'] < 1.0
+
+
+def test_broken_stream_uses_the_same_partial_policy(ollama):
+    ollama.scripts.append(tokens("Your order ships today. ", "It will") + [(0.05, 'drop')])
+    result = generate("prompt", total_timeout=5)
+    assert result['truncated'] and result['text'] == "Your order ships today."
+    assert result['tokens'] == 2 and result['generation_seconds'] > 0
+
+
+def test_too_short_partial_reply_is_dropped(ollama):
+    ollama.scripts.append(tokens("Yes. ", "It") + [(0.05, 'drop')])
+    result = generate("prompt", total_timeout=5)
+    assert result['truncated'] and result['text'] == ''
+    assert result['ttft'] is not None
+
+
+def test_no_first_token_is_retried(ollama):
+    ollama.scripts.append([(0.5, {'response': "late"})])
+    ollama.scripts.append(tokens("On time.") + [(0, {'done': True})])
+    result = generate("prompt", first_token_timeout=0.2, total_timeout=10)
+    assert result['text'] == "On time."
+    assert len(ollama.requests) == 2
+
+
+def test_failure_without_tokens(ollama):
+    for _ in range(3):
+        ollama.scripts.append([(0, {'error': 'model not found'})])
+    result = generate("prompt", max_retries=3, total_timeout=10)
+    assert result['ttft'] is None and result['text'] == ''
+    assert len(ollama.requests) == 3
@@ -0,0 +1,105 @@
+import asyncio
+import os
+
+import log_tail
+from log_tail import follow_log, read_log_tail
+
+
+def write_lines(path, count):
+    with open(path, 'w') as f:
+        for i in range(count):
+            f.write(f"line {i}\n")
+
+
+def test_read_log_tail_returns_last_lines(tmp_path):
+    path = tmp_path / 'service.log'
+    write_lines(path, 10)
+    assert read_log_tail(path, 3) == ['line 7\n', 'line 8\n', 'line 9\n']
+
+
+def test_read_log_tail_across_blocks(tmp_path, monkeypatch):
+    monkeypatch.setattr(log_tail, 'BLOCK_SIZE', 16)
+    path = tmp_path / 'service.log'
+    write_lines(path, 1000)
+    assert read_log_tail(path, 25) == [f"line {i}\n" for i in range(975, 1000)]
+
+
+def test_read_log_tail_short_file_and_zero_count(tmp_path):
+    path = tmp_path / 'service.log'
+    write_lines(path, 2)
+    assert read_log_tail(path, 100) == ['line 0\n', 'line 1\n']
+    assert read_log_tail(path, 0) == []
+
+
+def test_read_log_tail_keeps_unterminated_last_line(tmp_path):
+    path = tmp_path / 'service.log'
+    path.write_text("first\nsecond\nthird")
+    assert read_log_tail(path, 2) == ['second\n', 'third']
+
+
+def test_read_log_tail_multibyte_split_by_a_block(tmp_path, monkeypatch):
+    monkeypatch.setattr(log_tail, 'BLOCK_SIZE', 5)
+    path = tmp_path / 'service.log'
+    path.write_text("Jörg wrote\nGrüße aus Köln\n", encoding='utf-8')
+    assert read_log_tail(path, 1) == ['Grüße aus Köln\n']
+
+
+def collect(path, actions, count):
+    """Follow path while running each action (a callable) between reads; return count lines"""
+
+    async def run():
+        lines = []
+        agen = follow_log(path, poll_interval=0.01)
+        pending = list(actions)
+        # Let the follower open the file at its current end first
+        task = asyncio.ensure_future(agen.__anext__())
+        await asyncio.sleep(0.05)
+        while len(lines) < count:
+            if pending:
+                pending.pop(0)()
+            done, _ = await asyncio.wait({task}, timeout=0.05)
+            if done:
+                lines.append(task.result())
+                task = asyncio.ensure_future(agen.__anext__())
+        task.cancel()
+        await agen.aclose()
+        return lines
+
+    return asyncio.run(asyncio.wait_for(run(), timeout=5))
+
+
+def test_follow_log_yields_appended_lines_only(tmp_path):
+    path = tmp_path / 'service.log'
+    write_lines(path, 3)
+
+    def append():
+        with open(path, 'a') as f:
+            f.write("new 1\nnew 2\n")
+
+    assert collect(path, [append], 2) == ['new 1\n', 'new 2\n']
+
+
+def test_follow_log_holds_back_partial_lines(tmp_path):
+    path = tmp_path / 'service.log'
+    path.write_text("")
+
+    def append(text):
+        def action():
+            with open(path, 'a') as f:
+                f.write(text)
+        return action
+
+    assert collect(path, [append("half"), append(" and the rest\n")], 1) == ['half and the rest\n']
+
+
+def test_follow_log_reopens_a_rotated_file(tmp_path):
+    path = tmp_path / 'service.log'
+    write_lines(path, 1)
+
+    def rotate():
+        with open(path, 'a') as f:
+            f.write("before rotation\n")
+        os.rename(path, tmp_path / 'service.log.1')
+        path.write_text("after rotation\n")
+
+    assert collect(path, [rotate], 2) == ['before rotation\n', 'after rotation\n']
@@ -0,0 +1,154 @@
+import base64
+from email.generator import BytesGenerator
+from email.message import EmailMessage
+from io import BytesIO
+
+from mail_client import (chunked, decode_header_value, decode_text, decode_transfer, fetch_text_emails, html_to_text,
+                         parse_fetch_response, reply_address, select_text_part, to_sequence_set, walk_bodystructure)
+
+
+def test_to_sequence_set_compresses_runs():
+    assert to_sequence_set([1, 2, 3, 5, 7, 8, 9]) == '1:3,5,7:9'
+
+
+def test_to_sequence_set_sorts_and_dedupes():
+    assert to_sequence_set(['9', 3, 4, 3, b'10']) == '3:4,9:10'
+
+
+def test_to_sequence_set_single_and_empty():
+    assert to_sequence_set([42]) == '42'
+    assert to_sequence_set([]) == ''
+
+
+def test_chunked_keeps_order():
+    assert list(chunked([1, 2, 3, 4, 5], 2)) == [[1, 2], [3, 4], [5]]
+
+
+# BODYSTRUCTURE of a message with a text/plain + text/html alternative and a PDF attachment
+MIXED_STRUCTURE = (b'(("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" 25 2 NIL NIL NIL NIL)'
+                   b'("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "7BIT" 40 1 NIL NIL NIL NIL) "ALTERNATIVE" '
+                   b'("BOUNDARY" "b2") NIL NIL NIL)'
+                   b'("APPLICATION" "PDF" ("NAME" "invoice.pdf") NIL NIL "BASE64" 120000 NIL '
+                   b'("ATTACHMENT" ("FILENAME" "invoice.pdf")) NIL NIL) "MIXED" ("BOUNDARY" "b1") NIL NIL NIL')
+
+
+def structure(raw):
+    return parse_fetch_response([b'1 (UID 7 BODYSTRUCTURE (' + raw + b'))'])[0]['BODYSTRUCTURE']
+
+
+def test_parse_fetch_response_with_literals_and_partial_origin():
+    data = [(b'1 (UID 7 BODY[1]<0> {5}', b'hello'), b' FLAGS (\\Seen))',
+            (b'2 (UID 9 BODY[1]<0> {3}', b'bye'), b' FLAGS ())']
+    assert parse_fetch_response(data) == [
+        {'UID': b'7', 'BODY[1]': b'hello', 'FLAGS': [b'\\Seen']},
+        {'UID': b'9', 'BODY[1]': b'bye', 'FLAGS': []},
+    ]
+
+
+def test_parse_fetch_response_quoted_strings_and_nil():
+    [fields] = parse_fetch_response([b'1 (UID 3 X-TEST ("a \\"quoted\\" word" NIL))'])
+    assert fields['X-TEST'] == [b'a "quoted" word', None]
+
+
+def test_walk_bodystructure_numbers_nested_parts():
+    parts = list(walk_bodystructure(structure(MIXED_STRUCTURE)))
+    assert [(part['part'], part['type'], part['subtype']) for part in parts] == [
+        ('1.1', 'text', 'plain'), ('1.2', 'text', 'html'), ('2', 'application', 'pdf')]
+    assert parts[0]['params'] == {'charset': 'utf-8'}
+    assert parts[0]['encoding'] == 'quoted-printable'
+    assert parts[2]['size'] == 120000
+    assert parts[2]['disposition'] == 'attachment'
+
+
+def test_walk_bodystructure_single_part_is_part_1():
+    [part] = walk_bodystructure(structure(b'"TEXT" "PLAIN" ("CHARSET" "us-ascii") NIL NIL "7BIT" 12 1 NIL NIL NIL NIL'))
+    assert part['part'] == '1'
+    assert part['disposition'] is None
+
+
+def test_select_text_part_prefers_plain():
+    assert select_text_part(structure(MIXED_STRUCTURE))['part'] == '1.1'
+
+
+def test_select_text_part_skips_text_attachments_and_falls_back_to_html():
+    raw = (b'("TEXT" "PLAIN" ("NAME" "notes.txt") NIL NIL "7BIT" 500 10 NIL ("ATTACHMENT" ("FILENAME" "notes.txt")) '
+           b'NIL NIL)("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "7BIT" 40 1 NIL NIL NIL NIL) "MIXED" NIL NIL NIL NIL')
+    assert select_text_part(structure(raw))['part'] == '2'
+
+
+def test_select_text_part_without_text():
+    raw = b'"IMAGE" "PNG" NIL NIL NIL "BASE64" 2048 NIL NIL NIL NIL'
+    assert select_text_part(structure(raw)) is None
+
+
+def test_decode_transfer_cut_off_base64():
+    encoded = base64.b64encode("Grüße aus Köln".encode('utf-8'))
+    assert decode_transfer(encoded[:-3] + b'\r\n', 'base64') == "Grüße aus Köln".encode('utf-8')[:-2]
+    assert decode_transfer(b'SGk=\r\n', 'BASE64') == b'Hi'
+
+
+def test_decode_transfer_quoted_printable():
+    assert decode_transfer(b'caf=C3=A9 =\r\nlatte', 'quoted-printable') == 'café latte'.encode('utf-8')
+
+
+def test_decode_text_charset_handling():
+    assert decode_text('café'.encode('latin-1'), 'iso-8859-1') == 'café'
+    assert decode_text('café'.encode('utf-8'), 'x-unknown') == 'café'
+    # A size cap cut the last character in half
+    assert decode_text('café'.encode('utf-8')[:-1]) == 'caf'
+    assert decode_text('naïve'.encode('cp1252')) == 'naïve'
+
+
+def test_html_to_text():
+    text = html_to_text('<p>Hello<br>there</p><script>var x;</script><div>Thanks &amp; bye</div>')
+    assert [line.strip() for line in text.splitlines() if line.strip()] == ['Hello', 'there', 'Thanks & bye']
+
+
+def test_reply_address_keeps_the_address_outside_encoded_words():
+    msg = EmailMessage()
+    msg['To'] = reply_address('=?utf-8?q?J=C3=B6rg?= <jorg@example.com>')
+    out = BytesIO()
+    BytesGenerator(out).flatten(msg)
+    header = out.getvalue().split(b'\n')[0]
+    assert header.endswith(b' <jorg@example.com>')
+    assert decode_header_value(msg['To']) == 'Jörg <jorg@example.com>'
+    assert reply_address('plain@example.com') == 'plain@example.com'
+
+
+class FakeImap:
+    """Answers the two FETCH rounds of fetch_text_emails from canned messages"""
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.commands = []
+
+    def uid(self, command, sequence_set, items):
+        self.commands.append(items)
+        data = []
+        for uid, (header, structure_raw, body) in sorted(self.messages.items()):
+            if 'BODYSTRUCTURE' in items:
+                data += [(b'1 (UID %d BODYSTRUCTURE (%s) BODY[HEADER] {%d}' % (uid, structure_raw, len(header)), header),
+                         b')']
+            else:
+                data += [(b'1 (UID %d BODY[1.1]<0> {%d}' % (uid, len(body)), body), b')']
+        return 'OK', data
+
+
+def test_fetch_text_emails_fetches_only_the_text_part():
+    header = (b'From: =?utf-8?q?J=C3=B6rg?= <jorg@example.com>\r\nSubject: Invoice\r\n'
+              b'Message-ID: <m1@example.com>\r\n\r\n')
+    mail = FakeImap({7: (header, MIXED_STRUCTURE, b'Please resend the invoice =E2=80=93 thanks')})
+    [(uid, fields)] = fetch_text_emails(mail, [7], max_body_bytes=1000)
+    assert uid == 7
+    assert fields['sender_email'] == 'Jörg <jorg@example.com>'
+    assert fields['reply_address'].endswith('<jorg@example.com>')
+    assert fields['message_id'] == '<m1@example.com>'
+    assert fields['message_body'] == 'Please resend the invoice – thanks'
+    assert mail.commands == ['(UID BODYSTRUCTURE BODY.PEEK[HEADER])', '(UID BODY.PEEK[1.1]<0.1000>)']
+
+
+def test_fetch_text_emails_skips_senders_not_accepted():
+    header = b'From: other@example.com\r\nSubject: Hi\r\nMessage-ID: <m2@example.com>\r\n\r\n'
+    mail = FakeImap({8: (header, MIXED_STRUCTURE, b'ignored')})
+    assert fetch_text_emails(mail, [8], accept=lambda sender: 'customer' in sender) == []
+    assert len(mail.commands) == 1
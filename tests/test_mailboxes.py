@@ -0,0 +1,81 @@
+import pytest
+
+from mailboxes import Mailbox, assign_mailboxes, load_mailboxes
+
+
+def mailbox(shards=1, senders=(), email='support@example.com'):
+    return Mailbox('support', email, 'secret', 'imap.example.com', senders=senders, shards=shards)
+
+
+def test_key_includes_the_shard_only_when_split():
+    assert mailbox().key == 'support@example.com/inbox'
+    assert [shard.key for shard in mailbox(shards=2).split()] == [
+        'support@example.com/inbox#0/2', 'support@example.com/inbox#1/2']
+
+
+def test_every_sender_is_owned_by_exactly_one_shard():
+    shards = mailbox(shards=3).split()
+    for index in range(50):
+        sender = f"customer{index}@example.com"
+        assert sum(shard.owns(sender) for shard in shards) == 1
+
+
+def test_owner_ignores_display_name_and_case():
+    shards = mailbox(shards=4).split()
+    owners = [shard.shard for shard in shards if shard.owns('Jane <Jane@Example.com>')]
+    assert owners == [shard.shard for shard in shards if shard.owns('jane@example.com')]
+
+
+def test_search_criteria():
+    assert mailbox().search_criteria() == '(UNSEEN NOT KEYWORD "Processed-By-System")'
+    assert mailbox(senders=['a@x.com', 'b@x.com', 'c@x.com']).search_criteria(41) == (
+        '(UID 42:* UNSEEN OR FROM "a@x.com" OR FROM "b@x.com" FROM "c@x.com" NOT KEYWORD "Processed-By-System")')
+
+
+def test_assign_mailboxes_spreads_shards_round_robin():
+    first, second = mailbox(shards=3), mailbox(email='sales@example.com')
+    assignments = assign_mailboxes([first, second], 2)
+    assert [[shard.key for shard in worker] for worker in assignments] == [
+        ['support@example.com/inbox#0/3', 'support@example.com/inbox#2/3'],
+        ['support@example.com/inbox#1/3', 'sales@example.com/inbox'],
+    ]
+
+
+def test_assign_mailboxes_never_starts_idle_workers():
+    assert len(assign_mailboxes([mailbox(shards=2)], 8)) == 2
+    assert len(assign_mailboxes([mailbox()], 0)) == 1
+
+
+def test_load_mailboxes_from_file(tmp_path, monkeypatch):
+    monkeypatch.setenv('SALES_PASSWORD', 'from-env')
+    path = tmp_path / 'mailboxes.yml'
+    path.write_text("""
+mailboxes:
+  - name: support
+    email: support@example.com
+    password: secret
+    imap_server: imap.example.com
+    senders: a@x.com, b@x.com
+    shards: 2
+  - email: sales@example.com
+    password_env: SALES_PASSWORD
+    imap_server: imap.example.com
+    folder: orders
+""")
+    support, sales = load_mailboxes(str(path))
+    assert support.senders == ['a@x.com', 'b@x.com'] and support.shards == 2
+    assert sales.name == 'sales@example.com' and sales.password == 'from-env' and sales.folder == 'orders'
+
+
+@pytest.mark.parametrize('content, message', [
+    ("mailboxes:\n  - email: a@example.com\n", "needs an email and a password"),
+    ("mailboxes:\n  - email: a@example.com\n    password: x\n    shards: 0\n", "shards must be at least 1"),
+    ("mailboxes:\n  - {email: a@example.com, password: x}\n  - {email: a@example.com, password: y}\n",
+     "listed twice"),
+    ("mailboxes: []\n", "No mailboxes"),
+])
+def test_load_mailboxes_rejects_bad_files(tmp_path, content, message):
+    path = tmp_path / 'mailboxes.yml'
+    path.write_text(content)
+    with pytest.raises(ValueError, match=message):
+        load_mailboxes(str(path))
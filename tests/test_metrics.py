@@ -0,0 +1,74 @@
+import pytest
+
+import metrics
+from metrics import Counter, Gauge, Histogram, Trace, render_prometheus
+
+
+def test_register_returns_the_existing_metric():
+    first = metrics.counter('test_registered_total', "Registered twice")
+    assert metrics.counter('test_registered_total', "Registered twice") is first
+
+
+def test_counter_and_gauge_series():
+    emails = Counter('emails_total', "Emails")
+    emails.inc(mailbox='INBOX')
+    emails.inc(2, mailbox='INBOX')
+    emails.inc(mailbox='Support')
+    assert sorted(emails.snapshot()['series'], key=str) == [[{'mailbox': 'INBOX'}, 3], [{'mailbox': 'Support'}, 1]]
+
+    queued = Gauge('queued', "Queued")
+    queued.set(4, stage='send')
+    queued.set_function(lambda: 7, stage='generate')
+    queued.set_function(lambda: 1 / 0, stage='broken')
+    assert sorted(queued.snapshot()['series'], key=str) == [[{'stage': 'generate'}, 7], [{'stage': 'send'}, 4]]
+
+
+def test_histogram_buckets():
+    seconds = Histogram('seconds', "Seconds", buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        seconds.observe(value)
+    [[labels, value]] = seconds.snapshot()['series']
+    assert labels == {}
+    # Upper bounds are inclusive, as in Prometheus
+    assert value == {'counts': [2, 1, 1], 'sum': pytest.approx(3.65)}
+
+
+def test_render_prometheus_merges_processes():
+    emails = Counter('emails_total', "Emails")
+    emails.inc(mailbox='IN"BOX')
+    seconds = Histogram('seconds', "Seconds", buckets=(1,))
+    seconds.observe(0.5)
+    seconds.observe(2)
+    snapshot = {'metrics': {'emails_total': emails.snapshot(), 'seconds': seconds.snapshot(),
+                            'empty': Counter('empty', "Unused").snapshot()}}
+    text = render_prometheus([({'worker': 'a'}, snapshot), ({'worker': 'b'}, snapshot)])
+    assert text == (
+        '# HELP emails_total Emails\n'
+        '# TYPE emails_total counter\n'
+        'emails_total{mailbox="IN\\"BOX",worker="a"} 1\n'
+        'emails_total{mailbox="IN\\"BOX",worker="b"} 1\n'
+        '# HELP seconds Seconds\n'
+        '# TYPE seconds histogram\n'
+        'seconds_bucket{le="1",worker="a"} 1\n'
+        'seconds_bucket{le="+Inf",worker="a"} 2\n'
+        'seconds_sum{worker="a"} 2.5\n'
+        'seconds_count{worker="a"} 2\n'
+        'seconds_bucket{le="1",worker="b"} 1\n'
+        'seconds_bucket{le="+Inf",worker="b"} 2\n'
+        'seconds_sum{worker="b"} 2.5\n'
+        'seconds_count{worker="b"} 2\n'
+    )
+
+
+def test_trace_records_spans_and_errors():
+    trace = Trace('<a@x>', mailbox='INBOX')
+    with trace.span('save'):
+        pass
+    with pytest.raises(ValueError):
+        with trace.span('generate'):
+            raise ValueError("bad reply")
+    record = trace.finish('failed')
+    assert [span['name'] for span in record['spans']] == ['save', 'generate']
+    assert record['spans'][1]['error'] == 'ValueError' and 'error' not in record['spans'][0]
+    assert record['attributes'] == {'mailbox': 'INBOX'}
+    assert metrics.snapshot()['traces'][-1] is record
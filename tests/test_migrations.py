@@ -0,0 +1,103 @@
+import mysql.connector
+import pytest
+
+from database import MIGRATIONS, apply_migrations
+
+
+class FakeMigrationCursor:
+    """Runs apply_migrations against an in-memory schema_migrations table"""
+
+    def __init__(self, applied=(), errors=None):
+        self.applied = set(applied)
+        self.errors = errors or {}
+        self.statements = []
+        self.lock_held = False
+        self._result = None
+
+    def execute(self, sql, params=()):
+        sql = ' '.join(sql.split())
+        if sql in self.errors:
+            raise self.errors[sql]
+        self.statements.append(sql)
+        if sql.startswith("SELECT GET_LOCK"):
+            self.lock_held = True
+            self._result = [(1,)]
+        elif sql.startswith("SELECT RELEASE_LOCK"):
+            self.lock_held = False
+            self._result = [(1,)]
+        elif sql == "SELECT version FROM schema_migrations":
+            self._result = [(version,) for version in sorted(self.applied)]
+        elif sql.startswith("INSERT INTO schema_migrations"):
+            self.applied.add(params[0])
+
+    def fetchone(self):
+        return self._result[0]
+
+    def fetchall(self):
+        return self._result
+
+
+class FakeMigrationConnection:
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.commits = 0
+
+    def cursor(self):
+        return self._cursor
+
+    def commit(self):
+        self.commits += 1
+
+
+def statement(sql):
+    return ' '.join(sql.split())
+
+
+def test_versions_are_unique_and_ordered():
+    versions = [version for version, _, _ in MIGRATIONS]
+    assert versions == sorted(set(versions))
+
+
+def test_applies_only_missing_migrations_in_order():
+    cursor = FakeMigrationCursor(applied=[1, 2])
+    conn = FakeMigrationConnection(cursor)
+    apply_migrations(conn)
+    assert cursor.applied == {version for version, _, _ in MIGRATIONS}
+    assert conn.commits == len(MIGRATIONS) - 2
+    assert statement(MIGRATIONS[0][2][0]) not in cursor.statements
+    first_new = cursor.statements.index(statement(MIGRATIONS[2][2][0]))
+    assert cursor.statements[first_new - 1] == "SELECT version FROM schema_migrations"
+    assert not cursor.lock_held
+
+    # Nothing left to do the second time
+    before = len(cursor.statements)
+    apply_migrations(conn)
+    assert not [sql for sql in cursor.statements[before:] if sql.startswith(("ALTER", "INSERT INTO schema"))]
+
+
+def test_statement_already_applied_is_skipped():
+    version, _, statements = MIGRATIONS[-1]
+    error = mysql.connector.errors.ProgrammingError(msg="Duplicate column name", errno=1060)
+    cursor = FakeMigrationCursor(applied=[v for v, _, _ in MIGRATIONS[:-1]], errors={statement(statements[0]): error})
+    apply_migrations(FakeMigrationConnection(cursor))
+    assert version in cursor.applied
+    assert all(statement(sql) in cursor.statements for sql in statements[1:])
+
+
+def test_failed_migration_is_not_recorded_and_releases_the_lock():
+    version, _, statements = MIGRATIONS[-1]
+    error = mysql.connector.errors.ProgrammingError(msg="Syntax error", errno=1064)
+    cursor = FakeMigrationCursor(applied=[v for v, _, _ in MIGRATIONS[:-1]], errors={statement(statements[0]): error})
+    with pytest.raises(mysql.connector.Error):
+        apply_migrations(FakeMigrationConnection(cursor))
+    assert version not in cursor.applied
+    assert not cursor.lock_held
+
+
+def test_lock_timeout(monkeypatch):
+    cursor = FakeMigrationCursor()
+    monkeypatch.setattr(cursor, 'fetchone', lambda: (0,))
+    with pytest.raises(RuntimeError):
+        apply_migrations(FakeMigrationConnection(cursor))
+    assert not any(sql.startswith("ALTER") for sql in cursor.statements)
+
@@ -0,0 +1,145 @@
+import threading
+import time
+
+from pipeline import EmailPipeline, SessionSerialExecutor
+
+
+class FakeSmtp:
+    def __init__(self, sent):
+        self.sent = sent
+        self.closed = False
+
+    def quit(self):
+        self.closed = True
+
+
+def make_pipeline(generate=None, send=None, **kwargs):
+    sent = []
+    connections = []
+
+    def connect():
+        connections.append(FakeSmtp(sent))
+        return connections[-1]
+
+    def default_send(smtp, job):
+        smtp.sent.append(job['message_id'])
+
+    pipeline = EmailPipeline(generate=generate or (lambda job: f"reply to {job['message_id']}"),
+                             send=send or default_send, connect_smtp=connect, **kwargs)
+    return pipeline, sent, connections
+
+
+def drain(pipeline):
+    done = []
+    pipeline.drain(done.append)
+    return done
+
+
+def test_session_serial_executor_keeps_order_within_a_session():
+    executor = SessionSerialExecutor(workers=4)
+    order = []
+    lock = threading.Lock()
+
+    def work(job):
+        # Earlier jobs take longer, so only the per-session queue keeps them in order
+        time.sleep(0.02 if job[1] == 0 else 0)
+        with lock:
+            order.append(job)
+
+    for index in range(3):
+        for session in ('a', 'b'):
+            executor.submit(session, work, (session, index))
+    executor.shutdown()
+    assert [index for session, index in order if session == 'a'] == [0, 1, 2]
+    assert [index for session, index in order if session == 'b'] == [0, 1, 2]
+
+
+def test_session_serial_executor_continues_after_a_failure():
+    executor = SessionSerialExecutor(workers=2)
+    ran = []
+
+    def work(job):
+        ran.append(job)
+        if job == 1:
+            raise RuntimeError("boom")
+
+    for job in (1, 2):
+        executor.submit('s', work, job)
+    executor.shutdown()
+    assert ran == [1, 2]
+
+
+def test_pipeline_generates_and_sends_every_job():
+    pipeline, sent, connections = make_pipeline(generation_workers=3, smtp_workers=2)
+    jobs = [{'message_id': f"m{i}", 'session_id': f"s{i % 4}"} for i in range(20)]
+    for job in jobs:
+        pipeline.submit(job)
+    done = drain(pipeline)
+    pipeline.close()
+
+    assert sorted(job['message_id'] for job in done) == sorted(job['message_id'] for job in jobs)
+    assert sorted(sent) == sorted(job['message_id'] for job in jobs)
+    assert all(job['reply'] == f"reply to {job['message_id']}" for job in done)
+    assert all(smtp.closed for smtp in connections)
+    assert pipeline.pending() == 0
+
+
+def test_pipeline_sends_a_session_in_order():
+    def generate(job):
+        # The first reply of the session is the slowest to generate
+        time.sleep(0.03 if job['message_id'] == 'm0' else 0)
+        return 'reply'
+
+    pipeline, sent, connections = make_pipeline(generate=generate, generation_workers=4, smtp_workers=3)
+    for i in range(5):
+        pipeline.submit({'message_id': f"m{i}", 'session_id': 'same'})
+    drain(pipeline)
+    pipeline.close()
+    assert sent == [f"m{i}" for i in range(5)]
+
+
+def test_pipeline_reports_failed_generation_and_send():
+    def generate(job):
+        if job['message_id'] == 'bad-generate':
+            raise RuntimeError("model down")
+        return 'reply'
+
+    def send(smtp, job):
+        if job['message_id'] == 'bad-send':
+            raise OSError("smtp down")
+        smtp.sent.append(job['message_id'])
+
+    pipeline, sent, connections = make_pipeline(generate=generate, send=send)
+    for message_id in ('ok', 'bad-generate', 'bad-send', 'after'):
+        pipeline.submit({'message_id': message_id, 'session_id': message_id})
+    done = {job['message_id']: job for job in drain(pipeline)}
+    pipeline.close()
+
+    assert str(done['bad-generate']['error']) == "model down"
+    assert str(done['bad-send']['error']) == "smtp down"
+    assert 'error' not in done['ok'] and 'error' not in done['after']
+    assert sorted(sent) == ['after', 'ok']
+    # The failed send dropped its connection; the next job reconnected
+    assert len(connections) == 2 and connections[0].closed
+
+
+def test_submit_blocks_at_max_pending():
+    release = threading.Event()
+
+    def generate(job):
+        release.wait(5)
+        return 'reply'
+
+    pipeline, sent, connections = make_pipeline(generate=generate, max_pending=2)
+    pipeline.submit({'message_id': 'm1', 'session_id': 'a'})
+    pipeline.submit({'message_id': 'm2', 'session_id': 'b'})
+    third = threading.Thread(target=pipeline.submit, args=({'message_id': 'm3', 'session_id': 'c'},))
+    third.start()
+    third.join(0.1)
+    assert third.is_alive()
+
+    release.set()
+    third.join(5)
+    assert not third.is_alive()
+    assert len(drain(pipeline)) == 3
+    pipeline.close()
@@ -0,0 +1,72 @@
+import prompts
+from prompts import (SYSTEM_PROMPT, SessionContextCache, build_prompt, clean_turn, first_sentence,
+                     history_window, trim_to_tokens)
+
+
+def turn(message, role='user', received_at='2024-01-01 10:00:00'):
+    return {'role': role, 'message': message, 'received_at': received_at}
+
+
+def test_clean_turn_drops_quotes_and_blank_runs():
+    assert clean_turn("Thanks!\n> old text\n  > more\n\n\n\nBye") == "Thanks!\n\nBye"
+    assert clean_turn(None) == ''
+
+
+def test_trim_to_tokens():
+    assert trim_to_tokens("short", 10) == "short"
+    assert trim_to_tokens("one two three four five", 3) == "one two [...]"
+
+
+def test_first_sentence():
+    assert first_sentence("My order is late.  Please  help.") == "My order is late."
+    assert first_sentence("no end " * 40) == ("no end " * 40)[:120]
+
+
+def test_history_window_keeps_recent_turns_and_summarizes_older():
+    history = [turn(f"Message number {i}. " + "x" * 200) for i in range(10)]
+    summary, kept = history_window(history, budget=200)
+    assert kept and len(kept) < 10
+    # The kept turns are the newest, oldest first
+    assert kept[-1].endswith(history[-1]['message'])
+    assert "Message number 0." in summary
+    assert sum(prompts.estimate_tokens(text) for text in kept) <= 200
+
+
+def test_history_window_notes_omitted_turns():
+    history = [turn(f"Message number {i}. " + "x" * 200) for i in range(40)]
+    summary, kept = history_window(history, budget=100)
+    assert summary.startswith("- (")
+    assert "earlier message(s) omitted" in summary
+
+
+def test_history_window_fits_everything():
+    assert history_window([turn("Hi."), turn("Hello.", role='assistant')]) == (
+        None, ["Customer (2024-01-01 10:00:00):\nHi.", "Support (2024-01-01 10:00:00):\nHello."])
+
+
+def test_build_prompt_leaves_instructions_to_the_system_prompt():
+    prompt = build_prompt("a@example.com", "Refund", "Where is my refund?")
+    assert "Earlier messages" not in prompt
+    assert SYSTEM_PROMPT not in prompt
+    assert "From: a@example.com\nSubject: Refund\nMessage:\nWhere is my refund?" in prompt
+    with_history = build_prompt("a@example.com", "Refund", "Any news?", history=[turn("Where is my refund?")])
+    assert with_history.startswith("Earlier messages in this conversation:\n\nCustomer (")
+
+
+def test_context_cache_is_per_model_and_bounded():
+    cache = SessionContextCache(max_sessions=2, max_tokens=3)
+    cache.put(('s1', 'a@x'), 'm', [1, 2])
+    assert cache.get(('s1', 'a@x'), 'm') == [1, 2]
+    assert cache.get(('s1', 'a@x'), 'other') is None
+    assert cache.get(('s1', 'b@x'), 'm') is None
+
+    cache.put(('s2', 'a@x'), 'm', [3])
+    cache.get(('s1', 'a@x'), 'm')
+    cache.put(('s3', 'a@x'), 'm', [4])
+    # s2 was the least recently used
+    assert cache.get(('s2', 'a@x'), 'm') is None
+    assert cache.get(('s1', 'a@x'), 'm') == [1, 2]
+
+    # A context grown past max_tokens replaces the old one with nothing
+    cache.put(('s1', 'a@x'), 'm', [1, 2, 3, 4])
+    assert cache.get(('s1', 'a@x'), 'm') is None
@@ -0,0 +1,76 @@
+import reply_cache
+from reply_cache import ReplyCache, cache_key, hamming_distance, normalize_body, simhash
+
+BODY = ("Hello, I ordered a blue kettle last week (order 5512) and it still has not arrived. "
+        "Could you tell me when it will be delivered? Thanks, Anna")
+
+
+def memory_cache(**kwargs):
+    return ReplyCache(persist=False, **kwargs)
+
+
+def test_normalize_body_drops_quotes_case_and_whitespace():
+    body = "Hi   THERE\n> quoted reply\n  > more quote\nsecond   line\n"
+    assert normalize_body(body) == "hi there second line"
+
+
+def test_cache_key_ignores_formatting_and_display_name():
+    assert (cache_key("Anna <anna@example.com>", "Re: Kettle", "Where is it?")
+            == cache_key("anna@example.com", "kettle", "  where IS it? "))
+
+
+def test_cache_key_differs_by_sender():
+    assert cache_key("anna@example.com", "Kettle", "Where is it?") != cache_key("bob@example.com", "Kettle", "Where is it?")
+
+
+def test_simhash_is_close_for_small_edits_and_far_for_other_text():
+    original = simhash(normalize_body(BODY))
+    edited = simhash(normalize_body(BODY.replace("Thanks, Anna", "Best regards, Anna")))
+    other = simhash(normalize_body("Please cancel my subscription and refund the last invoice, it was charged twice."))
+    assert hamming_distance(original, edited) <= reply_cache.REPLY_CACHE_NEAR_DUP_DISTANCE
+    assert hamming_distance(original, other) > reply_cache.REPLY_CACHE_NEAR_DUP_DISTANCE
+
+
+def test_simhash_is_deterministic_64_bit():
+    assert simhash("same words") == simhash("same words")
+    assert 0 <= simhash(BODY) < 2 ** 64
+
+
+def test_exact_hit():
+    cache = memory_cache()
+    cache.store("anna@example.com", "Kettle", BODY, "It ships tomorrow.", session_id="s1")
+    assert cache.lookup("Anna <anna@example.com>", "Re: Kettle", BODY.upper(), session_id="s2") == "It ships tomorrow."
+
+
+def test_near_duplicate_hit_only_for_same_sender_and_session():
+    cache = memory_cache()
+    cache.store("anna@example.com", "Kettle", BODY, "It ships tomorrow.", session_id="s1")
+    resent = BODY.replace("Thanks, Anna", "Best regards, Anna")
+    assert cache.lookup("anna@example.com", "Kettle again", resent, session_id="s1") == "It ships tomorrow."
+    assert cache.lookup("anna@example.com", "Kettle again", resent, session_id="s2") is None
+    assert cache.lookup("bob@example.com", "Kettle again", resent, session_id="s1") is None
+
+
+def test_no_hit_across_senders_for_a_short_repeat():
+    cache = memory_cache()
+    cache.store("anna@example.com", "Order", "Any update on my order?", "Anna's order ships today.", session_id="s1")
+    assert cache.lookup("bob@example.com", "Order", "Any update on my order?", session_id="s1") is None
+
+
+def test_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(reply_cache.time, 'time', lambda: now[0])
+    cache = memory_cache(ttl=60)
+    cache.store("anna@example.com", "Kettle", BODY, "It ships tomorrow.")
+    now[0] += 61
+    assert cache.lookup("anna@example.com", "Kettle", BODY) is None
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = memory_cache(max_size=2)
+    cache.store("a@example.com", "One", "first email", "reply 1")
+    cache.store("a@example.com", "Two", "second email", "reply 2")
+    assert cache.lookup("a@example.com", "One", "first email") == "reply 1"
+    cache.store("a@example.com", "Three", "third email", "reply 3")
+    assert cache.lookup("a@example.com", "Two", "second email") is None
+    assert cache.lookup("a@example.com", "One", "first email") == "reply 1"
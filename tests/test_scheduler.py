@@ -0,0 +1,100 @@
+import threading
+import time
+
+import scheduler
+from scheduler import LLMScheduler
+
+
+def observe(llm_scheduler, latency, **slot_args):
+    with llm_scheduler.slot(**slot_args) as ticket:
+        ticket['latency'] = latency
+
+
+def test_limit_is_cut_when_latency_rises(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(scheduler.time, 'monotonic', lambda: now[0])
+    llm_scheduler = LLMScheduler(max_in_flight=8, min_in_flight=1, latency_tolerance=2.0, smoothing=1.0)
+    observe(llm_scheduler, 1.0)
+    assert llm_scheduler.limit == 8
+
+    observe(llm_scheduler, 5.0)
+    assert llm_scheduler.limit == 6
+
+    # At most one cut per smoothed latency period
+    now[0] += 1
+    observe(llm_scheduler, 5.0)
+    assert llm_scheduler.limit == 6
+    now[0] += 10
+    observe(llm_scheduler, 5.0)
+    assert llm_scheduler.limit == 4
+
+
+def test_limit_never_drops_below_minimum(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(scheduler.time, 'monotonic', lambda: now[0])
+    llm_scheduler = LLMScheduler(max_in_flight=2, min_in_flight=1, smoothing=1.0)
+    observe(llm_scheduler, 1.0)
+    for _ in range(5):
+        now[0] += 100
+        observe(llm_scheduler, 50.0)
+    assert llm_scheduler.limit == 1
+
+
+def test_limit_grows_back_one_step_at_a_time(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(scheduler.time, 'monotonic', lambda: now[0])
+    llm_scheduler = LLMScheduler(max_in_flight=4, min_in_flight=1, smoothing=1.0)
+    observe(llm_scheduler, 1.0)
+    observe(llm_scheduler, 10.0)
+    assert llm_scheduler.limit == 3
+
+    observe(llm_scheduler, 1.0)
+    assert llm_scheduler.limit == 4
+    observe(llm_scheduler, 1.0)
+    assert llm_scheduler.limit == 4
+
+
+def test_stats_reports_state():
+    llm_scheduler = LLMScheduler(max_in_flight=3)
+    with llm_scheduler.slot():
+        stats = llm_scheduler.stats()
+    assert stats['limit'] == 3 and stats['in_flight'] == 1 and stats['waiting'] == 0
+    assert llm_scheduler.stats()['in_flight'] == 0
+
+
+def admission_order(requests):
+    """Admit requests, as (name, enqueued_at, session_id), behind a held slot; return the order they ran in"""
+    llm_scheduler = LLMScheduler(max_in_flight=1, min_in_flight=1)
+    order = []
+    started = threading.Event()
+
+    def hold():
+        with llm_scheduler.slot(session_id='busy'):
+            started.set()
+            while llm_scheduler.stats()['waiting'] < len(requests):
+                time.sleep(0.005)
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    started.wait()
+
+    def run(name, enqueued_at, session_id):
+        with llm_scheduler.slot(enqueued_at=enqueued_at, session_id=session_id):
+            order.append(name)
+
+    threads = [threading.Thread(target=run, args=request) for request in requests]
+    for thread in threads:
+        thread.start()
+    for thread in [holder] + threads:
+        thread.join(timeout=5)
+    return order
+
+
+def test_oldest_email_is_admitted_first():
+    assert admission_order([('new', 30.0, None), ('old', 10.0, None), ('middle', 20.0, None)]) == \
+        ['old', 'middle', 'new']
+
+
+def test_sessions_with_a_request_in_flight_go_last():
+    assert admission_order([('same session', 10.0, 'busy'), ('other session', 20.0, 'other')]) == \
+        ['other session', 'same session']
@@ -0,0 +1,78 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import database
+import main
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_imports_do_not_touch_the_database_or_log_file(tmp_path):
+    script = """
+import mysql.connector, mysql.connector.pooling
+
+def refuse(*args, **kwargs):
+    raise AssertionError("connected to MySQL at import time")
+
+mysql.connector.connect = refuse
+mysql.connector.pooling.MySQLConnectionPool = refuse
+import database, main, api
+assert database._pool is None
+"""
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    subprocess.run([sys.executable, '-c', script], cwd=tmp_path, env=env, check=True)
+    assert not (tmp_path / 'email_service.log').exists()
+
+
+def test_ensure_schema_runs_once(monkeypatch):
+    calls = []
+    monkeypatch.setattr(database, 'init_db', lambda: calls.append(1))
+    monkeypatch.setattr(database, '_schema_checked', False)
+    monkeypatch.setattr(database, 'DB_SCHEMA_CHECK', True)
+    database.ensure_schema()
+    database.ensure_schema()
+    assert calls == [1]
+
+
+def test_ensure_schema_can_be_turned_off(monkeypatch):
+    calls = []
+    monkeypatch.setattr(database, 'init_db', lambda: calls.append(1))
+    monkeypatch.setattr(database, '_schema_checked', False)
+    monkeypatch.setattr(database, 'DB_SCHEMA_CHECK', False)
+    database.ensure_schema()
+    assert calls == []
+    database.ensure_schema(force=True)
+    assert calls == [1]
+
+
+@pytest.fixture
+def templates(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, '_templates_cache', (None, None, None))
+    return tmp_path / 'templates.yml'
+
+
+def test_templates_are_reread_only_when_the_file_changes(templates, monkeypatch):
+    templates.write_text("greeting: {subject: Hello}\n")
+    assert main.load_email_templates(str(templates)) == {'greeting': {'subject': 'Hello'}}
+
+    opened = []
+    real_open = open
+    monkeypatch.setattr('builtins.open', lambda *args, **kwargs: opened.append(args) or real_open(*args, **kwargs))
+    main.load_email_templates(str(templates))
+    assert opened == []
+
+    templates.write_text("greeting: {subject: Hi}\n")
+    os.utime(templates, ns=(1, 1))
+    assert main.load_email_templates(str(templates)) == {'greeting': {'subject': 'Hi'}}
+
+
+def test_broken_templates_keep_the_last_good_version(templates):
+    templates.write_text("greeting: {subject: Hello}\n")
+    main.load_email_templates(str(templates))
+    templates.write_text("greeting: {subject: [unclosed\n")
+    os.utime(templates, ns=(1, 1))
+    assert main.load_email_templates(str(templates)) == {'greeting': {'subject': 'Hello'}}
+    assert main.load_email_templates(str(templates.with_name('missing.yml'))) == main.DEFAULT_TEMPLATES
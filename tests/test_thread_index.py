@@ -0,0 +1,193 @@
+import re
+
+import pytest
+
+from thread_index import (ThreadLocks, _session_lock_name, count_merges, extract_email_address, find_session,
+                          link_thread, lock_sessions, locked_thread_keys, merge_sessions, normalize_subject,
+                          thread_keys_for)
+
+
+class FakeThreadTables:
+    """In-memory session_aliases, thread_keys and session_summaries behind a DB-API style cursor"""
+
+    def __init__(self):
+        self.aliases = {}
+        self.keys = {}
+        self.summaries = {}
+        self.merge_counter = 0
+        self.locks = []
+        self.statements = []
+        self._result = None
+
+    def execute(self, sql, params=()):
+        sql = ' '.join(sql.split())
+        self.statements.append(sql)
+        self._result = None
+        if sql.startswith('SELECT parent_id FROM session_aliases'):
+            parent = self.aliases.get(params[0])
+            self._result = (parent,) if parent else None
+        elif sql.startswith('SELECT session_id FROM thread_keys'):
+            session = self.keys.get((params[0], params[1]))
+            self._result = (session,) if session else None
+        elif sql.startswith('UPDATE session_aliases'):
+            winner, loser = params
+            for session, parent in list(self.aliases.items()):
+                if parent == loser:
+                    self.aliases[session] = winner
+        elif sql.startswith('INSERT INTO session_aliases'):
+            self.aliases[params[0]] = params[1]
+        elif sql.startswith('INSERT INTO session_summaries') and 'SELECT' in sql:
+            winner, loser = params
+            if loser in self.summaries:
+                count = self.summaries[loser]
+                self.summaries[winner] = self.summaries.get(winner, 0) + count
+        elif sql.startswith('DELETE FROM session_summaries'):
+            self.summaries.pop(params[0], None)
+        elif sql.startswith('INSERT INTO thread_keys'):
+            self.keys[(params[0], params[1])] = params[2]
+        elif sql.startswith('UPDATE session_merge_counter'):
+            self.merge_counter += params[0]
+        elif sql.startswith('SELECT GET_LOCK'):
+            self.locks.append(params[0])
+            self._result = (1,)
+        elif sql.startswith('SELECT RELEASE_LOCK'):
+            self.locks.remove(params[0])
+            self._result = (1,)
+        elif not re.match(r'SET TRANSACTION', sql):
+            raise AssertionError(f"Unexpected statement: {sql}")
+
+    def fetchone(self):
+        return self._result
+
+
+@pytest.fixture
+def tables():
+    return FakeThreadTables()
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('Jane Doe <Jane@Example.com>', 'jane@example.com'),
+    ('  jane@example.com ', 'jane@example.com'),
+    ('"Doe, Jane" <jane@example.com>', 'jane@example.com'),
+])
+def test_extract_email_address(value, expected):
+    assert extract_email_address(value) == expected
+
+
+@pytest.mark.parametrize('subject, expected', [
+    ('Re: Refund request', 'refund request'),
+    ('FWD:  Refund request ', 'refund request'),
+    ('Refund request', 'refund request'),
+    ('Re: Re: Refund', 're: refund'),
+    (None, ''),
+])
+def test_normalize_subject(subject, expected):
+    assert normalize_subject(subject) == expected
+
+
+def test_thread_keys_for_sender_and_subject():
+    keys = thread_keys_for('Jane <jane@example.com>', 'Re: Refund')
+    assert [key_type for key_type, key_hash in keys] == ['sender', 'subject']
+    assert keys == thread_keys_for('jane@example.com', 'refund')
+    assert thread_keys_for('jane@example.com', 'Re: ') == keys[:1]
+
+
+def test_first_email_starts_its_own_session(tables):
+    assert link_thread(tables, 'm1', 'jane@example.com', 'Refund') == 'm1'
+    assert set(tables.keys.values()) == {'m1'}
+    assert tables.aliases == {}
+
+
+def test_same_sender_joins_the_newest_session(tables):
+    link_thread(tables, 'm1', 'jane@example.com', 'Refund')
+    assert link_thread(tables, 'm2', 'Jane <jane@example.com>', 'Another question') == 'm2'
+    assert tables.aliases == {'m1': 'm2'}
+    assert find_session(tables, 'm1') == 'm2'
+
+
+def test_merges_keep_the_forest_flat(tables):
+    link_thread(tables, 'm1', 'a@example.com', 'Refund')
+    link_thread(tables, 'm2', 'a@example.com', 'Shipping')
+    link_thread(tables, 'm3', 'b@example.com', 'Shipping')
+    assert tables.aliases == {'m1': 'm3', 'm2': 'm3'}
+    assert find_session(tables, 'm1') == 'm3'
+
+
+def test_an_email_linking_two_conversations_merges_both(tables):
+    link_thread(tables, 'm1', 'a@example.com', 'Refund')
+    link_thread(tables, 'm2', 'b@example.com', 'Shipping')
+    assert link_thread(tables, 'm3', 'a@example.com', 'Shipping') == 'm3'
+    assert tables.aliases == {'m1': 'm3', 'm2': 'm3'}
+
+
+def test_merge_folds_the_summaries(tables):
+    tables.summaries = {'winner': 2, 'loser': 3}
+    tables.aliases = {'older': 'loser'}
+    merge_sessions(tables, 'winner', 'loser')
+    assert tables.summaries == {'winner': 5}
+    assert tables.aliases == {'older': 'winner', 'loser': 'winner'}
+
+
+def test_reply_in_an_existing_session_links_without_merging(tables):
+    link_thread(tables, 'm1', 'jane@example.com', 'Refund')
+    assert link_thread(tables, 'm1', 'jane@example.com', 'Re: Refund') == 'm1'
+    assert tables.aliases == {}
+
+
+def test_locked_thread_keys_takes_sorted_locks_and_releases_them(tables):
+    keys = thread_keys_for('jane@example.com', 'Refund')
+    with locked_thread_keys(tables, keys) as locks:
+        assert tables.statements[0] == 'SET TRANSACTION ISOLATION LEVEL READ COMMITTED'
+        assert tables.locks == sorted(tables.locks) and len(tables.locks) == 2
+        assert link_thread(tables, 'm1', 'jane@example.com', 'Refund', locks) == 'm1'
+        # The session being linked is locked as well
+        assert len(tables.locks) == 3
+    assert tables.locks == []
+
+
+def test_lock_names_fit_mysql_limit(tables):
+    with locked_thread_keys(tables, thread_keys_for('a@example.com', 'x' * 500)) as locks:
+        lock_sessions(tables, locks, ['<' + 'y' * 300 + '@example.com>'])
+        assert all(len(name) <= 64 for name in tables.locks)
+
+
+def test_lock_timeout_raises_and_releases(tables):
+    class Busy(FakeThreadTables):
+        def execute(self, sql, params=()):
+            super().execute(sql, params)
+            if 'GET_LOCK' in sql and len(self.locks) == 2:
+                self._result = (0,)
+                self.locks.pop()
+
+    busy = Busy()
+    with pytest.raises(RuntimeError, match="Timed out"):
+        with locked_thread_keys(busy, thread_keys_for('jane@example.com', 'Refund')):
+            pass
+    assert busy.locks == []
+
+
+def test_lock_sessions_resolves_again_after_a_concurrent_merge(tables):
+    tables.aliases = {'x': 'a'}
+
+    class MergedWhileWaiting(FakeThreadTables):
+        def execute(self, sql, params=()):
+            super().execute(sql, params)
+            if 'GET_LOCK' in sql and params[0] == _session_lock_name('a'):
+                # Another worker merged a into b and committed just before we got the lock
+                self.aliases.update({'x': 'b', 'a': 'b'})
+
+    merged = MergedWhileWaiting()
+    merged.aliases = dict(tables.aliases)
+    locks = ThreadLocks(merged)
+    assert lock_sessions(merged, locks, ['x']) == ['b']
+    assert _session_lock_name('b') in locks.held
+
+
+def test_merges_under_locks_are_counted_at_commit(tables):
+    link_thread(tables, 'm1', 'a@example.com', 'Refund')
+    assert tables.merge_counter == 0
+    with locked_thread_keys(tables, thread_keys_for('a@example.com', 'Other')) as locks:
+        link_thread(tables, 'm2', 'a@example.com', 'Other', locks)
+        assert tables.merge_counter == 0 and locks.merges == 1
+        count_merges(tables, locks.merges)
+    assert tables.merge_counter == 1
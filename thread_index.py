@@ -0,0 +1,248 @@
+"""
+Incremental conversation (thread) resolution.
+
+Every session_id ever written to the emails table stays as it was written.
+Sessions that turn out to be the same conversation are merged in the
+session_aliases table, a union-find forest that is kept fully flattened:
+each merged session has exactly one row pointing straight at its root, so
+resolving any session_id is a single primary-key lookup, and readers can
+resolve rows with one LEFT JOIN (COALESCE(parent_id, session_id)).
+
+thread_keys maps a normalized sender address and a normalized subject to
+the session they were last seen in, which replaces scanning emails for
+messages from the same sender or with the same subject.
+
+session_merge_counter counts the merges, so readers that cache rows with
+their canonical session_id (the change feed) notice when it changed.
+
+session_summaries holds one row per canonical session (message count,
+first/last activity, last role) so conversations can be listed without
+aggregating emails. It is updated for every saved email and folded
+together when sessions merge.
+"""
+
+import hashlib
+import logging
+import re
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Reply/forward prefix stripped from subjects before they are used as thread keys
+SUBJECT_PREFIX_RE = re.compile(r'^(?:Re|Fwd|FW|RE|FWD):\s*', flags=re.IGNORECASE)
+
+# Seconds to wait for another worker linking an email with the same sender or subject
+THREAD_LOCK_TIMEOUT = 30
+
+
+def extract_email_address(email_string):
+    """Extract clean email address from a string like 'Name <email@example.com>'"""
+    match = re.search(r'<([^>]+)>', email_string)
+    if match:
+        return match.group(1).lower()
+    return email_string.strip().lower()
+
+
+def normalize_subject(subject):
+    """Lower-cased subject without a leading Re:/Fwd: prefix"""
+    return SUBJECT_PREFIX_RE.sub('', subject or '', count=1).strip().lower()
+
+
+def _key_hash(value):
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+
+def thread_keys_for(sender_email, subject):
+    """Return the (key_type, key_hash) pairs an inbound email is grouped by"""
+    keys = []
+    clean_sender = extract_email_address(sender_email or '')
+    if clean_sender:
+        keys.append(('sender', _key_hash(clean_sender)))
+    # An empty subject says nothing about the conversation, so it is not a key
+    clean_subject = normalize_subject(subject)
+    if clean_subject:
+        keys.append(('subject', _key_hash(clean_subject)))
+    return keys
+
+
+class ThreadLocks:
+    """
+    MySQL named locks held by one transaction and released together, and
+    the number of session merges made under them (see count_merges)
+    """
+
+    def __init__(self, c, timeout=THREAD_LOCK_TIMEOUT):
+        self.c = c
+        self.timeout = timeout
+        self.held = []
+        self.merges = 0
+
+    def acquire(self, names):
+        """
+        Take the named locks not held yet, in sorted order. Locks taken by a
+        later call cannot be ordered with those already held; MySQL detects
+        such a deadlock and fails one of the transactions.
+        """
+        for name in sorted(set(names) - set(self.held)):
+            self.c.execute("SELECT GET_LOCK(%s, %s)", (name, self.timeout))
+            if self.c.fetchone()[0] != 1:
+                raise RuntimeError(f"Timed out waiting for thread lock {name}")
+            self.held.append(name)
+
+    def release(self):
+        for name in reversed(self.held):
+            try:
+                self.c.execute("SELECT RELEASE_LOCK(%s)", (name,))
+                self.c.fetchone()
+            except Exception as e:
+                # Named locks are also released when the pooled session is reset
+                logger.warning(f"Could not release thread lock {name}: {e}")
+        self.held = []
+
+
+def _session_lock_name(session_id):
+    # Lock names are limited to 64 characters, Message-IDs are not
+    return f"session:{_key_hash(session_id)}"
+
+
+@contextmanager
+def locked_thread_keys(c, keys, timeout=THREAD_LOCK_TIMEOUT):
+    """
+    Hold a MySQL named lock per thread key, so emails sharing a sender or
+    subject are linked one at a time, also across worker processes; yields
+    the ThreadLocks, which link_thread() adds the locks of the sessions it
+    merges to. Enter it before the transaction's first statement: the
+    transaction then runs at READ COMMITTED, so every read made after
+    taking a lock sees what the previous holder committed. All locks are
+    released after the caller committed.
+    """
+    c.execute("SET TRANSACTION ISOLATION LEVEL READ COMMITTED")
+    locks = ThreadLocks(c, timeout)
+    try:
+        locks.acquire(f"thread:{key_type}:{key_hash}" for key_type, key_hash in keys)
+        yield locks
+    finally:
+        locks.release()
+
+
+def find_session(c, session_id):
+    """Resolve a session_id to the root of its merged conversation"""
+    if not session_id:
+        return session_id
+    c.execute("SELECT parent_id FROM session_aliases WHERE session_id = %s", (session_id,))
+    result = c.fetchone()
+    return result[0] if result else session_id
+
+
+def merge_sessions(c, winner, loser):
+    """Merge the loser root session into the winner root session"""
+    # Keep the forest flat: everything that pointed at loser now points at winner
+    c.execute("UPDATE session_aliases SET parent_id = %s WHERE parent_id = %s", (winner, loser))
+    c.execute("""INSERT INTO session_aliases (session_id, parent_id) VALUES (%s, %s)
+                 ON DUPLICATE KEY UPDATE parent_id = VALUES(parent_id)""", (loser, winner))
+
+    # Fold the loser's summary into the winner's (the winner may not have one yet)
+    c.execute("""INSERT INTO session_summaries
+                     (session_id, subject, sender_email, message_count, first_at, last_at, last_role, last_message_id)
+                 SELECT %s, subject, sender_email, message_count, first_at, last_at, last_role, last_message_id
+                 FROM session_summaries WHERE session_id = %s
+                 ON DUPLICATE KEY UPDATE
+                     message_count = message_count + VALUES(message_count),
+                     subject = IF(VALUES(first_at) < first_at, VALUES(subject), subject),
+                     sender_email = IF(VALUES(first_at) < first_at, VALUES(sender_email), sender_email),
+                     first_at = LEAST(first_at, VALUES(first_at)),
+                     last_role = IF(VALUES(last_at) > last_at, VALUES(last_role), last_role),
+                     last_message_id = IF(VALUES(last_at) > last_at, VALUES(last_message_id), last_message_id),
+                     last_at = GREATEST(last_at, VALUES(last_at))""", (winner, loser))
+    c.execute("DELETE FROM session_summaries WHERE session_id = %s", (loser,))
+    logger.info(f"Merged session {loser} into session_id: {winner}")
+
+
+def lock_sessions(c, locks, session_ids):
+    """
+    Resolve session_ids to their roots while holding the session lock of
+    every root, and return the roots in order. A root is only merged by the
+    holder of its lock, so the roots stay roots until the locks are released;
+    if one was merged before its lock was taken, resolve again.
+    """
+    roots = [find_session(c, session_id) for session_id in session_ids]
+    while locks is not None:
+        locks.acquire(_session_lock_name(root) for root in roots)
+        resolved = [find_session(c, session_id) for session_id in session_ids]
+        if resolved == roots:
+            break
+        roots = resolved
+    return roots
+
+
+def link_thread(c, session_id, sender_email, subject, locks=None):
+    """
+    Attach an inbound email's session to any conversation sharing its sender
+    or normalized subject, and return the canonical session_id. Call it
+    within locked_thread_keys() for the email's thread_keys_for() and pass
+    its locks, so that the sessions being merged are locked as well.
+
+    The session of the newest email wins, matching the previous behaviour of
+    moving older emails into the latest session.
+    """
+    keys = thread_keys_for(sender_email, subject)
+
+    linked = []
+    for key_type, key_hash in keys:
+        c.execute("SELECT session_id FROM thread_keys WHERE key_type = %s AND key_hash = %s",
+                  (key_type, key_hash))
+        result = c.fetchone()
+        if result:
+            linked.append(result[0])
+
+    root, *other_roots = lock_sessions(c, locks, [session_id] + linked)
+    merges = 0
+    for other_root in dict.fromkeys(other_roots):
+        if other_root != root:
+            merge_sessions(c, root, other_root)
+            merges += 1
+    if locks is None:
+        count_merges(c, merges)
+    else:
+        # Counted right before commit, so the counter row is not locked while waiting for more locks
+        locks.merges += merges
+
+    for key_type, key_hash in keys:
+        c.execute("""INSERT INTO thread_keys (key_type, key_hash, session_id) VALUES (%s, %s, %s)
+                     ON DUPLICATE KEY UPDATE session_id = VALUES(session_id)""",
+                  (key_type, key_hash, root))
+    return root
+
+
+def count_merges(c, merges):
+    """Add merges to session_merge_counter; call it just before committing them"""
+    if merges:
+        c.execute("UPDATE session_merge_counter SET merges = merges + %s WHERE id = 1", (merges,))
+
+
+# MySQL applies the assignments left to right, so last_at must be updated last
+_RECORD_SESSION_MESSAGE_SQL = """INSERT INTO session_summaries
+        (session_id, subject, sender_email, message_count, first_at, last_at, last_role, last_message_id)
+    VALUES (%s, %s, %s, 1, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        message_count = message_count + 1,
+        last_role = IF(VALUES(last_at) >= last_at, VALUES(last_role), last_role),
+        last_message_id = IF(VALUES(last_at) >= last_at, VALUES(last_message_id), last_message_id),
+        last_at = GREATEST(last_at, VALUES(last_at))"""
+
+
+def record_session_message(c, session_id, sender_email, subject, message_id, role, received_at):
+    """Count a newly saved email in its canonical session's summary"""
+    c.execute(_RECORD_SESSION_MESSAGE_SQL,
+              (session_id, subject, sender_email, received_at, received_at, role, message_id))
+
+
+def record_session_messages(c, messages):
+    """
+    record_session_message for many emails at once; messages are
+    (session_id, sender_email, subject, message_id, role, received_at) tuples
+    """
+    # Rows of one session are applied in order, so keep them sorted by time
+    c.executemany(_RECORD_SESSION_MESSAGE_SQL,
+                  [(session_id, subject, sender_email, received_at, received_at, role, message_id)
+                   for session_id, sender_email, subject, message_id, role, received_at in messages])